@@ -1,3 +1,6 @@
+from multiprocessing import freeze_support
 from src.pipe_replacement_tool import PipeReplacementTool
 
-PipeReplacementTool()
+if __name__ == "__main__":
+    freeze_support()  # Needed by the process pools when running as a frozen executable
+    PipeReplacementTool()
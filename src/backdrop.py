@@ -0,0 +1,72 @@
+from typing import NamedTuple, Optional, Tuple
+import numpy as np
+import contextily as ctx
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from src.figures import release_figure
+from src.tile_cache import add_attribution, basemap_layer
+
+
+# Longest side in pixels of the network raster of a backdrop
+MAX_BACKDROP_PIXELS = 4096
+
+# Below this number of pipes drawing them as lines is cheaper than compositing their raster
+MIN_RASTER_EDGES = 2000
+
+
+class Backdrop(NamedTuple):
+    extent: Tuple[float, float, float, float]  # (xmin, xmax, ymin, ymax) frame of every map drawn on the backdrop
+    basemap: Optional[np.ndarray]  # Warped basemap tiles, None without tiles
+    basemap_extent: Optional[Tuple[float, float, float, float]]
+    network: Optional[np.ndarray]  # RGBA raster of the pipes over the frame, transparent elsewhere
+    attribution: Optional[str]
+
+
+def render_backdrop(extent, crs, edges=None, figsize=(12, 10), dpi=100, linewidth=1, color='0.2', source=None) -> Backdrop:
+    '''
+    Static layers of a series of maps with the same frame, rendered once: the basemap (fetched and warped once) and,
+    with edges of at least MIN_RASTER_EDGES pipes, the pipes drawn as in edges.plot(linewidth=linewidth, color=color)
+    and rasterized at the pixel density of a figsize figure. draw_backdrop then composites them under the layers of
+    each map; without a network raster the maps draw the pipes themselves.
+    '''
+    provider = ctx.providers.CartoDB.Positron if source is None else source
+    basemap, basemap_extent = basemap_layer(extent, crs, provider)
+
+    network = None
+    if edges is not None and len(edges) >= MIN_RASTER_EDGES:
+        xmin, xmax, ymin, ymax = extent
+        density = max(figsize[0] * dpi / (xmax - xmin), figsize[1] * dpi / (ymax - ymin))
+        density = min(density, MAX_BACKDROP_PIXELS / max(xmax - xmin, ymax - ymin))
+        width, height = max(int(np.ceil((xmax - xmin) * density)), 1), max(int(np.ceil((ymax - ymin) * density)), 1)
+
+        # The axes fill a transparent canvas of exactly the frame, so every pixel maps back to the frame
+        fig = Figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+        canvas = FigureCanvasAgg(fig)
+        fig.patch.set_alpha(0)
+        ax = fig.add_axes([0, 0, 1, 1])
+        ax.set_axis_off()
+        edges.plot(ax=ax, linewidth=linewidth, color=color)
+        ax.set_aspect('auto')
+        ax.set_xlim(xmin, xmax)
+        ax.set_ylim(ymin, ymax)
+        canvas.draw()
+        network = np.asarray(canvas.buffer_rgba()).copy()
+        release_figure(fig)
+
+    return Backdrop(tuple(extent), basemap, basemap_extent, network, provider.get("attribution"))
+
+
+def draw_backdrop(ax, backdrop: Backdrop, network_zorder: float = 1.5) -> None:
+    # The basemap goes under everything, the pipes above the filled polygons (zorder 1) and under the lines (zorder 2),
+    # where edges.plot and contextily put them. The axes are framed to the extent of the backdrop
+    xmin, xmax, ymin, ymax = backdrop.extent
+
+    if backdrop.basemap is not None:
+        ax.imshow(backdrop.basemap, extent=backdrop.basemap_extent, interpolation="bilinear", zorder=0)
+    if backdrop.network is not None:
+        ax.imshow(backdrop.network, extent=backdrop.extent, interpolation="bilinear", zorder=network_zorder)
+
+    ax.set_aspect('equal')
+    ax.axis((xmin, xmax, ymin, ymax))
+    if backdrop.basemap is not None and backdrop.attribution:
+        add_attribution(ax, backdrop.attribution)
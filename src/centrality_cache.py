@@ -0,0 +1,68 @@
+from typing import Dict, Optional
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+
+
+# Bump when the cached columns or their meaning change, so that older entries are ignored
+CACHE_VERSION = 2
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".prt_cache", "centralities")
+
+
+def network_hash(edges, lengths: Optional[np.ndarray] = None) -> str:
+    '''
+    Content hash of the network: the geometry of every edge (after the projection to EPSG 2100) together with
+    its start and end node, in the order momepy returns the edges. Two shapefiles with the same pipes
+    give the same hash regardless of their file name or the attribute columns. lengths are the weights of the
+    edges for the length weighted metrics, they come from an attribute (USER_L) and not only from the geometry.
+    '''
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(edges['node_start'].to_numpy(dtype=np.int64)).tobytes())
+    digest.update(np.ascontiguousarray(edges['node_end'].to_numpy(dtype=np.int64)).tobytes())
+
+    for wkb in edges.geometry.to_wkb():
+        digest.update(wkb)
+
+    if lengths is not None:
+        digest.update(np.ascontiguousarray(lengths, dtype=np.float64).tobytes())
+
+    return digest.hexdigest()
+
+
+def centrality_cache_key(network: str, betweenness_k: Optional[int] = None, seed: Optional[int] = None, engine: str = "networkx",
+                         contract_chains: bool = False, distance: str = "hops") -> str:
+    # Exact results are the same for every engine, sampled ones depend on the pivots and on how the error is estimated
+    if betweenness_k is None:
+        variant = "exact"
+    else:
+        variant = f"k{betweenness_k}_s{seed}_{engine}"
+    if contract_chains:
+        variant += "_contracted"
+    if distance != "hops":
+        variant += f"_{distance}"
+    return f"{network}_v{CACHE_VERSION}_{variant}"
+
+
+def load_centralities(key: str) -> Optional[Dict[str, np.ndarray]]:
+    path = os.path.join(CACHE_DIR, key + ".npz")
+
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with np.load(path) as data:
+            return {column: data[column] for column in data.files}
+    except (OSError, ValueError):
+        return None  # A corrupt or half written entry is treated as a miss and will be overwritten
+
+
+def save_centralities(key: str, columns: pd.DataFrame) -> None:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, key + ".npz")
+
+    # Write to a temporary file first so that a crash never leaves a truncated entry behind
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, **{column: columns[column].to_numpy() for column in columns.columns})
+    os.replace(tmp_path, path)
@@ -2,6 +2,8 @@ SRC_CRS = "EPSG:2100"
 TARGET_CRS = "EPSG:4326"
 
 WIN_WAIT_BEFORE_CLOSE = 700  # After the calculations of a popup window finish, the window will close after this time in ms
+RENDER_POLL_INTERVAL = 500  # A map that is still being rendered in the background is checked again after this time in ms
+PREVIEW_DEBOUNCE_MS = 30  # The live preview of the composite metric is redrawn at most once per this interval while a slider moves
 
 LEFT_RIGHT_FRAME_TITLE_DIV = 1.9
 LEFT_RIGHT_FRAME_CONTENT_DIV = 2
@@ -18,6 +20,23 @@ RESET_MAP_TEXT = "Reset map"
 
 MENU_SPACES = "       "
 
+CENTRALITY_ENGINES = ["networkx", "csr"]
+CENTRALITY_DISTANCES = ["hops", "length"]
+BETWEENNESS_MODES = ["exact", "pivots", "accuracy"]
+
+# p-value thresholds of the choice of the best cell size, the smallest one with a significant cell size is used
+P_VALUE_THRESHOLDS = [0.05, 0.10, 0.15, 0.20, 0.25, 0.30, 0.35, 0.40, 0.45, 0.50]
+MORAN_PERMUTATIONS = 999
+MORAN_SEED = 42
+MORAN_INFERENCES = ["permutation", "analytic"]
+SQUARE_SIZE_SEARCHES = ["grid", "adaptive"]
+SQUARE_SIZE_MIN_STEP = 25  # Finest step in metres of the adaptive search of the cell size
+BASE_SIZE_MIN_FRACTION = 8  # The base fishnet of a sweep is used when its cells are at least 1/8 of the smallest size
+
+# Attribute columns read from the input shapefiles, every other column of the EYDAP exports is skipped when loading them
+NETWORK_COLUMNS = ["ID", "LABEL", "D", "MATERIAL", "USER_L"]
+DAMAGES_COLUMNS = ["KOD_VLAVIS", "DATE_EIDOP", "PERIGRAF__"]
+
 MATERIAL_COLORS = {
 	'Asbestos Cement': "#FF0000",
 	'PVC': "#00FF00",
@@ -31,6 +50,19 @@ BETWEENESS_TOOLTIP = 'Betweenness centrality metric expresses "how often" shorte
 BRIDGES_TOOLTIP = 'Bridges metric expresses whether the pipeline is a "bridge" of the network or not. It practically indicates that if the pipeline is removed, then parts of the network are completely cut off. Bridge metric identifies the pipelines that can lead to the interruption of water supply to consumer segments.'
 COMPOSITE_TOOLTIP = 'The above selected weights of the individual topological metrics are normalized and aggregated into a "Composite Metric". The Composite metric practically takes into account all the above "policies" of prioritising pipe replacement. Equally weights across the 3 metrics are suggested.'
 COMBINED_METRIC_FAILURES_TOOLTIP = 'The final index is calculated by combining the composite metric with the failure index. The weights are normalized. For example, if only the failure index should be considered with no contribution from topological metrics, the slider should be set to 1. Conversely, if only the topological metric is to be considered, the slider should be set to 0. It is recommended to assign equal weights to both the composite metric and the failures index.'
+CENTRALITY_ENGINE_TOOLTIP = 'The engine used to calculate the closeness, betweenness and bridges metrics. Both engines produce the same exact results. "networkx" is the reference implementation, "csr" converts the network into compact arrays first and is much faster on large networks. With a sampled betweenness the "csr" engine rescales the estimate like networkx 3.5 and newer, so its values differ slightly from those of the "networkx" engine. The results are cached per network, so running again on the same network with different weights only takes seconds.'
+CENTRALITY_WORKERS_TOOLTIP = 'Number of processes used to calculate the closeness and betweenness metrics. The network is split into its connected components (pressure zones, islands) and every process calculates the metrics of its own part, the results are identical to a single process run. The "csr" engine also splits a large component across the processes, the "networkx" engine only runs different components in parallel and does not use the processes for a sampled betweenness. Set it to the number of CPU cores of the workstation.'
+BETWEENNESS_SAMPLING_TOOLTIP = 'How the betweenness metric is calculated. "exact" uses the shortest paths from every node. "pivots" estimates it from the given number of randomly chosen source nodes and "accuracy" picks enough source nodes to keep the error of the normalised betweenness below the given value (e.g. 0.05). The sampled modes are reproducible and report the estimated error, use them for a quick first map of a large network.'
+CENTRALITY_DISTANCE_TOOLTIP = 'How the shortest paths between the nodes are measured. "hops" counts the number of pipes, so a short fitting counts as much as a long main. "length" uses the pipe lengths (the USER_L attribute, or the length of the geometry where it is missing). Use "length" with the "csr" engine and contracted pipe chains on large networks.'
+CONTRACT_CHAINS_TOOLTIP = 'Network shapefiles split the pipes at every valve and fitting. With this option the chains of such pipes are merged into single links before the calculation of the metrics and every pipe of a chain gets the values of its link. The bridges are identical and the calculation is several times faster, the closeness and betweenness are an approximation that keeps the ranking of the main pipes.'
+LIVE_PREVIEW_TOOLTIP = 'Color the pipe network on the map by the composite metric while moving the sliders above. The closeness, betweenness and bridges metrics are calculated once when the preview is enabled (or taken from the cache if this network has been analysed before), after that only their weighted sum is recalculated.'
+SWEEP_WORKERS_TOOLTIP = 'Number of processes used to evaluate the cell sizes between the lower and the upper bound, every process creates the grid, the criticality map and the Moran\'s I of its own cell sizes. The results are the same for any number of processes. Set it to the number of CPU cores of the workstation.'
+MORAN_PERMUTATIONS_TOOLTIP = 'Number of random permutations used to calculate the p-value of the Moran\'s I of every cell size and of the LISA clusters. More permutations give a more precise p-value but take longer, 999 is the usual value.'
+MORAN_SEED_TOOLTIP = 'Seed of the random permutations. Runs with the same seed give exactly the same p-values, with any number of processes.'
+MORAN_EARLY_STOP_TOOLTIP = 'Stop the permutations of a cell size as soon as its p-value is clearly below or above every threshold used to choose the best cell size. The choice of the best cell size is the same and the calculation is much faster, the reported p-values are less precise.'
+MORAN_INFERENCE_TOOLTIP = 'How the significance (p-value) of the Moran\'s I of every cell size is calculated. "permutation" runs the random permutations for every cell size. "analytic" compares the cell sizes with the analytical p-value of Moran\'s I and runs the permutations only for the best few cell sizes to confirm the choice, which is much faster for many cell sizes. The analytical p-values are marked in the comparison results.'
+SQUARE_SIZE_SEARCH_TOOLTIP = 'How the cell sizes between the lower and the upper bound are evaluated. "grid" evaluates every 100 m. "adaptive" evaluates every 100 m and then the sizes 50 m and 25 m around the best cell size, so the optimal cell size is found with a 25 m precision for only a few extra cell sizes. All the evaluated cell sizes are shown in the comparison results.'
+LAZY_MAPS_TOOLTIP = 'Draw the criticality map of a cell size only when it is first shown in "Criticality maps per cell size". The calculation finishes as soon as the Moran\'s I of every cell size is known and the maps that are never looked at are never drawn. A drawn map is stored in the project folder and opens immediately afterwards.'
 CELL_LOWER_BOUND_TOOLTIP = 'The minimum cell size of the rectangular grid that will be created for the definition of critical areas. The size of the grid cell is a parameter to be optimised.'
 CELL_UPPER_BOUND_TOOLTIP = 'The maximum cell size of the rectangular grid that will be created for the definition of critical areas. The size of the grid cell is a parameter to be optimised.'
 LIFESPAN_TOOLTIP = 'The lifespan of the contract in years'
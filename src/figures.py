@@ -0,0 +1,34 @@
+from contextlib import contextmanager
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+
+@contextmanager
+def agg_subplots(figsize, interactive=False, **kwargs):
+    '''
+    (fig, ax) of a new figure, released when the block exits, also after an error. The figure has its own Agg canvas
+    and is never registered with pyplot, so a sweep that saves many maps does not accumulate figures (or trigger the
+    too-many-figures warning) and the memory of each canvas is given back as soon as its PNG is written.
+    With interactive the figure comes from pyplot, for plt.show(), and is closed the same way.
+    '''
+    if interactive:
+        fig, ax = plt.subplots(figsize=figsize, **kwargs)
+    else:
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        ax = fig.subplots(**kwargs)
+
+    try:
+        yield fig, ax
+    finally:
+        release_figure(fig)
+
+
+def release_figure(fig) -> None:
+    # Close the figure in pyplot (a no-op for the Agg figures), drop its artists and the cached renderer of its canvas
+    plt.close(fig)
+    fig.clear()
+    canvas = fig.canvas
+    if hasattr(canvas, "renderer"):
+        del canvas.renderer
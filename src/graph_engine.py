@@ -0,0 +1,701 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Dict, List, Tuple
+import math
+import random
+import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional, without it the kernels below run as plain python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+class CSRGraph:
+    '''
+    Integer-indexed copy of an undirected (multi)graph stored as CSR arrays.
+    Parallel edges are collapsed into one entry and counted in `multiplicity`, self-loops are dropped
+    since they never lie on a shortest path and can never be bridges.
+    '''
+
+    def __init__(self, nodes: List, indptr: np.ndarray, indices: np.ndarray, multiplicity: np.ndarray, weights: np.ndarray = None):
+        self.nodes = nodes  # The original node keys, in the order of the networkx graph
+        self.indptr = indptr
+        self.indices = indices
+        self.multiplicity = multiplicity
+        self.weights = weights  # Edge lengths (the shortest of any parallel edges), None for hop distances
+
+
+    @property
+    def n(self) -> int:
+        return len(self.nodes)
+
+
+def from_edges(nodes: List, u: np.ndarray, v: np.ndarray, w: np.ndarray = None) -> CSRGraph:
+    # Build the CSR arrays from integer edge endpoints (and optional edge lengths) over len(nodes) nodes
+    n = len(nodes)
+    u = np.asarray(u, dtype=np.int64)
+    v = np.asarray(v, dtype=np.int64)
+    mask = u != v
+    u, v = u[mask], v[mask]
+
+    # Store each edge in both directions, duplicate entries are summed into the edge multiplicity
+    rows = np.concatenate([u, v])
+    cols = np.concatenate([v, u])
+    adjacency = sp.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)), shape=(n, n))
+    adjacency.sum_duplicates()
+    adjacency.sort_indices()
+    indptr, indices = adjacency.indptr.astype(np.int64), adjacency.indices.astype(np.int64)
+
+    weights = None
+    if w is not None:
+        # Shortest paths only ever use the shortest of parallel edges. Sorting the directed entries by
+        # (row, col, length) puts that one first in every group, in the same order as the CSR entries
+        w = np.concatenate([w[mask], w[mask]]).astype(np.float64)
+        order = np.lexsort((w, cols, rows))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (rows[order][1:] != rows[order][:-1]) | (cols[order][1:] != cols[order][:-1])
+        weights = w[order][first]
+
+    return CSRGraph(nodes, indptr, indices, adjacency.data.astype(np.int64), weights)
+
+
+def from_networkx(G, weight: str = None) -> CSRGraph:
+    nodes = list(G.nodes)
+    index = {node: i for i, node in enumerate(nodes)}
+
+    edges = np.array([(index[u], index[v]) for u, v in G.edges()], dtype=np.int64).reshape(-1, 2)
+    w = None
+    if weight is not None:
+        w = np.array([data.get(weight, 1) for _, _, data in G.edges(data=True)], dtype=np.float64)
+
+    return from_edges(nodes, edges[:, 0], edges[:, 1], w)
+
+
+@njit(cache=True)
+def _closeness_kernel(indptr, indices, sources):
+    # Breadth first search from every source, returns the number of reachable nodes and the sum of the hop distances
+    n = len(indptr) - 1
+    reach = np.zeros(len(sources), dtype=np.int64)
+    totsp = np.zeros(len(sources), dtype=np.int64)
+    dist = np.full(n, -1, dtype=np.int64)
+    queue = np.empty(n, dtype=np.int64)
+
+    for k in range(len(sources)):
+        s = sources[k]
+        dist[s] = 0
+        queue[0] = s
+        head, tail, total = 0, 1, 0
+
+        while head < tail:
+            v = queue[head]
+            head += 1
+            for p in range(indptr[v], indptr[v + 1]):
+                w = indices[p]
+                if dist[w] < 0:
+                    dist[w] = dist[v] + 1
+                    total += dist[w]
+                    queue[tail] = w
+                    tail += 1
+
+        reach[k] = tail
+        totsp[k] = total
+        for i in range(tail):
+            dist[queue[i]] = -1
+
+    return reach, totsp
+
+
+@njit(cache=True)
+def _betweenness_kernel(indptr, indices, sources):
+    # Brandes' algorithm for unweighted graphs, returns the raw (unscaled) dependencies summed over the sources
+    # together with the sum of their squares, which gives the variance of the estimate when the sources are sampled
+    n = len(indptr) - 1
+    betweenness = np.zeros(n)
+    betweenness_sq = np.zeros(n)
+    dist = np.full(n, -1, dtype=np.int64)
+    sigma = np.zeros(n)
+    delta = np.zeros(n)
+    order = np.empty(n, dtype=np.int64)
+
+    for k in range(len(sources)):
+        s = sources[k]
+        dist[s] = 0
+        sigma[s] = 1.0
+        order[0] = s
+        head, tail = 0, 1
+
+        while head < tail:
+            v = order[head]
+            head += 1
+            for p in range(indptr[v], indptr[v + 1]):
+                w = indices[p]
+                if dist[w] < 0:
+                    dist[w] = dist[v] + 1
+                    order[tail] = w
+                    tail += 1
+                if dist[w] == dist[v] + 1:
+                    sigma[w] += sigma[v]
+
+        # Accumulate the dependencies in order of non-increasing distance from the source
+        for i in range(tail - 1, -1, -1):
+            w = order[i]
+            coeff = (1.0 + delta[w]) / sigma[w]
+            for p in range(indptr[w], indptr[w + 1]):
+                v = indices[p]
+                if dist[v] == dist[w] - 1:
+                    delta[v] += sigma[v] * coeff
+            if w != s:
+                betweenness[w] += delta[w]
+                betweenness_sq[w] += delta[w] * delta[w]
+
+        for i in range(tail):
+            w = order[i]
+            dist[w] = -1
+            sigma[w] = 0.0
+            delta[w] = 0.0
+
+    return betweenness, betweenness_sq
+
+
+@njit(cache=True)
+def _bridges_kernel(indptr, indices, multiplicity):
+    # Iterative Tarjan lowlink search, an edge is a bridge if no back edge jumps over it and it is not doubled
+    n = len(indptr) - 1
+    disc = np.full(n, -1, dtype=np.int64)
+    low = np.zeros(n, dtype=np.int64)
+    parent = np.full(n, -1, dtype=np.int64)
+    parent_edge = np.full(n, -1, dtype=np.int64)
+    next_edge = np.zeros(n, dtype=np.int64)
+    stack = np.empty(n, dtype=np.int64)
+    bridges = np.empty((len(indices) // 2 + 1, 2), dtype=np.int64)
+    count = 0
+    timer = 0
+
+    for root in range(n):
+        if disc[root] >= 0:
+            continue
+        disc[root] = timer
+        low[root] = timer
+        timer += 1
+        next_edge[root] = indptr[root]
+        stack[0] = root
+        top = 0
+
+        while top >= 0:
+            v = stack[top]
+            if next_edge[v] < indptr[v + 1]:
+                p = next_edge[v]
+                next_edge[v] += 1
+                w = indices[p]
+                if disc[w] < 0:
+                    parent[w] = v
+                    parent_edge[w] = p
+                    disc[w] = timer
+                    low[w] = timer
+                    timer += 1
+                    next_edge[w] = indptr[w]
+                    top += 1
+                    stack[top] = w
+                elif w != parent[v]:
+                    low[v] = min(low[v], disc[w])
+            else:
+                top -= 1
+                if top >= 0:
+                    u = stack[top]
+                    low[u] = min(low[u], low[v])
+                    if low[v] > disc[u] and multiplicity[parent_edge[v]] == 1:
+                        bridges[count, 0] = u
+                        bridges[count, 1] = v
+                        count += 1
+
+    return bridges[:count]
+
+
+@njit(cache=True)
+def _heap_push(heap_dist, heap_node, size, d, v):
+    # Binary min-heap on two parallel arrays, entries are never decreased in place (lazy deletion)
+    i = size
+    heap_dist[i] = d
+    heap_node[i] = v
+    while i > 0:
+        parent = (i - 1) // 2
+        if heap_dist[parent] <= heap_dist[i]:
+            break
+        heap_dist[parent], heap_dist[i] = heap_dist[i], heap_dist[parent]
+        heap_node[parent], heap_node[i] = heap_node[i], heap_node[parent]
+        i = parent
+    return size + 1
+
+
+@njit(cache=True)
+def _heap_pop(heap_dist, heap_node, size):
+    d = heap_dist[0]
+    v = heap_node[0]
+    size -= 1
+    heap_dist[0] = heap_dist[size]
+    heap_node[0] = heap_node[size]
+    i = 0
+    while True:
+        left = 2 * i + 1
+        if left >= size:
+            break
+        child = left
+        if left + 1 < size and heap_dist[left + 1] < heap_dist[left]:
+            child = left + 1
+        if heap_dist[i] <= heap_dist[child]:
+            break
+        heap_dist[child], heap_dist[i] = heap_dist[i], heap_dist[child]
+        heap_node[child], heap_node[i] = heap_node[i], heap_node[child]
+        i = child
+    return d, v, size
+
+
+@njit(cache=True)
+def _weighted_closeness_kernel(indptr, indices, weights, sources):
+    # Dijkstra from every source, returns the number of reachable nodes and the sum of the distances
+    n = len(indptr) - 1
+    reach = np.zeros(len(sources), dtype=np.int64)
+    totsp = np.zeros(len(sources))
+    dist = np.full(n, np.inf)
+    done = np.zeros(n, dtype=np.bool_)
+    visited = np.empty(n, dtype=np.int64)
+    heap_dist = np.empty(len(indices) + 1)
+    heap_node = np.empty(len(indices) + 1, dtype=np.int64)
+
+    for k in range(len(sources)):
+        s = sources[k]
+        dist[s] = 0.0
+        size = _heap_push(heap_dist, heap_node, 0, 0.0, s)
+        count, total = 0, 0.0
+
+        while size > 0:
+            d, v, size = _heap_pop(heap_dist, heap_node, size)
+            if done[v]:
+                continue
+            done[v] = True
+            visited[count] = v
+            count += 1
+            total += d
+            for p in range(indptr[v], indptr[v + 1]):
+                w = indices[p]
+                nd = d + weights[p]
+                if nd < dist[w]:
+                    dist[w] = nd
+                    size = _heap_push(heap_dist, heap_node, size, nd, w)
+
+        reach[k] = count
+        totsp[k] = total
+        for i in range(count):
+            dist[visited[i]] = np.inf
+            done[visited[i]] = False
+
+    return reach, totsp
+
+
+@njit(cache=True)
+def _weighted_betweenness_kernel(indptr, indices, weights, sources):
+    # Brandes' algorithm with Dijkstra, same return values as _betweenness_kernel
+    n = len(indptr) - 1
+    betweenness = np.zeros(n)
+    betweenness_sq = np.zeros(n)
+    dist = np.full(n, np.inf)
+    done = np.zeros(n, dtype=np.bool_)
+    sigma = np.zeros(n)
+    delta = np.zeros(n)
+    order = np.empty(n, dtype=np.int64)
+    heap_dist = np.empty(len(indices) + 1)
+    heap_node = np.empty(len(indices) + 1, dtype=np.int64)
+
+    for k in range(len(sources)):
+        s = sources[k]
+        dist[s] = 0.0
+        sigma[s] = 1.0
+        size = _heap_push(heap_dist, heap_node, 0, 0.0, s)
+        count = 0
+
+        # Settle the nodes in order of distance, the shortest path counts of a node are final once it is settled
+        while size > 0:
+            d, v, size = _heap_pop(heap_dist, heap_node, size)
+            if done[v]:
+                continue
+            done[v] = True
+            order[count] = v
+            count += 1
+            for p in range(indptr[v], indptr[v + 1]):
+                w = indices[p]
+                nd = d + weights[p]
+                if nd < dist[w]:
+                    dist[w] = nd
+                    sigma[w] = sigma[v]
+                    size = _heap_push(heap_dist, heap_node, size, nd, w)
+                elif nd == dist[w] and not done[w]:
+                    sigma[w] += sigma[v]
+
+        for i in range(count - 1, -1, -1):
+            w = order[i]
+            coeff = (1.0 + delta[w]) / sigma[w]
+            for p in range(indptr[w], indptr[w + 1]):
+                v = indices[p]
+                if done[v] and dist[v] + weights[p] == dist[w]:
+                    delta[v] += sigma[v] * coeff
+            if w != s:
+                betweenness[w] += delta[w]
+                betweenness_sq[w] += delta[w] * delta[w]
+
+        for i in range(count):
+            w = order[i]
+            dist[w] = np.inf
+            done[w] = False
+            sigma[w] = 0.0
+            delta[w] = 0.0
+
+    return betweenness, betweenness_sq
+
+
+def _closeness_chunk(indptr, indices, weights, sources):
+    if weights is None:
+        return _closeness_kernel(indptr, indices, sources)
+    return _weighted_closeness_kernel(indptr, indices, weights, sources)
+
+
+def _betweenness_chunk(indptr, indices, weights, sources):
+    if weights is None:
+        return _betweenness_kernel(indptr, indices, sources)
+    return _weighted_betweenness_kernel(indptr, indices, weights, sources)
+
+
+def _component_tasks(graph: CSRGraph, sources: np.ndarray, tasks: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+    '''
+    Split the shortest path searches into about `tasks` pieces of similar work along the connected components.
+    No shortest path leaves its component, so every piece only needs the nodes of its own components: large components
+    are split into chunks of their sources, small ones (islands, separate zones) are packed together.
+    Returns (nodes, positions) per piece, the node indices of its subgraph and the positions of its sources in `sources`.
+    '''
+    adjacency = sp.csr_matrix((np.ones(len(graph.indices)), graph.indices, graph.indptr), shape=(graph.n, graph.n))
+    n_components, labels = connected_components(adjacency, directed=False)
+
+    sizes = np.bincount(labels, minlength=n_components)
+    source_labels = labels[sources]
+    source_counts = np.bincount(source_labels, minlength=n_components)
+    work = sizes.astype(np.float64) * source_counts  # A search costs about the size of its component
+    target = work.sum() / tasks
+
+    node_order = np.argsort(labels, kind='stable')
+    node_bounds = np.concatenate([[0], np.cumsum(sizes)])
+    source_order = np.argsort(source_labels, kind='stable')
+    source_bounds = np.concatenate([[0], np.cumsum(source_counts)])
+
+    pieces = []
+    packed_nodes, packed_positions, packed_work = [], [], 0.0
+
+    for c in np.argsort(-work, kind='stable'):
+        if source_counts[c] == 0:
+            continue
+        nodes = np.sort(node_order[node_bounds[c]:node_bounds[c + 1]])
+        positions = source_order[source_bounds[c]:source_bounds[c + 1]]
+
+        if work[c] >= target:
+            for chunk in np.array_split(positions, int(math.ceil(work[c] / target))):
+                pieces.append((nodes, chunk))
+            continue
+
+        packed_nodes.append(nodes)
+        packed_positions.append(positions)
+        packed_work += work[c]
+        if packed_work >= target:
+            pieces.append((np.sort(np.concatenate(packed_nodes)), np.concatenate(packed_positions)))
+            packed_nodes, packed_positions, packed_work = [], [], 0.0
+
+    if packed_nodes:
+        pieces.append((np.sort(np.concatenate(packed_nodes)), np.concatenate(packed_positions)))
+
+    return pieces
+
+
+def _subgraph_arrays(graph: CSRGraph, nodes: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # CSR arrays of the subgraph induced by the (sorted) nodes, renumbered 0..len(nodes)-1. The matrix entries hold
+    # the position of every edge (plus one, scipy may drop zeros) so that the weights can be carried over
+    entries = np.arange(1, len(graph.indices) + 1, dtype=np.float64)
+    adjacency = sp.csr_matrix((entries, graph.indices, graph.indptr), shape=(graph.n, graph.n))
+    sub = adjacency[nodes][:, nodes]
+    sub.sort_indices()
+    weights = graph.weights[sub.data.astype(np.int64) - 1] if graph.weights is not None else None
+    return sub.indptr.astype(np.int64), sub.indices.astype(np.int64), weights
+
+
+def _map_sources(chunk_func, graph: CSRGraph, workers: int, sources: np.ndarray = None) -> List:
+    '''
+    Run chunk_func over the source nodes (all nodes by default). With more than one worker the searches are split
+    along the connected components (see _component_tasks) and processed by a pool of processes, each one on the
+    subgraph of its components. Returns (nodes, positions, result) per piece: nodes maps the subgraph back to the
+    graph (None for the whole graph) and positions are the indices of the piece's sources in `sources`.
+    '''
+    if sources is None:
+        sources = np.arange(graph.n, dtype=np.int64)
+
+    if workers <= 1 or len(sources) < 2 * workers:
+        return [(None, np.arange(len(sources)), chunk_func(graph.indptr, graph.indices, graph.weights, sources))]
+
+    # A few pieces per worker keep the processes busy when some pieces turn out cheaper than others
+    pieces = _component_tasks(graph, sources, workers * 4)
+
+    subgraphs = {}
+    arguments = []
+    for nodes, positions in pieces:
+        # The chunks of one large component share the same subgraph arrays
+        key = id(nodes)
+        if key not in subgraphs:
+            local = np.full(graph.n, -1, dtype=np.int64)
+            local[nodes] = np.arange(len(nodes))
+            subgraphs[key] = _subgraph_arrays(graph, nodes) + (local,)
+        indptr, indices, weights, local = subgraphs[key]
+        arguments.append((indptr, indices, weights, local[sources[positions]]))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(chunk_func, *zip(*arguments)))
+
+    return [(nodes, positions, result) for (nodes, positions), result in zip(pieces, results)]
+
+
+def _sum_nodes(partial: List, index: int, n: int) -> np.ndarray:
+    # Add the per node vectors of the pieces of _map_sources into one vector over all nodes
+    total = np.zeros(n)
+    for nodes, _, result in partial:
+        if nodes is None:
+            total += result[index]
+        else:
+            total[nodes] += result[index]
+    return total
+
+
+def closeness_centrality(graph: CSRGraph, workers: int = 1) -> np.ndarray:
+    # Same definition as nx.closeness_centrality (with wf_improved=True), on hop distances or on the edge weights.
+    # The scaling uses the number of nodes of the whole graph, also when the searches ran per component
+    n = graph.n
+    reach = np.zeros(n)
+    totsp = np.zeros(n)
+    for _, positions, result in _map_sources(_closeness_chunk, graph, workers):
+        reach[positions] = result[0]
+        totsp[positions] = result[1]
+
+    closeness = np.zeros(n)
+    if n > 1:
+        mask = totsp > 0
+        closeness[mask] = (reach[mask] - 1.0) / totsp[mask]
+        closeness[mask] *= (reach[mask] - 1.0) / (n - 1)
+    return closeness
+
+
+def pivots_for_accuracy(n: int, epsilon: float, delta: float = 0.05) -> int:
+    '''
+    Number of pivot sources that keeps the error of every normalised betweenness value below epsilon with
+    probability 1 - delta (Hoeffding bound with a union bound over the n nodes, as in Brandes & Pich).
+    Every pivot contributes a dependency between 0 and n - 2, i.e. a value in [0, 1] after normalisation.
+    '''
+    if not 0 < epsilon < 1 or not 0 < delta < 1:
+        raise ValueError("The target accuracy and the confidence level must be between 0 and 1")
+    if n < 3:
+        return n
+    return min(math.ceil(math.log(2 * n / delta) / (2 * epsilon ** 2)), n)
+
+
+def pivot_error_bound(n: int, k: int, delta: float = 0.05) -> float:
+    # Inverse of pivots_for_accuracy, the error bound on the normalised betweenness for k pivots
+    if k >= n or n < 3:
+        return 0.0
+    return math.sqrt(math.log(2 * n / delta) / (2 * k))
+
+
+def betweenness_centrality(graph: CSRGraph, workers: int = 1, k: int = None, seed: int = None) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Same definition and normalization as nx.betweenness_centrality on an undirected graph.
+    With k, the dependencies are summed over k pivot sources drawn like networkx does for the same seed. Every node
+    is then estimated from the pivots other than itself (the unbiased rescaling of networkx >= 3.5), so the
+    values can differ slightly from the older networkx releases that scale all nodes by n / k.
+    The dependencies of disjoint sets of sources are independent, so the partial vectors are simply summed and
+    normalised once with the number of nodes of the whole graph.
+    Returns the betweenness and its standard error, which is zero unless the sources are sampled.
+    '''
+    n = graph.n
+    sources = None
+    if k is not None and k < n:
+        sources = np.array(random.Random(seed).sample(range(n), k), dtype=np.int64)
+
+    partial = _map_sources(_betweenness_chunk, graph, workers, sources)
+    betweenness = _sum_nodes(partial, 0, n)
+    stderr = np.zeros(n)
+
+    if n <= 2:
+        return betweenness, stderr
+
+    if sources is None:
+        return betweenness / ((n - 1) * (n - 2)), stderr
+
+    # A pivot has no dependency on itself, so it is estimated from the other k - 1 pivots. The pivots other than
+    # v are a sample without replacement out of the n - 1 other nodes, hence the finite population correction
+    pivots = np.full(n, float(k))
+    pivots[sources] -= 1
+    betweenness_sq = _sum_nodes(partial, 1, n)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(pivots > 0, betweenness / pivots, 0.0)
+        variance = np.where(pivots > 1, np.maximum(betweenness_sq / pivots - mean ** 2, 0) * pivots / (pivots - 1), 0.0)
+        stderr = np.sqrt(np.where(pivots > 0, variance / pivots * (n - 1 - pivots) / (n - 2), 0.0))
+
+    return mean / (n - 2), stderr / (n - 2)
+
+
+def bridges(graph: CSRGraph) -> List[Tuple]:
+    pairs = _bridges_kernel(graph.indptr, graph.indices, graph.multiplicity)
+    return [(graph.nodes[u], graph.nodes[v]) for u, v in pairs]
+
+
+def csr_centralities(G, workers: int = 1, k: int = None, seed: int = None, weight: str = None) -> Tuple[Dict, Dict, List[Tuple], Dict]:
+    '''
+    Drop-in replacement of nx.closeness_centrality, nx.betweenness_centrality and nx.bridges for the
+    momepy graph. The graph is converted once into CSR arrays and the results are keyed by the original nodes.
+    With workers > 1 the shortest path searches are spread over a pool of processes. With k set, betweenness
+    is estimated from k pivot sources and the standard error of every node value is returned as well.
+    With weight set, the shortest paths use that edge attribute as length (Dijkstra instead of breadth first search).
+    '''
+    graph = from_networkx(G, weight)
+
+    closeness = dict(zip(graph.nodes, closeness_centrality(graph, workers)))
+    betweenness, stderr = betweenness_centrality(graph, workers, k, seed)
+
+    return closeness, dict(zip(graph.nodes, betweenness)), bridges(graph), dict(zip(graph.nodes, stderr))
+
+
+def _networkx_component(G, weight: str = None) -> Tuple[Dict, Dict, List[Tuple]]:
+    return nx.closeness_centrality(G, distance=weight), nx.betweenness_centrality(G, weight=weight), list(nx.bridges(G))
+
+
+def networkx_centralities(G, workers: int = 1, k: int = None, seed: int = None, weight: str = None) -> Tuple[Dict, Dict, List[Tuple]]:
+    '''
+    Closeness, betweenness and bridges with the networkx algorithms. With workers > 1 (and the exact betweenness)
+    every connected component is handed to a pool of processes. networkx normalises by the size of the graph it is
+    given, so the values of every component are rescaled to the number of nodes of the whole graph.
+    '''
+    if workers <= 1 or k is not None:
+        return nx.closeness_centrality(G, distance=weight), nx.betweenness_centrality(G, k=k, seed=seed, weight=weight), list(nx.bridges(G))
+
+    n = G.number_of_nodes()
+    components = sorted(nx.connected_components(G), key=len, reverse=True)
+    closeness, betweenness, bridges = {}, {}, []
+
+    # The many small islands are sent in batches, the large components one by one
+    chunksize = max(1, len(components) // (workers * 4))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        subgraphs = (G.subgraph(component).copy() for component in components)
+        for component, (closeness_c, betweenness_c, bridges_c) in zip(components, executor.map(_networkx_component, subgraphs, repeat(weight), chunksize=chunksize)):
+            size = len(component)
+            closeness_scale = (size - 1) / (n - 1) if n > 1 else 0.0
+            betweenness_scale = (size - 1) * (size - 2) / ((n - 1) * (n - 2)) if size > 2 else 1.0
+            closeness.update((node, value * closeness_scale) for node, value in closeness_c.items())
+            betweenness.update((node, value * betweenness_scale) for node, value in betweenness_c.items())
+            bridges.extend(bridges_c)
+
+    # Keep the node order of the graph, like the single process results
+    return {node: closeness[node] for node in G.nodes}, {node: betweenness[node] for node in G.nodes}, bridges
+
+
+class ChainContraction:
+    '''
+    Result of contract_degree2_chains. Every original edge belongs to exactly one super-edge (edge_super), a
+    super-edge runs between two kept nodes and replaces a chain of `hops` original edges whose lengths add up to `length`.
+    '''
+
+    def __init__(self, kept: np.ndarray, super_start: np.ndarray, super_end: np.ndarray, hops: np.ndarray, length: np.ndarray, edge_super: np.ndarray):
+        self.kept = kept
+        self.super_start = super_start
+        self.super_end = super_end
+        self.hops = hops
+        self.length = length
+        self.edge_super = edge_super
+
+
+    def to_networkx(self):
+        # MultiGraph over the kept node IDs with the 'hops' and 'length' of every super-edge
+        H = nx.MultiGraph()
+        H.add_nodes_from(self.kept.tolist())
+        H.add_edges_from((u, v, {'hops': h, 'length': l}) for u, v, h, l in
+                         zip(self.super_start.tolist(), self.super_end.tolist(), self.hops.tolist(), self.length.tolist()))
+        return H
+
+
+@njit(cache=True)
+def _contract_kernel(indptr, incident_edge, incident_node, keep, n_edges):
+    # Walk from every kept node along each unvisited incident edge through the degree 2 nodes until the next kept
+    # node. Rings made only of degree 2 nodes have no kept node, one of their nodes is kept in the second pass
+    n = len(indptr) - 1
+    edge_super = np.full(n_edges, -1, dtype=np.int64)
+    super_start = np.empty(n_edges, dtype=np.int64)
+    super_end = np.empty(n_edges, dtype=np.int64)
+    hops = np.empty(n_edges, dtype=np.int64)
+    count = 0
+
+    for rings in range(2):
+        for a in range(n):
+            if keep[a] == rings:
+                continue
+            for p in range(indptr[a], indptr[a + 1]):
+                e = incident_edge[p]
+                if edge_super[e] >= 0:
+                    continue
+                keep[a] = True
+                edge_super[e] = count
+                current = incident_node[p]
+                previous = e
+                length = 1
+                while not keep[current]:
+                    q = indptr[current]
+                    if incident_edge[q] == previous:
+                        q += 1
+                    previous = incident_edge[q]
+                    edge_super[previous] = count
+                    current = incident_node[q]
+                    length += 1
+                super_start[count] = a
+                super_end[count] = current
+                hops[count] = length
+                count += 1
+
+    return edge_super, super_start[:count], super_end[:count], hops[:count], keep
+
+
+def contract_degree2_chains(start: np.ndarray, end: np.ndarray, n: int, lengths: np.ndarray = None) -> ChainContraction:
+    '''
+    Contract the chains of degree 2 nodes of an undirected multigraph with nodes 0..n-1 and edges (start[i], end[i])
+    into super-edges between the remaining nodes (degree other than 2, as counted by networkx). Distances in hops between
+    kept nodes are preserved by the 'hops' of the super-edges, the optional edge lengths are summed along every chain.
+    '''
+    start = np.asarray(start, dtype=np.int64)
+    end = np.asarray(end, dtype=np.int64)
+    m = len(start)
+
+    degree = np.bincount(start, minlength=n) + np.bincount(end, minlength=n)
+    keep = degree != 2
+
+    # Incidence lists: every edge is listed at both of its ends (twice at the node of a self-loop)
+    ends = np.concatenate([start, end])
+    others = np.concatenate([end, start])
+    edge_ids = np.concatenate([np.arange(m), np.arange(m)])
+    order = np.argsort(ends, kind='stable')
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(ends, minlength=n))
+
+    edge_super, super_start, super_end, hops, keep = _contract_kernel(indptr, edge_ids[order], others[order], keep, m)
+
+    if lengths is None:
+        lengths = np.ones(m)
+    length = np.bincount(edge_super, weights=np.asarray(lengths, dtype=np.float64), minlength=len(hops))
+
+    return ChainContraction(np.flatnonzero(keep), super_start, super_end, hops, length, edge_super)
@@ -1,7 +1,11 @@
 from shapely.geometry import box
-from src.const import TARGET_CRS
+from src.const import TARGET_CRS, NETWORK_COLUMNS, DAMAGES_COLUMNS
+from src.shapefile_io import read_shapefile
 from typing import List, Tuple
+import matplotlib.pyplot as plt
+import matplotlib.colors as mcolors
 import geopandas as gpd
+import numpy as np
 import os
 
 
@@ -10,7 +14,7 @@ def reproject_shp(gdf: gpd.GeoDataFrame, target_crs: str = TARGET_CRS) -> gpd.Ge
 
 
 def extract_network_shapefile_data(network_shp_path: str):
-    gdf = reproject_shp(gpd.read_file(network_shp_path))
+    gdf = reproject_shp(read_shapefile(network_shp_path, NETWORK_COLUMNS))
     # Calculate the bounding box
     bounding_box = gdf.total_bounds
     minx, miny, maxx, maxy = bounding_box
@@ -35,7 +39,7 @@ def extract_network_shapefile_data(network_shp_path: str):
 
 
 def extract_damages_shapefile_data(dmg_shp_path: str):
-    gdf = gpd.read_file(dmg_shp_path)
+    gdf = read_shapefile(dmg_shp_path, DAMAGES_COLUMNS)
     gdf.set_crs(epsg=2100, inplace=True)
     gdf = reproject_shp(gdf)
     
@@ -74,7 +78,7 @@ def extract_optimized_cells_data(base_folder: str):
 				shp_path = os.path.join(folder_path, file)
 				break
 		
-		gdf = gpd.read_file(shp_path)
+		gdf = read_shapefile(shp_path, ['ID', 't_opt'])
 		gdf.set_crs(epsg=2100, inplace=True)
 		gdf = reproject_shp(gdf)
 
@@ -94,7 +98,7 @@ def extract_optimized_cells_data(base_folder: str):
 
 
 def extract_pipe_grouping_data(shp_path: str):
-	gdf = gpd.read_file(shp_path)
+	gdf = read_shapefile(shp_path, ['ID', 'cluster'])
 	gdf.set_crs(epsg=2100, inplace=True)
 	gdf = reproject_shp(gdf)
 
@@ -108,3 +112,16 @@ def extract_pipe_grouping_data(shp_path: str):
 	
 	attributes = gdf.drop(columns='geometry')
 	return pipes_lines_paths, attributes
+
+
+def metric_color_lut(cmap_name: str = "RdYlGn_r", levels: int = 256) -> List[str]:
+    # Hex colors of a matplotlib colormap sampled at `levels` steps, so that recoloring a path is a list lookup
+    cmap = plt.get_cmap(cmap_name)
+    return [mcolors.to_hex(cmap(i / (levels - 1))) for i in range(levels)]
+
+
+def metric_color_indices(values: np.ndarray, levels: int = 256) -> np.ndarray:
+    # Indices of metric_color_lut for values in [0, 1], the color plot_metric_map gives them: the metric maps index
+    # the colormap with the raw metric, so values outside [0, 1] take the color of the nearest end
+    values = np.clip(np.asarray(values, dtype=float), 0, 1)
+    return np.minimum(np.nan_to_num(np.floor(values * levels), nan=0), levels - 1).astype(np.int64)
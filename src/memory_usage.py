@@ -0,0 +1,67 @@
+from typing import Optional
+import threading
+import sys
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows
+
+
+class PeakMemory:
+    '''
+    Peak resident memory in bytes while the with block runs. With psutil the memory of this process and of its children
+    (the square size and render workers) is sampled by a thread every `interval` seconds. Without psutil only the peak
+    of this process since it started is available, and only on POSIX systems; peak is None otherwise.
+    '''
+
+    def __init__(self, interval: float = 0.2):
+        self.interval = interval
+        self.peak: Optional[int] = None
+        self.per_process = psutil is not None  # False when peak is the lifetime peak of this process
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self) -> int:
+        process = psutil.Process()
+        total = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except psutil.Error:
+                pass  # The worker exited between the listing and the reading
+        return total
+
+    def _watch(self) -> None:
+        while True:
+            self.peak = max(self.peak or 0, self._sample())
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        if psutil is not None:
+            self._thread = threading.Thread(target=self._watch, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak or 0, self._sample())
+        elif resource is not None:
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.peak = maxrss if sys.platform == "darwin" else maxrss * 1024
+        return False
+
+    def report(self) -> str:
+        if self.peak is None:
+            return "Peak memory: not available (install psutil)"
+        scope = "" if self.per_process else " (this process since it started)"
+        return f"Peak memory: {self.peak / 2 ** 20:.0f} MB{scope}"
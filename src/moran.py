@@ -0,0 +1,117 @@
+from typing import NamedTuple, Optional, Sequence
+import numpy as np
+from scipy.stats import norm
+from src.const import P_VALUE_THRESHOLDS
+
+
+class MoranPermutations(NamedTuple):
+    I: float
+    p_sim: float
+    z_sim: float
+    EI_sim: float
+    seI_sim: float
+    permutations: int  # Number of permutations actually drawn, fewer than requested after an early stop
+
+
+def _settled(above: int, drawn: int, thresholds: Sequence[float], z: float) -> bool:
+    # True when the Wilson confidence interval of the (folded) p-value contains none of the thresholds,
+    # i.e. further permutations would not change on which side of every threshold the p-value falls
+    q = above / drawn
+    centre = (q + z * z / (2 * drawn)) / (1 + z * z / drawn)
+    half = z * np.sqrt(q * (1 - q) / drawn + z * z / (4 * drawn * drawn)) / (1 + z * z / drawn)
+    q_lo, q_hi = max(centre - half, 0.0), min(centre + half, 1.0)
+
+    if q_hi <= 0.5:
+        p_lo, p_hi = q_lo, q_hi
+    elif q_lo >= 0.5:
+        p_lo, p_hi = 1 - q_hi, 1 - q_lo
+    else:
+        p_lo, p_hi = min(q_lo, 1 - q_hi), 0.5
+    return not any(p_lo <= threshold <= p_hi for threshold in thresholds)
+
+
+def moran_permutations(y, w, permutations: int = 999, seed=None, early_stop: bool = False,
+                       thresholds: Sequence[float] = P_VALUE_THRESHOLDS, confidence: float = 0.99,
+                       batch_size: Optional[int] = None) -> MoranPermutations:
+    '''
+    Global Moran's I of y with the permutation inference of esda.Moran (same I, p_sim and z_sim definitions), but the
+    permutations are drawn as one matrix per batch from a numpy Generator seeded with `seed` and evaluated with a
+    sparse matrix product. With early_stop the permutations stop as soon as the p-value is known to be below or
+    above every threshold of find_best_square_size with the given confidence, checked after every batch.
+    w must already have its transformation set.
+    '''
+    y = np.asarray(y, dtype=float).flatten()
+    n = len(y)
+    W = w.sparse.tocsr()
+    z = y - y.mean()
+    z2ss = z @ z
+    scale = n / W.sum()
+    I = scale * (z @ (W @ z)) / z2ss
+
+    if batch_size is None:
+        batch_size = 100 if early_stop else max(1, min(permutations, 1_000_000 // max(n, 1)))
+
+    rng = np.random.default_rng(seed)
+    critical = norm.ppf(0.5 + confidence / 2)
+    sims = []
+    drawn = above = 0
+
+    while drawn < permutations:
+        batch = min(batch_size, permutations - drawn)
+        Z = rng.permuted(np.tile(z, (batch, 1)), axis=1)
+        sim = scale * np.einsum('ij,ij->i', Z, (W @ Z.T).T) / z2ss
+        sims.append(sim)
+        drawn += batch
+        above += int((sim >= I).sum())
+
+        if early_stop and drawn < permutations and _settled(above, drawn, thresholds, critical):
+            break
+
+    sims = np.concatenate(sims)
+    larger = min(above, drawn - above)
+    p_sim = (larger + 1.0) / (drawn + 1.0)
+    EI_sim = sims.sum() / drawn
+    seI_sim = sims.std()
+    z_sim = (I - EI_sim) / seI_sim
+    return MoranPermutations(I, p_sim, z_sim, EI_sim, seI_sim, drawn)
+
+
+class MoranAnalytic(NamedTuple):
+    I: float
+    EI: float
+    VI: float
+    z: float
+    p: float
+
+
+def moran_analytic(y, w, assumption: str = "randomization") -> MoranAnalytic:
+    '''
+    Global Moran's I of y with the analytical inference of esda.Moran, under the normality ('normal') or the
+    randomization ('randomization') assumption, without any permutations. The p-value is one-tailed (the tail on the
+    side of I), which is what the folded p_sim of the permutations estimates, so both compare to the same thresholds.
+    w must already have its transformation set.
+    '''
+    if assumption not in ("normal", "randomization"):
+        raise ValueError(f"Invalid assumption: {assumption}")
+
+    y = np.asarray(y, dtype=float).flatten()
+    n = len(y)
+    z = y - y.mean()
+    z2ss = z @ z
+    I = n / w.s0 * (z @ (w.sparse.tocsr() @ z)) / z2ss
+
+    s0, s1, s2 = w.s0, w.s1, w.s2
+    s02 = s0 * s0
+    n2 = n * n
+    EI = -1.0 / (n - 1)
+    if assumption == "normal":
+        VI = (n2 * s1 - n * s2 + 3 * s02) / ((n - 1) * (n + 1) * s02) - EI * EI
+    else:
+        k = (np.sum(z ** 4) / n) / (z2ss / n) ** 2
+        A = n * ((n2 - 3 * n + 3) * s1 - n * s2 + 3 * s02)
+        B = k * ((n2 - n) * s1 - 2 * n * s2 + 6 * s02)
+        VI = (A - B) / ((n - 1) * (n - 2) * (n - 3) * s02) - EI * EI
+
+    z_score = (I - EI) / np.sqrt(VI)
+    p = norm.sf(z_score) if z_score > 0 else norm.cdf(z_score)
+    return MoranAnalytic(I, EI, VI, z_score, p)
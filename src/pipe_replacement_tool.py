@@ -14,11 +14,12 @@ import os
 import platform
 from src.tools import *
 from src.custom_tooltip import make_tt
+from src.render_pool import failed_renders, is_rendering, pending_renders, shutdown_render_pool, wait_for_renders
+from src.tile_cache import seed_tiles
 import datetime
 import sys
 import json
 from typing import List
-import geopandas as gpd
 import numpy as np
 import pandas as pd
 
@@ -77,7 +78,9 @@ class PipeReplacementTool:
         self.closeness_metric = None
         self.betweeness_metric = None
         self.bridges_metric = None
+        self.betweenness_sampling = None
         self.edges = None
+        self.resubmitted_maps = set()
         self.df_metrics = None
         self.unique_pipe_materials_names = None
         self.topological_analysis_result_shapefile = None
@@ -89,6 +92,8 @@ class PipeReplacementTool:
         self.cell_upper_bound = None
         self.combined_metric_weight = None
         self.failures_weight = None
+        self.moran_options = None
+        self.middle_frame_request = None
         self.step2_finished = False
         
         self.select_square_size = None
@@ -105,6 +110,7 @@ class PipeReplacementTool:
         self.const_pipe_materials = {"Asbestos Cement": 50, "Steel": 40, "PVC": 30, "HDPE": 12, "Cast iron": 40}
         self.recent_scenarios = None
         self.network_shapefile_attributes = None
+        self.network_map_paths = []
 
 
     def root_window_stuff(self):
@@ -124,6 +130,8 @@ class PipeReplacementTool:
         
         self.root.geometry(f"{self.width}x{self.height}")
         self.root.iconphoto(True, tk.PhotoImage(file="logo.png", height=170))
+        
+        self.root.after(RENDER_POLL_INTERVAL, self.check_failed_renders)
 
         self.logo_image = tk.PhotoImage(file='logo.png')
         self.info_image = tk.PhotoImage(file='info.png').subsample(9, 9)
@@ -148,6 +156,16 @@ class PipeReplacementTool:
         if self.project_opened: 
             self.save_scenario(show_message=False)
         
+        # The maps still being rendered belong to the saved project, the app closes once they are written
+        if pending_renders():
+            self.root.config(cursor="watch")
+            self.root.update()
+            try:
+                wait_for_renders()
+            except Exception:
+                pass  # A map that failed is drawn again or shown as not available when the project is opened
+        
+        shutdown_render_pool()
         self.root.destroy()
         self.root.quit()
         
@@ -348,11 +366,12 @@ class PipeReplacementTool:
         self.betweeness_metric = metadata.get("betweeness_metric")
         self.closeness_metric = metadata.get("closeness_metric")
         self.bridges_metric = metadata.get("bridges_metric")
+        self.betweenness_sampling = metadata.get("betweenness_sampling")
         self.unique_pipe_materials_names = np.array(metadata.get("unique_pipe_materials_names")) if self.topological_analysis_finished else None
         self.topological_analysis_result_shapefile = metadata.get("topological_analysis_result_shapefile")
         self.pipe_materials = metadata.get("pipe_materials")
         
-        self.edges = gpd.read_file(os.path.join(self.project_folder, metadata["edges"])) if metadata.get("edges") else None
+        self.edges = read_shapefile(os.path.join(self.project_folder, metadata["edges"])) if metadata.get("edges") else None
         self.df_metrics = pd.read_csv(os.path.join(self.project_folder, metadata["df_metrics"]), index_col=0) if metadata.get("df_metrics") else None
         
         self.step2_output_path = metadata.get("step2_output_path")
@@ -361,6 +380,7 @@ class PipeReplacementTool:
         self.cell_upper_bound = metadata.get("cell_upper_bound")
         self.combined_metric_weight = metadata.get("combined_metric_weight")
         self.failures_weight = metadata.get("failures_weight")
+        self.moran_options = metadata.get("moran_options")
         self.step2_finished = metadata.get("step2_finished")
         
         self.select_square_size = metadata.get("select_square_size")
@@ -400,6 +420,7 @@ class PipeReplacementTool:
             "closeness_metric": self.closeness_metric,
             "betweeness_metric": self.betweeness_metric,
             "bridges_metric": self.bridges_metric,
+            "betweenness_sampling": self.betweenness_sampling,
             "edges": "edges.gpkg" if self.topological_analysis_finished else None,
             "df_metrics": "df_metrics.csv" if self.topological_analysis_finished else None,
             "unique_pipe_materials_names": list(self.unique_pipe_materials_names) if self.topological_analysis_finished else None,
@@ -411,6 +432,7 @@ class PipeReplacementTool:
             "cell_upper_bound": self.cell_upper_bound,
             "combined_metric_weight": self.combined_metric_weight,
             "failures_weight": self.failures_weight,
+            "moran_options": self.moran_options,
             "step2_finished": self.step2_finished,
             "select_square_size": self.select_square_size,
             "sorted_fishnet_df": "sorted_fishnet_df.csv" if self.step2b_finished else None,
@@ -549,7 +571,8 @@ class PipeReplacementTool:
                     self.selected_cell_size()
             
             if selected_item == f'{MENU_SPACES} Criticality map for selected cell size' and self.step2b_finished:
-                img_path = [f for f in os.listdir(self.step2_output_path) if (f.endswith("map.png")) and ('lisa' in f) and (f"{self.select_square_size}_" in f)][0]
+                # The map may still be rendered in the background, so it is found by its name rather than on disk
+                img_path = f"{self.select_square_size}_final_lisa_cluster_map.png"
                 self.update_middle_frame('criticality_map_selected_cell_size', os.path.join(self.step2_output_path, img_path))
             
             # LCC optimization
@@ -588,6 +611,15 @@ class PipeReplacementTool:
         messagebox.showinfo(f"Pipe clicked", f"Pipe ID: {pipe_id}\n\nPipe Label: {pipe_label}\n\nPipe Material: {pipe_material}")
 
 
+    def recolor_network_paths(self, path_indices, colors):
+        # Change the color of already drawn network paths in place, without recreating the map objects
+        for path_index, color in zip(path_indices, colors):
+            path = self.network_map_paths[path_index]
+            path.color = color
+            if path.canvas_line is not None:
+                path.map_widget.canvas.itemconfig(path.canvas_line, fill=color)
+
+
     def handle_marker_click(self, marker):
         for i, row in self.damages_shapefile_attributes.iterrows():
             if row['KOD_VLAVIS'] == marker.data:
@@ -822,6 +854,7 @@ class PipeReplacementTool:
         self.helpMenu.add_command(label="Project Information", command=self.show_scenario_info)
         
         self.fileMenu.add_command(label="Save Project", command=self.save_scenario)
+        self.fileMenu.add_command(label="Download Basemap Tiles", command=self.download_basemap_tiles)
         self.fileMenu.add_separator()
         self.fileMenu.add_command(label="Close Project", command=self.return_to_landing_page)
         self.fileMenu.add_command(label="Exit", command=self.close_app)
@@ -962,6 +995,7 @@ class PipeReplacementTool:
             tk.Label(self.right_frame, text=f"Normalised closeness metric: {self.closeness_metric:.2f}", fg=self.fg, bg=self.white, font=(self.font, int(self.font_size // LEFT_RIGHT_FRAME_CONTENT_DIV))).pack(padx=padx_content, pady=pady, anchor='w')
             tk.Label(self.right_frame, text=f"Normalised betweeness metric: {self.betweeness_metric:.2f}", fg=self.fg, bg=self.white, font=(self.font, int(self.font_size // LEFT_RIGHT_FRAME_CONTENT_DIV))).pack(padx=padx_content, pady=pady, anchor='w')
             tk.Label(self.right_frame, text=f"Normalised bridges metric: {self.bridges_metric:.2f}", fg=self.fg, bg=self.white, font=(self.font, int(self.font_size // LEFT_RIGHT_FRAME_CONTENT_DIV))).pack(padx=padx_content, pady=pady, anchor='w')
+            if self.betweenness_sampling: tk.Label(self.right_frame, text=f"Sampled betweenness: {self.betweenness_sampling['pivots']} pivots, mean error {self.betweenness_sampling['mean_error']:.2g}", fg=self.fg, bg=self.white, font=(self.font, int(self.font_size // LEFT_RIGHT_FRAME_CONTENT_DIV))).pack(padx=padx_content, pady=pady, anchor='w')
         
         else:
             tk.Label(self.right_frame, text=f"-", fg=self.fg, bg=self.white, font=(self.font, int(self.font_size // LEFT_RIGHT_FRAME_CONTENT_DIV), 'bold')).pack(padx=5)
@@ -996,15 +1030,36 @@ class PipeReplacementTool:
         for widget in self.middle_frame.winfo_children():
             widget.destroy()
         
+        # The maps are rendered in the background, one that is not written yet is shown as soon as it is
+        self.middle_frame_request = (display_type, args)
+        if display_type == 'criticality_maps_per_cell_size':
+            rendering = pending_renders(self.step2_output_path)
+        elif display_type in ('betweeness', 'closeness', 'bridges', 'composite', 'lisa', 'criticality_map_selected_cell_size'):
+            rendering = is_rendering(args[0]) or (not os.path.exists(args[0]) and self.resubmit_metric_map(display_type, args[0]))
+            
+            if not rendering and not os.path.exists(args[0]):
+                tk.Label(self.middle_frame, text="The map is not available, run the step again to create it", bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5))).pack(expand=True)
+                return
+        else:
+            rendering = False
+        
+        if rendering:
+            tk.Label(self.middle_frame, text="The map is being rendered...", bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5))).pack(expand=True)
+            self.root.after(RENDER_POLL_INTERVAL, lambda: self.middle_frame_request == (display_type, args) and self.update_middle_frame(display_type, *args))
+            return
+        
         if display_type == 'network':
             map_widget = tkintermapview.TkinterMapView(self.middle_frame, width=int(self.width * self.map_width_multiplier), height=int(self.top_height * map_mult))
             map_widget.pack()
             
             map_widget.fit_bounding_box((self.network_bounding_box[3], self.network_bounding_box[0]), (self.network_bounding_box[1], self.network_bounding_box[2]))
                     
+            # Keep the paths so that the topological metrics dialog can recolor them for the live preview
+            self.network_map_paths = []
+            
             for index, line_path in enumerate(self.network_pipes_lines_paths):
                 pipe_color = MATERIAL_COLORS[self.network_shapefile_attributes['MATERIAL'][index]]
-                map_widget.set_path(position_list=line_path, color=pipe_color, width=3, name=index, command=self.handle_pipe_line_click)
+                self.network_map_paths.append(map_widget.set_path(position_list=line_path, color=pipe_color, width=3, name=index, command=self.handle_pipe_line_click))
 
             # Reset map button
             tk.Button(self.middle_frame, text=RESET_MAP_TEXT, command=lambda: map_widget.fit_bounding_box((self.network_bounding_box[3], self.network_bounding_box[0]), (self.network_bounding_box[1], self.network_bounding_box[2])), bg=self.blue_bg, fg="#ffffff", activebackground=self.blue_bg, activeforeground="#ffffff", font=(self.font, int(self.font_size // 2))).pack(anchor=RESET_MAP_ANCHOR, padx=RESET_MAP_PADX, pady=RESET_MAP_PADY)
@@ -1152,50 +1207,108 @@ class PipeReplacementTool:
             messagebox.showwarning("Warning", "Map tiles might not load properly due to lack of internet connection")
 
 
+    def check_failed_renders(self) -> None:
+        # The maps are rendered in the background, the errors of the failed ones are shown here
+        failures = failed_renders()
+        if failures:
+            errors = "\n".join(f"{os.path.basename(path)}: {error}" for path, error in failures.items())
+            messagebox.showerror("Error", f"The following maps could not be rendered:\n\n{errors}")
+        
+        self.root.after(RENDER_POLL_INTERVAL, self.check_failed_renders)
+
+
+    def resubmit_metric_map(self, display_type: str, map_path: str) -> bool:
+        # A metric map that is missing (its job failed or the app was closed before it was written) is rendered again
+        # from the edges of the project, once per session. False when it cannot be
+        metrics = {'betweeness': "betweenness", 'closeness': "closeness", 'bridges': "bridge", 'composite': "composite"}
+        if display_type not in metrics or self.edges is None or map_path in self.resubmitted_maps:
+            return False
+        
+        self.resubmitted_maps.add(map_path)
+        try:
+            plot_metrics(None, None, None, self.edges, [metrics[display_type]], 8, False, self.project_folder, background=True)
+        except KeyError:
+            return False  # The edges of the project have no metric columns
+        return is_rendering(map_path)
+
+
+    def download_basemap_tiles(self) -> None:
+        # Seed the tile cache of the matplotlib maps over the network, so that the analysis steps can run offline
+        if not check_internet_connection():
+            messagebox.showerror("Error", "An internet connection is needed to download the basemap tiles")
+            return
+
+        self.root.config(cursor="watch")
+        self.root.update()
+        network = read_shapefile(self.network_shapefile, [])
+        tiles = seed_tiles(network.total_bounds, network.crs.to_string() if network.crs else 'EPSG:2100')
+        self.root.config(cursor="")
+
+        messagebox.showinfo("Basemap Tiles", f"{tiles} basemap tiles of the network area are stored, the maps can now be created offline")
+
+
     def criticality_maps_per_cell_size(self):
         
         
         def next_image():
             nonlocal count
             count += 1
-            if count >= len(all_images):
+            if count >= len(square_sizes):
                 count = 0
-            img_label.config(image=all_images[count])
-            img_label.image = all_images[count]
+            show_image()
         
         
         def previous_image():
             nonlocal count
             count -= 1
             if count < 0:
-                count = len(all_images) - 1
-            img_label.config(image=all_images[count])
-            img_label.image = all_images[count]
+                count = len(square_sizes) - 1
+            show_image()
+        
+        
+        def show_image():
+            # The map of a size of a lazy sweep is drawn in the background the first time it is shown
+            square_size = square_sizes[count]
+            if square_size not in all_images:
+                map_path = choropleth_map_path(self.step2_output_path, square_size)
+                if not os.path.exists(map_path) and square_size not in requested:
+                    requested.add(square_size)
+                    request_swept_choropleth(self.topological_analysis_result_shapefile, self.damage_shapefile, self.combined_metric_weight, self.failures_weight, self.cell_upper_bound,
+                                             self.step2_output_path, square_size, self.edges, background=True)
+                
+                if is_rendering(map_path):
+                    img_label.config(image=placeholder, text=f"The map of {square_size} m is being rendered...")
+                    self.root.after(RENDER_POLL_INTERVAL, lambda: img_label.winfo_exists() and square_sizes[count] == square_size and show_image())
+                    return
+                if not os.path.exists(map_path):
+                    img_label.config(image=placeholder, text=f"The map of {square_size} m is not available")
+                    return
+                
+                img = Image.open(map_path)
+                img_resized = img.resize(self.my_images_size_2)
+                all_images[square_size] = ImageTk.PhotoImage(img_resized)
+            
+            img_label.config(image=all_images[square_size], text="")
+            img_label.image = all_images[square_size]
         
         
-        # Find all files in the Fishnet_Grids folder that are .png files
+        # Every evaluated cell size within the bounds, the adaptive search adds sizes between the 100 m steps. The sizes
+        # of a lazy sweep, and those whose map was not written, have their cells kept by the sweep cache and are drawn
+        # when they are shown
         files = [f for f in os.listdir(self.step2_output_path) if f.endswith("map.png") and 'lisa' not in f]
-        files = sorted(files, key=lambda x: int(x.split("_")[0]))
-        
-        all_images = []            
-
-        cell_boundaries = [str(cell_size) for cell_size in range(self.cell_lower_bound, self.cell_upper_bound + 1, 100)]
-
-        for file in files:
-
-            if not any(cell_boundary in file for cell_boundary in cell_boundaries):
-                continue
-            
-            img = Image.open(os.path.join(self.step2_output_path, file))
-            img_resized = img.resize(self.my_images_size_2)
-            photo_image = ImageTk.PhotoImage(img_resized)
-            all_images.append(photo_image)
+        files += [f for f in os.listdir(self.step2_output_path) if f.endswith("_sweep_cache.npz")]
+        square_sizes = sorted({int(f.split("_")[0]) for f in files if self.cell_lower_bound <= int(f.split("_")[0]) <= self.cell_upper_bound})
         
+        all_images = {}
+        requested = set()
         count = 0
         
-        img_label = tk.Label(self.middle_frame, image=all_images[0])
-        img_label.image = all_images[count]
+        # A blank map keeps the size of the label while a map is being rendered
+        placeholder = ImageTk.PhotoImage(Image.new("RGB", self.my_images_size_2, self.bg))
+        img_label = tk.Label(self.middle_frame, image=placeholder, bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)), compound='center')
+        img_label.image = placeholder
         img_label.pack(pady=20)
+        show_image()
                 
         tk.Label(self.middle_frame, text="Explore the results for the defined range of cell sizes", bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.3))).pack(pady=10)
         
@@ -1209,6 +1322,111 @@ class PipeReplacementTool:
     def topological_metrics(self):
         
         
+        def centrality_options():
+            # Read the engine, workers and betweenness sampling widgets, None if the sampling value is invalid
+            try:
+                workers = int(workers_spinbox.get())
+            except ValueError:
+                workers = 1
+            
+            options = {"engine": engine_combobox.get(), "workers": max(workers, 1), "betweenness_k": None, "betweenness_accuracy": None, "contract_chains": contract_var.get(), "distance": distance_combobox.get()}
+            try:
+                if sampling_combobox.get() == "pivots":
+                    options["betweenness_k"] = int(sampling_entry.get())
+                    if options["betweenness_k"] < 1: raise ValueError
+                elif sampling_combobox.get() == "accuracy":
+                    options["betweenness_accuracy"] = float(sampling_entry.get())
+                    if not 0 < options["betweenness_accuracy"] < 1: raise ValueError
+            except ValueError:
+                messagebox.showerror("Error", "The number of pivots must be a positive integer and the accuracy a number between 0 and 1")
+                return None
+            
+            return options
+        
+        
+        def normalised_weights():
+            closeness = closeness_slider.get()
+            betweeness = betweeness_slider.get()
+            bridges = bridges_slider.get()
+            
+            total = closeness + betweeness + bridges
+            if total == 0:
+                return 1/3, 1/3, 1/3
+            return closeness / total, betweeness / total, bridges / total
+        
+        
+        def toggle_preview():
+            if not preview_var.get():
+                restore_preview()
+                return
+            
+            if preview["edges"] is None:
+                options = centrality_options()
+                if options is None:
+                    preview_var.set(False)
+                    return
+                
+                info_label.config(text="Calculating the topological metrics for the preview...", fg=self.fg)
+                window.update()
+                
+                # The metrics are cached by network, so running the analysis afterwards will not calculate them again.
+                # The preview only needs the pipe IDs, the analysis reads every attribute column for its export
+                _, _, _, edges, _, _ = network_centralities(self.network_shapefile, columns=NETWORK_COLUMNS, **options)
+                
+                # Pipe IDs repeat in some exports, so the n-th pipe of an ID in edges is matched with the n-th path of that ID
+                path_ids = pd.Series(np.asarray(self.network_shapefile_attributes['ID']))
+                edge_ids = pd.Series(edges['ID'].to_numpy())
+                path_keys = pd.MultiIndex.from_arrays([path_ids, path_ids.groupby(path_ids, dropna=False).cumcount()])
+                edge_keys = pd.MultiIndex.from_arrays([edge_ids, edge_ids.groupby(edge_ids, dropna=False).cumcount()])
+                preview["edges"] = edges
+                preview["path_indices"] = path_keys.get_indexer(edge_keys)
+                info_label.config(text="")
+            
+            # Make sure the pipe network is the map on display
+            self.update_middle_frame('network')
+            preview["color_indices"] = None
+            update_preview()
+        
+        
+        def schedule_preview(value=None):
+            # Slider callbacks arrive for every pixel of movement, only the last one within the debounce interval is drawn
+            if not preview_var.get() or preview["edges"] is None:
+                return
+            if preview["job"] is not None:
+                window.after_cancel(preview["job"])
+            preview["job"] = window.after(PREVIEW_DEBOUNCE_MS, update_preview)
+        
+        
+        def update_preview():
+            preview["job"] = None
+            edges = preview["edges"]
+            
+            cm = composite_metric(edges, *normalised_weights()).to_numpy()
+            color_indices = metric_color_indices(cm)
+            
+            # Only the pipes whose color level changed are touched on the canvas
+            if preview["color_indices"] is None:
+                changed = np.arange(len(cm))
+            else:
+                changed = np.flatnonzero(color_indices != preview["color_indices"])
+            changed = changed[preview["path_indices"][changed] >= 0]
+            preview["color_indices"] = color_indices
+            
+            self.recolor_network_paths(preview["path_indices"][changed], [preview_lut[i] for i in color_indices[changed]])
+        
+        
+        def restore_preview():
+            if preview["job"] is not None:
+                window.after_cancel(preview["job"])
+                preview["job"] = None
+            if preview["color_indices"] is None or not self.network_map_paths:
+                return
+            
+            preview["color_indices"] = None
+            materials = self.network_shapefile_attributes['MATERIAL']
+            self.recolor_network_paths(range(len(self.network_map_paths)), [MATERIAL_COLORS[material] for material in materials])
+        
+        
         def run_topological_analysis():
             if self.step2_finished:
                 messagebox.showerror("Error", "You have already run the topological analysis")
@@ -1219,18 +1437,8 @@ class PipeReplacementTool:
             
             window.update()
             
-            closeness = closeness_slider.get()
-            betweeness = betweeness_slider.get()
-            bridges = bridges_slider.get()
-            
             # Normalize the values
-            total = closeness + betweeness + bridges
-            if total == 0:
-                closeness, betweeness, bridges = 1/3, 1/3, 1/3
-            else:
-                closeness /= total            
-                betweeness /= total
-                bridges /= total
+            closeness, betweeness, bridges = normalised_weights()
             
             self.closeness_metric = closeness
             self.betweeness_metric = betweeness
@@ -1238,10 +1446,17 @@ class PipeReplacementTool:
             
             output_path = self.project_folder
             
-            gdf, G, nodes, edges, df_metrics = process_shapefile(self.network_shapefile, closeness, betweeness, bridges, output_path)
+            options = centrality_options()
+            if options is None:
+                info_label.config(text="")
+                run_button.config(state=tk.NORMAL)
+                return
+            
+            gdf, G, nodes, edges, df_metrics = process_shapefile(self.network_shapefile, closeness, betweeness, bridges, output_path, **options)
             self.edges = edges
+            self.betweenness_sampling = edges.attrs.get('betweenness_sampling')
             
-            plot_metrics(gdf, G, nodes, edges, ["closeness", "betweenness", "bridge", "composite"], 8, False, output_path)
+            plot_metrics(gdf, G, nodes, edges, ["closeness", "betweenness", "bridge", "composite"], 8, False, output_path, background=True)
             
             output_path = os.path.join(output_path, "shp_with_metrics", "Pipes_WG_export_with_metrics.shp")
             
@@ -1270,7 +1485,7 @@ class PipeReplacementTool:
         window = tk.Toplevel(self.root)
         
         window_width = self.screen_width // 1.7
-        window_height = self.screen_height // 1.7
+        window_height = self.screen_height // 1.15
         x = (self.screen_width / 2) - (window_width / 2)
         y = (self.screen_height / 2) - (window_height / 2)
         window.geometry(f"{int(window_width)}x{int(window_height)}+{int(x)}+{int(y)}")
@@ -1289,63 +1504,161 @@ class PipeReplacementTool:
         slider_percentage = 0.6
         
         closeness_label = tk.Label(window_frame, text="Closeness metric", bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
-        closeness_label.grid(row=0, column=0, padx=5, pady=20, sticky=tk.SE)
+        closeness_label.grid(row=0, column=0, padx=5, pady=12, sticky=tk.SE)
         
         closeness_info = tk.Label(window_frame, text="", image=self.info_image, compound=tk.LEFT, bg=self.bg)
-        closeness_info.grid(row=0, column=1, padx=5, pady=20, sticky=tk.SW)
+        closeness_info.grid(row=0, column=1, padx=5, pady=12, sticky=tk.SW)
         
         closeness_lower_bound = tk.Label(window_frame, text=str(lowest_value), bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
-        closeness_lower_bound.grid(row=0, column=2, padx=5, pady=20, sticky=tk.SE)
+        closeness_lower_bound.grid(row=0, column=2, padx=5, pady=12, sticky=tk.SE)
         
         closeness_slider = tk.Scale(window_frame, from_=lowest_value, to=highest_value, orient=tk.HORIZONTAL, length=int(slider_percentage * window_width), resolution=step)
-        closeness_slider.grid(row=0, column=3, padx=5, pady=20)
+        closeness_slider.grid(row=0, column=3, padx=5, pady=12)
 
         closeness_upper_bound = tk.Label(window_frame, text=str(highest_value), bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
-        closeness_upper_bound.grid(row=0, column=4, padx=5, pady=20, sticky=tk.SW)
+        closeness_upper_bound.grid(row=0, column=4, padx=5, pady=12, sticky=tk.SW)
         
         betweeness_label = tk.Label(window_frame, text="Betweeness metric", bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
-        betweeness_label.grid(row=1, column=0, padx=5, pady=20, sticky=tk.SE)
+        betweeness_label.grid(row=1, column=0, padx=5, pady=12, sticky=tk.SE)
         
         betweeness_info = tk.Label(window_frame, text="", image=self.info_image, compound=tk.LEFT, bg=self.bg)
-        betweeness_info.grid(row=1, column=1, padx=5, pady=20, sticky=tk.SW)
+        betweeness_info.grid(row=1, column=1, padx=5, pady=12, sticky=tk.SW)
         
         betweeness_lower_bound = tk.Label(window_frame, text=str(lowest_value), bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
-        betweeness_lower_bound.grid(row=1, column=2, padx=5, pady=20, sticky=tk.SE)
+        betweeness_lower_bound.grid(row=1, column=2, padx=5, pady=12, sticky=tk.SE)
         
         betweeness_slider = tk.Scale(window_frame, from_=lowest_value, to=highest_value, orient=tk.HORIZONTAL, length=int(slider_percentage * window_width), resolution=step)
-        betweeness_slider.grid(row=1, column=3, padx=5, pady=20)
+        betweeness_slider.grid(row=1, column=3, padx=5, pady=12)
         
         betweeness_upper_bound = tk.Label(window_frame, text=str(highest_value), bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
-        betweeness_upper_bound.grid(row=1, column=4, padx=5, pady=20, sticky=tk.SW)
+        betweeness_upper_bound.grid(row=1, column=4, padx=5, pady=12, sticky=tk.SW)
         
         bridges_label = tk.Label(window_frame, text="Bridges metric", bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
-        bridges_label.grid(row=2, column=0, padx=5, pady=20, sticky=tk.SE)
+        bridges_label.grid(row=2, column=0, padx=5, pady=12, sticky=tk.SE)
         
         bridges_info = tk.Label(window_frame, text="", image=self.info_image, compound=tk.LEFT, bg=self.bg)
-        bridges_info.grid(row=2, column=1, padx=5, pady=20, sticky=tk.SW)
+        bridges_info.grid(row=2, column=1, padx=5, pady=12, sticky=tk.SW)
         
         bridges_lower_bound = tk.Label(window_frame, text=str(lowest_value), bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
-        bridges_lower_bound.grid(row=2, column=2, padx=5, pady=20, sticky=tk.SE)
+        bridges_lower_bound.grid(row=2, column=2, padx=5, pady=12, sticky=tk.SE)
         
         bridges_slider = tk.Scale(window_frame, from_=lowest_value, to=highest_value, orient=tk.HORIZONTAL, length=int(slider_percentage * window_width), resolution=step)
-        bridges_slider.grid(row=2, column=3, padx=5, pady=20)
+        bridges_slider.grid(row=2, column=3, padx=5, pady=12)
         
         bridges_upper_bound = tk.Label(window_frame, text=str(highest_value), bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
-        bridges_upper_bound.grid(row=2, column=4, padx=5, pady=20, sticky=tk.SW)
+        bridges_upper_bound.grid(row=2, column=4, padx=5, pady=12, sticky=tk.SW)
+        
+        engine_label = tk.Label(window_frame, text="Centrality engine", bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
+        engine_label.grid(row=3, column=0, padx=5, pady=12, sticky=tk.SE)
+        
+        engine_info = tk.Label(window_frame, text="", image=self.info_image, compound=tk.LEFT, bg=self.bg)
+        engine_info.grid(row=3, column=1, padx=5, pady=12, sticky=tk.SW)
+        
+        engine_combobox = ttk.Combobox(window_frame, values=CENTRALITY_ENGINES, state='readonly', width=20)
+        engine_combobox.grid(row=3, column=3, padx=5, pady=12, sticky='w')
+        engine_combobox.set(CENTRALITY_ENGINES[0])
+        
+        workers_label = tk.Label(window_frame, text="Parallel workers", bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
+        workers_label.grid(row=4, column=0, padx=5, pady=12, sticky=tk.SE)
+        
+        workers_info = tk.Label(window_frame, text="", image=self.info_image, compound=tk.LEFT, bg=self.bg)
+        workers_info.grid(row=4, column=1, padx=5, pady=12, sticky=tk.SW)
+        
+        workers_spinbox = tk.Spinbox(window_frame, from_=1, to=os.cpu_count() or 1, width=5, font=(self.font, int(self.font_size // 1.5)))
+        workers_spinbox.grid(row=4, column=3, padx=5, pady=12, sticky='w')
+        
+        sampling_label = tk.Label(window_frame, text="Betweenness sampling", bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
+        sampling_label.grid(row=5, column=0, padx=5, pady=12, sticky=tk.SE)
+        
+        sampling_info = tk.Label(window_frame, text="", image=self.info_image, compound=tk.LEFT, bg=self.bg)
+        sampling_info.grid(row=5, column=1, padx=5, pady=12, sticky=tk.SW)
+        
+        sampling_frame = tk.Frame(window_frame, bg=self.bg)
+        sampling_frame.grid(row=5, column=3, padx=5, pady=12, sticky='w')
+        
+        sampling_combobox = ttk.Combobox(sampling_frame, values=BETWEENNESS_MODES, state='readonly', width=20)
+        sampling_combobox.pack(side=tk.LEFT)
+        sampling_combobox.set(BETWEENNESS_MODES[0])
+        
+        sampling_entry = tk.Entry(sampling_frame, width=10, font=(self.font, int(self.font_size // 1.5)))
+        sampling_entry.pack(side=tk.LEFT, padx=10)
+        sampling_entry.config(state=tk.DISABLED)
+        
+        def sampling_mode_changed(event):
+            mode = sampling_combobox.get()
+            sampling_entry.config(state=tk.NORMAL)
+            sampling_entry.delete(0, tk.END)
+            if mode == "pivots": sampling_entry.insert(0, "500")
+            elif mode == "accuracy": sampling_entry.insert(0, "0.05")
+            else: sampling_entry.config(state=tk.DISABLED)
+        
+        sampling_combobox.bind("<<ComboboxSelected>>", sampling_mode_changed)
+        
+        distance_label = tk.Label(window_frame, text="Shortest path distance", bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
+        distance_label.grid(row=6, column=0, padx=5, pady=12, sticky=tk.SE)
+        
+        distance_info = tk.Label(window_frame, text="", image=self.info_image, compound=tk.LEFT, bg=self.bg)
+        distance_info.grid(row=6, column=1, padx=5, pady=12, sticky=tk.SW)
+        
+        distance_combobox = ttk.Combobox(window_frame, values=CENTRALITY_DISTANCES, state='readonly', width=20)
+        distance_combobox.grid(row=6, column=3, padx=5, pady=12, sticky='w')
+        distance_combobox.set(CENTRALITY_DISTANCES[0])
+        distance_combobox.bind("<<ComboboxSelected>>", lambda event: options_changed())
+        
+        contract_var = tk.BooleanVar(value=False)
+        
+        contract_label = tk.Label(window_frame, text="Contract pipe chains", bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
+        contract_label.grid(row=7, column=0, padx=5, pady=12, sticky=tk.SE)
+        
+        contract_info = tk.Label(window_frame, text="", image=self.info_image, compound=tk.LEFT, bg=self.bg)
+        contract_info.grid(row=7, column=1, padx=5, pady=12, sticky=tk.SW)
+        
+        def options_changed():
+            # The preview metrics depend on the distance and contraction options, so they are loaded again
+            preview["edges"] = None
+            if preview_var.get(): toggle_preview()
+        
+        contract_checkbutton = tk.Checkbutton(window_frame, variable=contract_var, command=options_changed, bg=self.bg, activebackground=self.bg)
+        contract_checkbutton.grid(row=7, column=3, padx=5, pady=12, sticky='w')
+        
+        preview = {"edges": None, "path_indices": None, "color_indices": None, "job": None}
+        preview_lut = metric_color_lut()
+        preview_var = tk.BooleanVar(value=False)
+        
+        preview_label = tk.Label(window_frame, text="Live preview", bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
+        preview_label.grid(row=8, column=0, padx=5, pady=12, sticky=tk.SE)
+        
+        preview_info = tk.Label(window_frame, text="", image=self.info_image, compound=tk.LEFT, bg=self.bg)
+        preview_info.grid(row=8, column=1, padx=5, pady=12, sticky=tk.SW)
+        
+        preview_checkbutton = tk.Checkbutton(window_frame, variable=preview_var, command=toggle_preview, bg=self.bg, activebackground=self.bg)
+        preview_checkbutton.grid(row=8, column=3, padx=5, pady=12, sticky='w')
+        
+        for slider in (closeness_slider, betweeness_slider, bridges_slider):
+            slider.config(command=schedule_preview)
+        
+        # Give the map its material colors back when the dialog closes
+        window.bind("<Destroy>", lambda event: restore_preview() if event.widget is window else None)
         
         composite_label = tk.Label(window_frame, text=COMPOSITE_TOOLTIP, bg=self.bg, fg=self.gray_fg, font=self.tooltip_font_full, wraplength=int(0.9*window_width), justify='left')
-        composite_label.grid(row=3, column=0, padx=5, pady=20, columnspan=5, sticky='w')
+        composite_label.grid(row=9, column=0, padx=5, pady=12, columnspan=5, sticky='w')
         
         run_button = tk.Button(window_frame, text="Run", width=30, background=self.blue_bg, foreground="#ffffff", activebackground=self.blue_bg, activeforeground="#ffffff", font=(self.font, int(self.font_size // 1.5)), command=run_topological_analysis)
-        run_button.grid(row=4, column=0, padx=5, pady=20, columnspan=5)
+        run_button.grid(row=10, column=0, padx=5, pady=12, columnspan=5)
         
         # Info label
         info_label = tk.Label(window_frame, text="", bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
-        info_label.grid(row=5, column=0, padx=5, pady=20, columnspan=5)
+        info_label.grid(row=11, column=0, padx=5, pady=12, columnspan=5)
         
         window.after_idle(lambda : make_tt(closeness_info, CLOSENESS_TOOLTIP, 'right'))
         window.after_idle(lambda : make_tt(betweeness_info, BETWEENESS_TOOLTIP, 'right'))
         window.after_idle(lambda : make_tt(bridges_info, BRIDGES_TOOLTIP, 'right'))
+        window.after_idle(lambda : make_tt(engine_info, CENTRALITY_ENGINE_TOOLTIP, 'right'))
+        window.after_idle(lambda : make_tt(workers_info, CENTRALITY_WORKERS_TOOLTIP, 'right'))
+        window.after_idle(lambda : make_tt(sampling_info, BETWEENNESS_SAMPLING_TOOLTIP, 'right'))
+        window.after_idle(lambda : make_tt(distance_info, CENTRALITY_DISTANCE_TOOLTIP, 'right'))
+        window.after_idle(lambda : make_tt(contract_info, CONTRACT_CHAINS_TOOLTIP, 'right'))
+        window.after_idle(lambda : make_tt(preview_info, LIVE_PREVIEW_TOOLTIP, 'right'))
         
         window.wait_window()
     
@@ -1361,6 +1674,22 @@ class PipeReplacementTool:
             combined_metric_failures = combined_metric_failures_slider.get()
             cell_lower_bound = cell_lower_bound_slider.get()
             cell_upper_bound = cell_upper_bound_slider.get()
+            try:
+                workers = max(int(workers_spinbox.get()), 1)
+            except ValueError:
+                workers = 1
+            try:
+                permutations = int(permutations_spinbox.get())
+                seed = int(seed_entry.get())
+            except ValueError:
+                messagebox.showerror("Error", "The permutations and the seed should be integers")
+                return
+            if permutations < 1:
+                messagebox.showerror("Error", "The number of permutations should be a positive integer")
+                return
+            if seed < 0:
+                messagebox.showerror("Error", "The seed should be zero or a positive integer")
+                return
             
             if cell_lower_bound >= cell_upper_bound:
                 messagebox.showerror("Error", "Cell lower bound should be less than cell upper bound")
@@ -1375,11 +1704,15 @@ class PipeReplacementTool:
             
             self.combined_metric_weight = 1 - combined_metric_failures
             self.failures_weight = combined_metric_failures
+            self.moran_options = {"permutations": permutations, "seed": seed, "early_stop": early_stop_var.get(), "workers": workers, "inference": inference_combobox.get(),
+                                  "search": search_combobox.get(), "lazy_maps": lazy_maps_var.get()}
             
             os.makedirs(os.path.join(self.project_folder, "Fishnet_Grids"), exist_ok=True)
             
             self.step2_output_path = os.path.join(self.project_folder, "Fishnet_Grids", "")
-            results, best_square_size = spatial_autocorrelation_analysis(self.topological_analysis_result_shapefile, self.damage_shapefile, self.cell_lower_bound, self.cell_upper_bound, self.combined_metric_weight, self.failures_weight, self.step2_output_path, self.edges)
+            results, best_square_size, _ = spatial_autocorrelation_analysis(self.topological_analysis_result_shapefile, self.damage_shapefile, self.cell_lower_bound, self.cell_upper_bound, self.combined_metric_weight, self.failures_weight, self.step2_output_path, self.edges, workers=workers,
+                                                                             seed=seed, permutations=permutations, early_stop=early_stop_var.get(), inference=inference_combobox.get(),
+                                                                             search=search_combobox.get(), background=True, lazy=lazy_maps_var.get())
             self.best_square_size = best_square_size
             self.step2_finished = True
         
@@ -1395,7 +1728,7 @@ class PipeReplacementTool:
         window = tk.Toplevel(self.root)
         
         window_width = self.screen_width // 1.2
-        window_height = self.screen_height // 2.2
+        window_height = self.screen_height // 1.2
         x = (self.screen_width / 2) - (window_width / 2)
         y = (self.screen_height / 2) - (window_height / 2)
         window.geometry(f"{int(window_width)}x{int(window_height)}+{int(x)}+{int(y)}")
@@ -1469,16 +1802,93 @@ class PipeReplacementTool:
         cell_upper_bound_upper_value = tk.Label(window_frame, text=str(cell_max_size), bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
         cell_upper_bound_upper_value.grid(row=2, column=4, padx=5, pady=20, sticky=tk.SW)
         
+        workers_label = tk.Label(window_frame, text="Parallel workers", bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
+        workers_label.grid(row=3, column=0, padx=5, pady=20, sticky=tk.SE)
+
+        workers_info = tk.Label(window_frame, text="", image=self.info_image, compound=tk.LEFT, bg=self.bg)
+        workers_info.grid(row=3, column=1, padx=5, pady=20, sticky=tk.SW)
+
+        workers_spinbox = tk.Spinbox(window_frame, from_=1, to=os.cpu_count() or 1, width=5, font=(self.font, int(self.font_size // 1.5)))
+        workers_spinbox.grid(row=3, column=3, padx=5, pady=20, sticky='w')
+        
+        permutations_label = tk.Label(window_frame, text="Permutations", bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
+        permutations_label.grid(row=4, column=0, padx=5, pady=20, sticky=tk.SE)
+
+        permutations_info = tk.Label(window_frame, text="", image=self.info_image, compound=tk.LEFT, bg=self.bg)
+        permutations_info.grid(row=4, column=1, padx=5, pady=20, sticky=tk.SW)
+
+        permutations_spinbox = tk.Spinbox(window_frame, from_=99, to=99999, increment=100, width=7, font=(self.font, int(self.font_size // 1.5)))
+        permutations_spinbox.grid(row=4, column=3, padx=5, pady=20, sticky='w')
+        permutations_spinbox.delete(0, tk.END)
+        permutations_spinbox.insert(0, str(MORAN_PERMUTATIONS))
+        
+        seed_label = tk.Label(window_frame, text="Random seed", bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
+        seed_label.grid(row=5, column=0, padx=5, pady=20, sticky=tk.SE)
+
+        seed_info = tk.Label(window_frame, text="", image=self.info_image, compound=tk.LEFT, bg=self.bg)
+        seed_info.grid(row=5, column=1, padx=5, pady=20, sticky=tk.SW)
+
+        seed_entry = tk.Entry(window_frame, width=8, font=(self.font, int(self.font_size // 1.5)))
+        seed_entry.grid(row=5, column=3, padx=5, pady=20, sticky='w')
+        seed_entry.insert(0, str(MORAN_SEED))
+        
+        early_stop_label = tk.Label(window_frame, text="Early stopping", bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
+        early_stop_label.grid(row=6, column=0, padx=5, pady=20, sticky=tk.SE)
+
+        early_stop_info = tk.Label(window_frame, text="", image=self.info_image, compound=tk.LEFT, bg=self.bg)
+        early_stop_info.grid(row=6, column=1, padx=5, pady=20, sticky=tk.SW)
+
+        early_stop_var = tk.BooleanVar(value=False)
+        early_stop_checkbutton = tk.Checkbutton(window_frame, variable=early_stop_var, bg=self.bg, activebackground=self.bg)
+        early_stop_checkbutton.grid(row=6, column=3, padx=5, pady=20, sticky='w')
+        
+        inference_label = tk.Label(window_frame, text="Significance", bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
+        inference_label.grid(row=7, column=0, padx=5, pady=20, sticky=tk.SE)
+
+        inference_info = tk.Label(window_frame, text="", image=self.info_image, compound=tk.LEFT, bg=self.bg)
+        inference_info.grid(row=7, column=1, padx=5, pady=20, sticky=tk.SW)
+
+        inference_combobox = ttk.Combobox(window_frame, values=MORAN_INFERENCES, state='readonly', width=20)
+        inference_combobox.grid(row=7, column=3, padx=5, pady=20, sticky='w')
+        inference_combobox.set(MORAN_INFERENCES[0])
+        
+        search_label = tk.Label(window_frame, text="Cell size search", bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
+        search_label.grid(row=8, column=0, padx=5, pady=20, sticky=tk.SE)
+
+        search_info = tk.Label(window_frame, text="", image=self.info_image, compound=tk.LEFT, bg=self.bg)
+        search_info.grid(row=8, column=1, padx=5, pady=20, sticky=tk.SW)
+
+        search_combobox = ttk.Combobox(window_frame, values=SQUARE_SIZE_SEARCHES, state='readonly', width=20)
+        search_combobox.grid(row=8, column=3, padx=5, pady=20, sticky='w')
+        search_combobox.set(SQUARE_SIZE_SEARCHES[0])
+        
+        lazy_maps_label = tk.Label(window_frame, text="Draw maps on demand", bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
+        lazy_maps_label.grid(row=9, column=0, padx=5, pady=20, sticky=tk.SE)
+
+        lazy_maps_info = tk.Label(window_frame, text="", image=self.info_image, compound=tk.LEFT, bg=self.bg)
+        lazy_maps_info.grid(row=9, column=1, padx=5, pady=20, sticky=tk.SW)
+
+        lazy_maps_var = tk.BooleanVar(value=False)
+        lazy_maps_checkbutton = tk.Checkbutton(window_frame, variable=lazy_maps_var, bg=self.bg, activebackground=self.bg)
+        lazy_maps_checkbutton.grid(row=9, column=3, padx=5, pady=20, sticky='w')
+        
         run_button = tk.Button(window_frame, text="Run", width=30, background=self.blue_bg, foreground="#ffffff", activebackground=self.blue_bg, activeforeground="#ffffff", font=(self.font, int(self.font_size // 1.5)),command=run_combined_analysis)
-        run_button.grid(row=3, column=0, columnspan=6, padx=5, pady=20)
+        run_button.grid(row=10, column=0, columnspan=6, padx=5, pady=20)
         
         info_label = tk.Label(window_frame, text="", bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
-        info_label.grid(row=4, column=0, columnspan=6, padx=5, pady=20)
+        info_label.grid(row=11, column=0, columnspan=6, padx=5, pady=20)
         
         window.after_idle(lambda : make_tt(combined_info_1, COMBINED_METRIC_FAILURES_TOOLTIP, 'right'))
         window.after_idle(lambda : make_tt(combined_info_2, COMBINED_METRIC_FAILURES_TOOLTIP, 'left'))
         window.after_idle(lambda : make_tt(cell_lower_info, CELL_LOWER_BOUND_TOOLTIP, 'right'))
         window.after_idle(lambda : make_tt(cell_upper_info, CELL_UPPER_BOUND_TOOLTIP, 'right'))
+        window.after_idle(lambda : make_tt(workers_info, SWEEP_WORKERS_TOOLTIP, 'right'))
+        window.after_idle(lambda : make_tt(permutations_info, MORAN_PERMUTATIONS_TOOLTIP, 'right'))
+        window.after_idle(lambda : make_tt(seed_info, MORAN_SEED_TOOLTIP, 'right'))
+        window.after_idle(lambda : make_tt(early_stop_info, MORAN_EARLY_STOP_TOOLTIP, 'right'))
+        window.after_idle(lambda : make_tt(inference_info, MORAN_INFERENCE_TOOLTIP, 'right'))
+        window.after_idle(lambda : make_tt(search_info, SQUARE_SIZE_SEARCH_TOOLTIP, 'right'))
+        window.after_idle(lambda : make_tt(lazy_maps_info, LAZY_MAPS_TOOLTIP, 'right'))
 
         window.wait_window()
     
@@ -1497,7 +1907,11 @@ class PipeReplacementTool:
             
             self.select_square_size = selected_cell_size_slider.get()
             
-            self.sorted_fishnet_df, self.results_pipe_clusters, self.fishnet_index = local_spatial_autocorrelation(self.topological_analysis_result_shapefile, self.edges, self.damage_shapefile, self.combined_metric_weight, self.failures_weight, self.select_square_size, self.step2_output_path)
+            # Same permutations as the sweep of step 2, projects of older versions have no options saved
+            moran_options = self.moran_options or {}
+            self.sorted_fishnet_df, self.results_pipe_clusters, self.fishnet_index = local_spatial_autocorrelation(self.topological_analysis_result_shapefile, self.edges, self.damage_shapefile, self.combined_metric_weight, self.failures_weight, self.select_square_size, self.step2_output_path,
+                                                                                                                   permutations=moran_options.get("permutations", MORAN_PERMUTATIONS), seed=moran_options.get("seed", MORAN_SEED), workers=moran_options.get("workers", 1),
+                                                                                                                   background=True)
             
             self.path_fishnet = os.path.join(self.project_folder, "Fishnet_Grids", f"{self.select_square_size}_fishnets_sorted.shp")
             self.step2b_finished = True
@@ -1536,7 +1950,9 @@ class PipeReplacementTool:
         cell_size_lower_value = tk.Label(window_frame, text=str(self.cell_lower_bound), bg=self.bg, fg=self.fg, font=(self.font, int(self.font_size // 1.5)))
         cell_size_lower_value.grid(row=1, column=1, padx=5, pady=20, sticky=tk.SE)
         
-        selected_cell_size_slider = tk.Scale(window_frame, from_=self.cell_lower_bound, to=self.cell_upper_bound, orient=tk.HORIZONTAL, length=int(0.5 * window_width), resolution=100)
+        # The adaptive search of step 2 may find a best cell size between the 100 m steps
+        resolution = SQUARE_SIZE_MIN_STEP if (self.moran_options or {}).get("search") == "adaptive" else 100
+        selected_cell_size_slider = tk.Scale(window_frame, from_=self.cell_lower_bound, to=self.cell_upper_bound, orient=tk.HORIZONTAL, length=int(0.5 * window_width), resolution=resolution)
         selected_cell_size_slider.grid(row=1, column=2, padx=5, pady=20)
         selected_cell_size_slider.set(self.best_square_size)
         
@@ -1617,7 +2033,7 @@ class PipeReplacementTool:
                     return
             
             # Run functions
-            pipes_gdf_cell = process_pipes_cell_data(self.topological_analysis_result_shapefile, self.path_fishnet, self.fishnet_index, cell_index, self.results_pipe_clusters, self.pipe_materials)
+            pipes_gdf_cell = process_pipes_cell_data(self.topological_analysis_result_shapefile, self.fishnet_index, cell_index, self.results_pipe_clusters, self.pipe_materials)
             
             pipe_table_trep, LLCCn, ann_budg, xl, xu = calculate_investment_timeseries(pipes_gdf_cell, self.contract_lifespan, 50, self.time_relaxation)
 
@@ -1814,7 +2230,7 @@ class PipeReplacementTool:
             for widget in window_frame.winfo_children():
                 widget.destroy()
             
-            gdf = gpd.read_file(cell_shp_path)
+            gdf = read_shapefile(cell_shp_path, ['ID'])
             gdf.set_crs(epsg=2100, inplace=True)
             gdf = reproject_shp(gdf)
             
@@ -0,0 +1,141 @@
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor, wait
+from functools import partial
+from typing import Callable, Dict, List, Optional
+import os
+import threading
+import matplotlib
+
+
+# Processes that render the PNG outputs, one core is left to the analysis and the Tk thread
+RENDER_WORKERS = max((os.cpu_count() or 1) - 1, 1)
+
+_executor: Optional[ProcessPoolExecutor] = None
+_jobs: Dict[str, Future] = {}
+_writers: Dict[str, Future] = {}  # The pool future of the last job of every PNG, the one that may be writing it
+_failures: Dict[str, BaseException] = {}
+_lock = threading.RLock()  # The jobs are also queued from the thread that runs the callbacks of the pool
+
+
+def _use_agg() -> None:
+    matplotlib.use('Agg')
+
+
+def render_pool() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=RENDER_WORKERS, initializer=_use_agg)
+    return _executor
+
+
+def submit_render(path: str, function: Callable, *args) -> Future:
+    '''
+    Render the PNG at path in the render pool with function(*args) and return its future, whose result is path.
+    A job is a module level plotting function with its data (GeoDataFrames, arrays) and style arguments, so it can be
+    sent to another process; the analysis step that submits it does not wait for the figure.
+    A queued job of the same PNG is replaced. One that is already being rendered cannot be stopped, the new job is
+    then only queued once it ends, so the two never write the PNG at the same time and the newer map is kept.
+    '''
+    path = os.path.abspath(path)
+    with _lock:
+        previous = _jobs.get(path)
+        if previous is not None:
+            previous.cancel()
+
+        _failures.pop(path, None)
+        writer = _writers.get(path)
+        if writer is not None and not writer.done():
+            future = Future()
+            _jobs[path] = future
+            writer.add_done_callback(lambda _: _submit_after(future, path, function, args))
+        else:
+            future = _submit(path, function, args)
+            _jobs[path] = future
+        future.add_done_callback(partial(_record_failure, path))
+    return future
+
+
+def _submit(path: str, function: Callable, args: tuple) -> Future:
+    writer = render_pool().submit(_render, path, function, *args)
+    _writers[path] = writer
+    return writer
+
+
+def _submit_after(future: Future, path: str, function: Callable, args: tuple) -> None:
+    # Queue a job that waited for the running job of its PNG, unless it was replaced or the pool was shut down since
+    with _lock:
+        if _executor is None:
+            future.cancel()
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            writer = _submit(path, function, args)
+        except Exception as error:
+            future.set_exception(error)
+            return
+    writer.add_done_callback(partial(_copy_outcome, future))
+
+
+def _copy_outcome(future: Future, writer: Future) -> None:
+    if writer.cancelled():
+        future.set_exception(CancelledError())
+    elif writer.exception() is not None:
+        future.set_exception(writer.exception())
+    else:
+        future.set_result(writer.result())
+
+
+def _record_failure(path: str, future: Future) -> None:
+    # Runs when a job ends, the error of a failed one is kept until the GUI collects it with failed_renders. A job
+    # that waited for another one and was dropped by shutdown_render_pool ends with a CancelledError, it did not fail
+    if future.cancelled() or isinstance(future.exception(), CancelledError):
+        return
+    if future.exception() is not None:
+        _failures[path] = future.exception()
+
+
+def _render(path: str, function: Callable, *args) -> str:
+    function(*args)
+    return path
+
+
+def is_rendering(path: str) -> bool:
+    # True while the PNG at path is queued or being rendered
+    future = _jobs.get(os.path.abspath(path))
+    return future is not None and not future.done()
+
+
+def pending_renders(folder: Optional[str] = None) -> List[str]:
+    # Paths of the PNGs still queued or being rendered, only those inside folder when it is given
+    folder = os.path.join(os.path.abspath(folder), "") if folder is not None else None
+    return [path for path, future in _jobs.items() if not future.done() and (folder is None or path.startswith(folder))]
+
+
+def failed_renders() -> Dict[str, BaseException]:
+    # The PNGs whose job failed since the last call, with the error of each job
+    failures = dict(_failures)
+    for path in failures:
+        _failures.pop(path, None)
+    return failures
+
+
+def wait_for_renders(timeout: Optional[float] = None) -> None:
+    # Block until every submitted PNG is written, the errors of the jobs are raised here
+    futures = list(_jobs.values())
+    wait(futures, timeout=timeout)
+    for future in futures:
+        if future.done() and not future.cancelled():
+            future.result()
+
+
+def shutdown_render_pool() -> None:
+    # Drop the queued jobs and stop the workers, the PNGs being rendered are finished
+    global _executor
+    with _lock:
+        for future in _jobs.values():
+            future.cancel()
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+        _jobs.clear()
+        _writers.clear()
+        _failures.clear()
@@ -0,0 +1,45 @@
+from typing import List, Optional, Sequence
+import geopandas as gpd
+
+try:
+    import pyogrio
+except ImportError:
+    pyogrio = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    import fiona
+except ImportError:
+    fiona = None
+
+
+def available_columns(path: str) -> List[str]:
+    # Attribute columns of the file, read from its header only
+    if pyogrio is not None:
+        return list(pyogrio.read_info(path)["fields"])
+    with fiona.open(path) as src:
+        return list(src.schema["properties"])
+
+
+def read_shapefile(path: str, columns: Optional[Sequence[str]] = None) -> gpd.GeoDataFrame:
+    '''
+    Read a shapefile (or any file GDAL can open) into a GeoDataFrame with only the given attribute columns and the geometry.
+    Columns that are missing from the file are skipped, the steps that need them raise as before. None reads every column.
+    Uses pyogrio with Arrow when they are installed, which is several times faster than fiona on wide EYDAP exports.
+    '''
+    if columns is not None:
+        present = set(available_columns(path))
+        columns = [column for column in columns if column in present]
+
+    if pyogrio is not None:
+        return gpd.read_file(path, engine="pyogrio", columns=columns, use_arrow=pyarrow is not None)
+
+    if columns is None:
+        return gpd.read_file(path)
+
+    # fiona only parses the requested fields, an empty list keeps the geometry alone
+    return gpd.read_file(path, include_fields=columns)
@@ -0,0 +1,109 @@
+from typing import NamedTuple, Optional
+import hashlib
+import os
+import geopandas as gpd
+import libpysal as lps
+import numpy as np
+import pandas as pd
+from src.shapefile_io import read_shapefile
+
+
+# Bump when the cached fields or their meaning change, so that older entries are ignored
+SWEEP_CACHE_VERSION = 3
+
+
+class SweepSize(NamedTuple):
+    fishnet_failures: gpd.GeoDataFrame  # Cells with failures and their metrics, as square_size_moran computes them
+    w: lps.weights.W  # Row standardised Queen weights of those cells, the ids are their positions
+    n_cols: int  # Number of columns of the full fishnet, to rebuild the weights of a subset of the cells
+    pipe_cells: pd.DataFrame  # 'fishnet_index' and pipe 'LABEL' of every pipe that intersects one of those cells
+
+
+def sweep_cache_key(pipe_shapefile_path: str, failures_shapefile_path: str, weight_avg_combined_metric: float, weight_failures: float) -> str:
+    '''
+    Content hash of the inputs of a step 2 sweep: the geometry (.shp) and attribute (.dbf) files of the pipes and of the
+    failures together with the two weights. A cached size is only reused by step 2b when all of them are unchanged.
+    '''
+    digest = hashlib.sha256()
+
+    for path in (pipe_shapefile_path, failures_shapefile_path):
+        for extension in (".shp", ".dbf"):
+            part = os.path.splitext(path)[0] + extension
+            if not os.path.exists(part):
+                continue
+            with open(part, "rb") as file:
+                for chunk in iter(lambda: file.read(1 << 20), b""):
+                    digest.update(chunk)
+
+    digest.update(repr((float(weight_avg_combined_metric), float(weight_failures), SWEEP_CACHE_VERSION)).encode())
+    return digest.hexdigest()
+
+
+def sweep_cache_path(output_path: str, square_size: int) -> str:
+    # The cells are kept in a GeoPackage next to this file, which holds the key, the weights and the pipes of the cells.
+    # Neither file format runs code when it is read, so project folders from other users are safe to open
+    return os.path.join(output_path, f"{square_size}_sweep_cache.npz")
+
+
+def _cells_path(output_path: str, square_size: int) -> str:
+    return os.path.join(output_path, f"{square_size}_sweep_cache.gpkg")
+
+
+def load_sweep_size(output_path: str, square_size: int, key: str) -> Optional[SweepSize]:
+    path = sweep_cache_path(output_path, square_size)
+    cells_path = _cells_path(output_path, square_size)
+
+    if not (os.path.exists(path) and os.path.exists(cells_path)):
+        return None
+
+    try:
+        with np.load(path, allow_pickle=False) as entry:
+            if str(entry["key"]) != key:
+                return None
+            n_cols = int(entry["n_cols"])
+            cardinalities, neighbours = entry["cardinalities"], entry["neighbours"]
+            pipe_cells = pd.DataFrame({"fishnet_index": entry["pipe_cells"], "LABEL": entry["pipe_labels"]})
+        fishnet_failures = read_shapefile(cells_path).set_index("cell")
+    except (OSError, KeyError, ValueError):
+        return None  # A corrupt or half written entry is treated as a miss and will be overwritten
+
+    if len(fishnet_failures) != len(cardinalities):
+        return None
+    fishnet_failures.index.name = None
+
+    # The ids of the weights are the positions of the cells, as fishnet_queen_weights builds them
+    groups = np.split(neighbours, np.cumsum(cardinalities)[:-1]) if len(cardinalities) else []
+    w = lps.weights.W({i: group.tolist() for i, group in enumerate(groups)}, silence_warnings=True)
+    w.transform = 'r'
+    return SweepSize(fishnet_failures, w, n_cols, pipe_cells)
+
+
+def save_sweep_size(output_path: str, square_size: int, key: str, sweep_size: SweepSize) -> None:
+    path = sweep_cache_path(output_path, square_size)
+    cells_path = _cells_path(output_path, square_size)
+
+    fishnet_failures = sweep_size.fishnet_failures
+    ids = range(len(fishnet_failures))
+    cardinalities = np.array([len(sweep_size.w.neighbors[i]) for i in ids], dtype=np.int64)
+    neighbours = np.array([j for i in ids for j in sweep_size.w.neighbors[i]], dtype=np.int64)
+
+    # Labels are kept as numbers or as text, never as Python objects
+    labels = sweep_size.pipe_cells["LABEL"].to_numpy()
+    if labels.dtype.kind not in "iuf":
+        labels = labels.astype(str)
+
+    # The key file goes last and is removed first, so a crash never pairs cells with the key of another sweep.
+    # Write to temporary files first so that a crash never leaves a truncated entry behind
+    if os.path.exists(path):
+        os.remove(path)
+
+    tmp_cells_path = cells_path + ".tmp.gpkg"
+    if os.path.exists(tmp_cells_path):
+        os.remove(tmp_cells_path)
+    fishnet_failures.rename_axis("cell").reset_index().to_file(tmp_cells_path, driver="GPKG")
+    os.replace(tmp_cells_path, cells_path)
+
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, key=np.array(key), n_cols=np.array(sweep_size.n_cols), cardinalities=cardinalities, neighbours=neighbours,
+             pipe_cells=sweep_size.pipe_cells["fishnet_index"].to_numpy(dtype=np.int64), pipe_labels=labels)
+    os.replace(tmp_path, path)
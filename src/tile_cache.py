@@ -0,0 +1,197 @@
+from typing import Iterable, Optional, Tuple
+import io
+import os
+import sqlite3
+import time
+import contextily as ctx
+import mercantile as mt
+import numpy as np
+import requests
+from matplotlib import patheffects
+from PIL import Image
+from rasterio.warp import transform_bounds
+
+
+TILE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".prt_cache", "tiles")
+
+# Extra zoom levels above the one of the whole network that seed_tiles downloads, for the maps of smaller extents
+SEED_EXTRA_ZOOMS = 2
+
+# Number of warped basemap layers kept in memory by basemap_layer
+LAYER_CACHE_SIZE = 4
+
+# Consecutive connection errors after which the tiles are only read from the cache, for OFFLINE_RETRY_SECONDS
+OFFLINE_AFTER_ERRORS = 3
+OFFLINE_RETRY_SECONDS = 60
+
+_layers = {}
+_connection_errors = 0
+_offline_until = 0.0  # time.monotonic() until which no download is tried
+
+
+def tile_cache_path(provider) -> str:
+    return os.path.join(TILE_CACHE_DIR, provider.name + ".mbtiles")
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    # MBTiles layout: the tiles table keeps the rows in the TMS scheme (counted from the south)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")  # The processes of a square size sweep read and write the same file
+    conn.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)")
+    return conn
+
+
+def fetch_tile(provider, tile: mt.Tile, conn: sqlite3.Connection) -> Optional[bytes]:
+    '''
+    Image of one XYZ tile from the cache, downloaded and stored when it is missing. Returns None when the tile is not
+    cached and cannot be downloaded. An HTTP error (a missing tile, a rate limit) only skips that tile; after
+    OFFLINE_AFTER_ERRORS connection errors in a row the downloads are skipped for OFFLINE_RETRY_SECONDS, so a machine
+    without internet does not wait for a timeout per tile and an online session gets its basemaps back afterwards.
+    '''
+    global _connection_errors, _offline_until
+    row = (1 << tile.z) - 1 - tile.y
+    cached = conn.execute("SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?", (tile.z, tile.x, row)).fetchone()
+    if cached is not None:
+        return cached[0]
+
+    if time.monotonic() < _offline_until:
+        return None
+
+    try:
+        response = requests.get(provider.build_url(x=tile.x, y=tile.y, z=tile.z), headers={"user-agent": ctx.tile.USER_AGENT}, timeout=10)
+        response.raise_for_status()
+    except requests.HTTPError:
+        _connection_errors = 0
+        return None
+    except requests.RequestException:
+        _connection_errors += 1
+        if _connection_errors >= OFFLINE_AFTER_ERRORS:
+            _connection_errors = 0
+            _offline_until = time.monotonic() + OFFLINE_RETRY_SECONDS
+        return None
+
+    _connection_errors = 0
+
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", (tile.z, tile.x, row, response.content))
+        conn.execute("INSERT OR IGNORE INTO metadata VALUES ('name', ?), ('format', 'png')", (provider.name,))
+    return response.content
+
+
+def basemap_zoom(w: float, s: float, e: float, n: float, provider) -> int:
+    # Same automatic zoom as contextily for a longitude/latitude box, limited to the zoom levels of the provider
+    zoom = int(min(np.ceil(np.log2(720.0 / (e - w))), np.ceil(np.log2(720.0 / (n - s)))))
+    return int(np.clip(zoom, provider.get("min_zoom", 0), provider.get("max_zoom", 22)))
+
+
+def basemap_image(w: float, s: float, e: float, n: float, zoom: int, provider) -> Tuple[Optional[np.ndarray], Tuple[float, float, float, float]]:
+    '''
+    RGBA mosaic of the tiles over a longitude/latitude box and its (left, right, bottom, top) extent in Web Mercator,
+    as contextily.bounds2img returns it but read through the tile cache. Tiles that are neither cached nor downloadable
+    stay transparent; the image is None when none of them is available.
+    '''
+    tiles = list(mt.tiles(w, s, e, n, zooms=[zoom]))
+    conn = _connect(tile_cache_path(provider))
+    try:
+        arrays = [fetch_tile(provider, tile, conn) for tile in tiles]
+    finally:
+        conn.close()
+
+    xs = np.array([tile.x for tile in tiles])
+    ys = np.array([tile.y for tile in tiles])
+    west, north = mt.xy(*mt.ul(xs.min(), ys.min(), zoom))
+    east, south = mt.xy(*mt.ul(xs.max() + 1, ys.max() + 1, zoom))
+    extent = (west, east, south, north)
+
+    if all(data is None for data in arrays):
+        return None, extent
+
+    size = 256
+    img = np.zeros(((ys.max() - ys.min() + 1) * size, (xs.max() - xs.min() + 1) * size, 4), dtype=np.uint8)
+    for tile, data in zip(tiles, arrays):
+        if data is None:
+            continue
+        array = np.asarray(Image.open(io.BytesIO(data)).convert("RGBA").resize((size, size)))
+        row, col = (tile.y - ys.min()) * size, (tile.x - xs.min()) * size
+        img[row:row + size, col:col + size] = array
+    return img, extent
+
+
+def basemap_layer(extent: Tuple[float, float, float, float], crs: Optional[str] = None, source=None,
+                  zoom="auto") -> Tuple[Optional[np.ndarray], Optional[Tuple[float, float, float, float]]]:
+    '''
+    Basemap image over a (xmin, xmax, ymin, ymax) extent in crs and the extent of the image, warped to crs, or
+    (None, None) when no tile is available. The last layers are kept in memory, so maps with the same extent (the four
+    maps of step 1, the choropleths of a sweep) fetch and warp the tiles once.
+    '''
+    provider = ctx.providers.CartoDB.Positron if source is None else source
+    key = (tuple(float(value) for value in extent), crs, provider.name, zoom)
+    if key in _layers:
+        return _layers[key]
+
+    xmin, xmax, ymin, ymax = extent
+    w, s, e, n = transform_bounds(crs or "EPSG:3857", "EPSG:4326", xmin, ymin, xmax, ymax)
+
+    if zoom == "auto":
+        zoom = basemap_zoom(w, s, e, n, provider)
+
+    image, image_extent = basemap_image(w, s, e, n, zoom, provider)
+    if image is None:
+        return None, None
+
+    if crs is not None:
+        image, image_extent = ctx.warp_tiles(image, image_extent, t_crs=crs)
+
+    if len(_layers) >= LAYER_CACHE_SIZE:
+        _layers.pop(next(iter(_layers)))
+    _layers[key] = (image, image_extent)
+    return image, image_extent
+
+
+def add_basemap(ax, crs: Optional[str] = None, source=None, zoom="auto") -> None:
+    '''
+    Drop-in replacement of contextily.add_basemap for the maps of the tool: the tiles come from an MBTiles file per
+    provider in TILE_CACHE_DIR, so the same tiles are downloaded once for all the maps and runs, and the maps are
+    drawn on machines without internet from the tiles seeded by seed_tiles. Without any tile the map has no basemap.
+    '''
+    provider = ctx.providers.CartoDB.Positron if source is None else source
+    xmin, xmax, ymin, ymax = ax.axis()
+    image, extent = basemap_layer((xmin, xmax, ymin, ymax), crs, provider, zoom)
+    if image is None:
+        print("Basemap tiles are not available offline, the map is drawn without a basemap")
+        return
+
+    ax.imshow(image, extent=extent, interpolation="bilinear", aspect=ax.get_aspect())
+    ax.axis((xmin, xmax, ymin, ymax))
+    add_attribution(ax, provider.get("attribution"))
+
+
+def add_attribution(ax, text: str) -> None:
+    # The attribution text of contextily.add_attribution, without its pyplot draw() that opens a figure in pyplot for
+    # the figures of src.figures; the text is wrapped when the figure is drawn
+    ax.text(0.005, 0.005, text, transform=ax.transAxes, size=ctx.plotting.ATTRIBUTION_SIZE,
+            path_effects=[patheffects.withStroke(linewidth=2, foreground="w")], wrap=True)
+
+
+def seed_tiles(total_bounds, crs: str, zooms: Optional[Iterable[int]] = None, source=None) -> int:
+    '''
+    Download into the cache the tiles over total_bounds (in crs) at the given zoom levels, by default the zoom of the
+    whole area and the SEED_EXTRA_ZOOMS levels above it. Returns the number of tiles that are now available.
+    '''
+    global _connection_errors, _offline_until
+    _connection_errors, _offline_until = 0, 0.0
+    provider = ctx.providers.CartoDB.Positron if source is None else source
+    w, s, e, n = transform_bounds(crs, "EPSG:4326", *total_bounds)
+
+    if zooms is None:
+        zoom = basemap_zoom(w, s, e, n, provider)
+        zooms = range(zoom, min(zoom + SEED_EXTRA_ZOOMS, provider.get("max_zoom", 22)) + 1)
+
+    conn = _connect(tile_cache_path(provider))
+    try:
+        return sum(fetch_tile(provider, tile, conn) is not None for tile in mt.tiles(w, s, e, n, zooms=list(zooms)))
+    finally:
+        conn.close()
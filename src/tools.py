@@ -3,9 +3,9 @@ import pandas as pd
 import math
 import numpy as np
 import geopandas as gpd
-from shapely import geometry
+import shapely
 import libpysal as lps
-from esda.moran import Moran, Moran_Local
+from esda.moran import Moran_Local
 from splot.esda import lisa_cluster
 from kneed import KneeLocator
 import matplotlib.pyplot as plt
@@ -23,67 +23,51 @@ import contextily as ctx
 import matplotlib.colors as mcolors
 import warnings
 import os
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import spearmanr
+from src.graph_engine import csr_centralities, networkx_centralities, contract_degree2_chains, pivots_for_accuracy, pivot_error_bound
+from src.centrality_cache import network_hash, centrality_cache_key, load_centralities, save_centralities
+from src.const import CENTRALITY_ENGINES, CENTRALITY_DISTANCES, NETWORK_COLUMNS, P_VALUE_THRESHOLDS, MORAN_PERMUTATIONS, MORAN_SEED, MORAN_INFERENCES, SQUARE_SIZE_SEARCHES, \
+    SQUARE_SIZE_MIN_STEP, BASE_SIZE_MIN_FRACTION
+from src.moran import moran_permutations, moran_analytic
+from src.shapefile_io import read_shapefile
+from src.sweep_cache import SweepSize, sweep_cache_key, load_sweep_size, save_sweep_size
+from src.tile_cache import add_basemap
+from src.backdrop import render_backdrop, draw_backdrop
+from src.render_pool import is_rendering, submit_render
+from src.figures import agg_subplots
+from src.memory_usage import PeakMemory
 
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 #### STEP1
-def process_shapefile(shp_path, weight_closeness, weight_betweenness, weight_bridge, output_path):
-    # Load the shapefile as geodataframe and convert to EPSG 2100
-    gdf = gpd.read_file(shp_path)
-    gdf = gdf.to_crs(epsg=2100)
-
-    # Convert the GeoDataFrame into a graph
-    G = momepy.gdf_to_nx(gdf, approach='primal')
-
-    # Extract nodes and edges
-    nodes, edges = momepy.nx_to_gdf(G)
-
-    # Find bridges in the graph
-    bridges = list(nx.bridges(G))
-
-    # Function to check if an edge is a bridge
-    def is_bridge(edge_row):
-        start_coord = (edge_row['geometry'].coords[0])
-        end_coord = (edge_row['geometry'].coords[-1])
-        return any([(start_coord, end_coord) in bridges, (end_coord, start_coord) in bridges])
-
-    # Create a list of nodes
-    list_of_nodes = list(G.nodes(data=True))
-
-    # Calculate centralities for nodes
-    closeness_centrality = nx.closeness_centrality(G)
-    betweenness_centrality = nx.betweenness_centrality(G)
-
-    # Create a mapping from node ID to centrality values
-    closeness_centrality_mapping = {}
-    betweenness_centrality_mapping = {}
-
-    for (x, y), attrs in list_of_nodes:
-        node_id = attrs['nodeID']
-        coords = (x, y)
-        closeness_centrality_mapping[node_id] = closeness_centrality[coords]
-        betweenness_centrality_mapping[node_id] = betweenness_centrality[coords]
-
-    # Add the two metrics as columns in the edges data frame
-    edges['cc'] = (edges['node_start'].map(closeness_centrality_mapping) + edges['node_end'].map(closeness_centrality_mapping)) / 2
-    edges['bc'] = (edges['node_start'].map(betweenness_centrality_mapping) + edges['node_end'].map(betweenness_centrality_mapping)) / 2
-
-    # Normalize the 'closeness_centrality' and 'betweenness_centrality' columns
-    edges['cc_norm'] = (edges['cc'] - edges['cc'].min()) / (edges['cc'].max() - edges['cc'].min())
-    edges['bc_norm'] = (edges['bc'] - edges['bc'].min()) / (edges['bc'].max() - edges['bc'].min())
-
-    # Add a 'is_bridge' column to the edges DataFrame
-    edges['is_bridge'] = 0  # Initialize all values as 0
-
-    for index, row in edges.iterrows():
-      # Assign 1 if the edge is a bridge, otherwise 0
-      edges.at[index, 'is_bridge'] = 1 if is_bridge(row) else 0
+# PNG files of the maps of plot_metrics
+METRIC_MAP_FILES = {"closeness": "cc_map.png", "betweenness": "bc_map.png", "bridge": "bridge_map.png", "composite": "cm_map.png"}
+
+def process_shapefile(shp_path, weight_closeness, weight_betweenness, weight_bridge, output_path, engine="networkx", workers=1,
+                      betweenness_k=None, betweenness_accuracy=None, seed=42, use_cache=True, contract_chains=False, distance="hops"):
+    # engine: "networkx" runs the networkx algorithms on the momepy graph, "csr" converts the graph once into
+    # integer-indexed CSR arrays and runs compiled versions of the same algorithms (identical exact results, much
+    # faster; a sampled betweenness is rescaled like networkx >= 3.5, see graph_engine.betweenness_centrality)
+    # workers: number of processes the centralities are spread over, along the connected components of the network
+    # betweenness_k / betweenness_accuracy: estimate betweenness from k pivot sources instead of all nodes, either
+    # given directly or derived from the target accuracy on the normalised betweenness. The pivots are drawn
+    # with the fixed seed, so repeated runs give the same map
+    # use_cache: the centralities only depend on the network, so they are cached on disk under a hash of its
+    # content and any later run on the same network (new scenario or new weights) only recomputes 'cm'
+    # contract_chains: calculate the metrics on the graph without its degree 2 nodes (see centrality_columns)
+    # distance: "hops" counts every pipe as one step of a shortest path, "length" uses the pipe lengths (see pipe_lengths)
+    gdf, G, nodes, edges, network, betweenness_k = network_centralities(shp_path, engine, workers, betweenness_k, betweenness_accuracy, seed, use_cache, contract_chains, distance)
+
+    if betweenness_k is not None:
+        # Compare against the exact run of the same network, if one has been cached
+        exact = load_centralities(centrality_cache_key(network, contract_chains=contract_chains, distance=distance))
+        exact_bc = exact['bc'] if exact is not None else None
+        edges.attrs['betweenness_sampling'] = betweenness_sampling_report(edges, G.number_of_nodes(), betweenness_k, seed, output_path, exact_bc)
 
     # Calculate the composite metric
-    edges['cm'] = ((edges['cc_norm'] * weight_closeness) +
-                   (edges['bc_norm'] * weight_betweenness) +
-                   (edges['is_bridge'] * weight_bridge))
+    edges['cm'] = composite_metric(edges, weight_closeness, weight_betweenness, weight_bridge)
 
     # Create a new DataFrame df_metrics as a copy of edges
     df_metrics = edges.copy(deep=True)
@@ -113,29 +97,215 @@ def process_shapefile(shp_path, weight_closeness, weight_betweenness, weight_bri
     return gdf, G, nodes, edges, df_metrics
 
 
-def plot_metrics(gdf, G, nodes, edges, plot_metrics, figsize, plot, output_path):
+def network_centralities(shp_path, engine="networkx", workers=1, betweenness_k=None, betweenness_accuracy=None, seed=42, use_cache=True, contract_chains=False,
+                         distance="hops", columns=None):
+    # Load the network and add the weight independent columns of step 1 to its edges (see centrality_columns),
+    # from the on-disk cache when this network has been analysed before with the same betweenness settings.
+    # Returns the resolved number of pivots (None for exact) together with the network hash
+    # columns: the attribute columns of the shapefile kept on the edges, None keeps all of them for the export of step 1
+    if engine not in CENTRALITY_ENGINES:
+        raise ValueError(f"Invalid centrality engine: {engine}")
+    if distance not in CENTRALITY_DISTANCES:
+        raise ValueError(f"Invalid distance: {distance}")
+
+    # Load the shapefile as geodataframe and convert to EPSG 2100
+    gdf = read_shapefile(shp_path, columns)
+    gdf = gdf.to_crs(epsg=2100)
+
+    # Convert the GeoDataFrame into a graph
+    G = momepy.gdf_to_nx(gdf, approach='primal')
+
+    # Extract nodes and edges
+    nodes, edges = momepy.nx_to_gdf(G)
+
+    # Number of pivot sources for the betweenness, None means exact
+    n = G.number_of_nodes()
+    if betweenness_accuracy is not None:
+        betweenness_k = pivots_for_accuracy(n, betweenness_accuracy)
+    if betweenness_k is not None:
+        if betweenness_k < 1:
+            raise ValueError("The number of pivots must be a positive integer")
+        betweenness_k = int(betweenness_k)
+        if betweenness_k >= n:
+            betweenness_k = None
+
+    # The length weighted metrics also depend on the pipe lengths, which the user can edit in USER_L
+    network = network_hash(edges, pipe_lengths(edges) if distance == "length" else None)
+    cache_key = centrality_cache_key(network, betweenness_k, seed, engine, contract_chains, distance)
+    cached = load_centralities(cache_key) if use_cache else None
+
+    if cached is not None:
+        for column, values in cached.items():
+            edges[column] = values
+    else:
+        centrality_columns(G, edges, engine, workers, betweenness_k, seed, contract_chains, distance)
+        columns = ['cc', 'bc', 'cc_norm', 'bc_norm', 'is_bridge'] + (['bc_err'] if betweenness_k is not None else [])
+        save_centralities(cache_key, edges[columns])
+
+    return gdf, G, nodes, edges, network, betweenness_k
+
+
+def centrality_columns(G, edges, engine, workers, betweenness_k, seed, contract_chains=False, distance="hops"):
+    # Calculate the closeness, betweenness and bridges of the graph and add them to the edges as the columns
+    # 'cc', 'bc', 'cc_norm', 'bc_norm', 'is_bridge' and, for a sampled betweenness, 'bc_err' (its 95% error, in the
+    # units of 'bc').
+    # contract_chains: pipes split at every valve and fitting form chains of degree 2 nodes. They are replaced by
+    # super-edges weighted by their number of pipes, the metrics are calculated on this much smaller graph and
+    # every pipe of a chain takes the values of its super-edge (the mean of the two nodes at the ends of the chain)
+    # distance: with "length" the shortest paths are measured in metres instead of number of pipes
+    start = edges['node_start'].to_numpy()
+    end = edges['node_end'].to_numpy()
+    lengths = pipe_lengths(edges)
+
+    if contract_chains:
+        contraction = contract_degree2_chains(start, end, G.number_of_nodes(), lengths)
+        graph = contraction.to_networkx()
+        weight = 'length' if distance == "length" else 'hops'
+        node_id_mapping = {node: node for node in graph.nodes}
+        start = contraction.super_start[contraction.edge_super]
+        end = contraction.super_end[contraction.edge_super]
+    else:
+        graph = G
+        weight = None
+        node_id_mapping = {coords: attrs['nodeID'] for coords, attrs in G.nodes(data=True)}
+        if distance == "length":
+            # The edges of the momepy graph are in the same order as the rows of its edges data frame
+            for (_, _, data), length in zip(G.edges(data=True), lengths):
+                data['pipe_length'] = length
+            weight = 'pipe_length'
+
+    n = graph.number_of_nodes()
+
+    # The contracted graph can have fewer nodes than the requested pivots, all of them are used then
+    pivots = betweenness_k if betweenness_k is not None and betweenness_k < n else None
+
+    # Find bridges in the graph and calculate centralities for nodes
+    if engine == "csr":
+        closeness_centrality, betweenness_centrality, bridges, betweenness_stderr = csr_centralities(graph, workers, pivots, seed, weight)
+        # 95% confidence half-width from the standard error of the pivot sample
+        betweenness_error = {node: 1.96 * value for node, value in betweenness_stderr.items()}
+    else:
+        closeness_centrality, betweenness_centrality, bridges = networkx_centralities(graph, workers, pivots, seed, weight)
+        # networkx gives no per node variance, use the (conservative) Hoeffding bound for all nodes. It bounds the
+        # error of the normalised betweenness of networkx, the same units as 'bc'
+        bound = pivot_error_bound(n, pivots) if pivots is not None else 0.0
+        betweenness_error = {node: bound for node in graph.nodes}
+
+    # Create a mapping from node ID to centrality values
+    closeness_centrality_mapping = {}
+    betweenness_centrality_mapping = {}
+    betweenness_error_mapping = {}
+
+    for node, node_id in node_id_mapping.items():
+        closeness_centrality_mapping[node_id] = closeness_centrality[node]
+        betweenness_centrality_mapping[node_id] = betweenness_centrality[node]
+        betweenness_error_mapping[node_id] = betweenness_error[node]
+
+    start = pd.Series(start, index=edges.index)
+    end = pd.Series(end, index=edges.index)
+
+    # Add the two metrics as columns in the edges data frame
+    edges['cc'] = (start.map(closeness_centrality_mapping) + end.map(closeness_centrality_mapping)) / 2
+    edges['bc'] = (start.map(betweenness_centrality_mapping) + end.map(betweenness_centrality_mapping)) / 2
+
+    # Normalize the 'closeness_centrality' and 'betweenness_centrality' columns
+    edges['cc_norm'] = (edges['cc'] - edges['cc'].min()) / (edges['cc'].max() - edges['cc'].min())
+    edges['bc_norm'] = (edges['bc'] - edges['bc'].min()) / (edges['bc'].max() - edges['bc'].min())
+
+    if betweenness_k is not None:
+        # Error of the edge mean, in the units of 'bc'. It is not carried through the min-max normalisation: the range
+        # of 'bc' is often smaller than the bound of the networkx engine, which would then cover the whole scale
+        edges['bc_err'] = (start.map(betweenness_error_mapping) + end.map(betweenness_error_mapping)) / 2
+
+    # Add a 'is_bridge' column to the edges DataFrame. The bridges are turned into (smaller, larger) node ID pairs
+    # and the edges are flagged with a single hashed lookup on their start and end node IDs
+    bridge_pairs = pd.MultiIndex.from_tuples(
+        [tuple(sorted((node_id_mapping[u], node_id_mapping[v]))) for u, v in bridges], names=['lo', 'hi'])
+    edge_pairs = pd.MultiIndex.from_arrays([np.minimum(start, end), np.maximum(start, end)], names=['lo', 'hi'])
+    edges['is_bridge'] = edge_pairs.isin(bridge_pairs).astype(int)
+
+    return edges
+
+
+def pipe_lengths(edges):
+    # Length of every pipe for the length weighted shortest paths, the USER_L attribute where it is given and the
+    # length of the geometry (metres in EPSG 2100) for the pipes without it
+    lengths = edges.geometry.length.to_numpy()
+    if 'USER_L' in edges:
+        user_lengths = pd.to_numeric(edges['USER_L'], errors='coerce').to_numpy(dtype=float)
+        lengths = np.where(np.isfinite(user_lengths) & (user_lengths > 0), user_lengths, lengths)
+    return lengths
+
+
+def composite_metric(edges, weight_closeness, weight_betweenness, weight_bridge):
+    # Weighted sum of the normalised metrics, the only part of step 1 that depends on the weights
+    return ((edges['cc_norm'] * weight_closeness) +
+            (edges['bc_norm'] * weight_betweenness) +
+            (edges['is_bridge'] * weight_bridge))
+
+
+def betweenness_sampling_report(edges, n, k, seed, output_path, exact_bc=None):
+    # Summarise the estimated error of a sampled betweenness run and, when the exact edge betweenness of the same
+    # network is given, the rank correlation of the sampled values against it. The summary is also written to a text file
+    report = {
+        'nodes': n,
+        'pivots': k,
+        'seed': seed,
+        'mean_error': float(edges['bc_err'].mean()),
+        'max_error': float(edges['bc_err'].max()),
+        'rank_correlation': None,
+    }
+
+    if exact_bc is not None and len(exact_bc) == len(edges):
+        report['rank_correlation'] = float(spearmanr(exact_bc, edges['bc'].values).correlation)
+
+    with open(output_path + "betweenness_sampling.txt", 'w') as file:
+        file.write(f"Nodes: {n}\n")
+        file.write(f"Pivot sources: {k} (seed {seed})\n")
+        file.write(f"Mean estimated error on the betweenness (95%): {report['mean_error']:.4g}\n")
+        file.write(f"Max estimated error on the betweenness (95%): {report['max_error']:.4g}\n")
+        file.write(f"Range of the betweenness: {edges['bc'].min():.4g} - {edges['bc'].max():.4g}\n")
+        if report['rank_correlation'] is not None:
+            file.write(f"Spearman rank correlation with the exact run: {round(report['rank_correlation'], 4)}\n")
+        else:
+            file.write("No exact run of this network is available for comparison\n")
+
+    return report
+
+
+def plot_metrics(gdf, G, nodes, edges, plot_metrics, figsize, plot, output_path, background=False):
     # Check if plot_metrics is a list, if not convert it to a list
     if not isinstance(plot_metrics, list):
         plot_metrics = [plot_metrics]
 
+    # With background the maps are saved by the render pool, all of them in parallel and without waiting for them.
+    # Only the geometry and the metric columns of the edges are sent to it
+    metric_edges = edges[['geometry', 'cc_norm', 'bc_norm', 'is_bridge', 'cm']]
+
+    for plot_metric in plot_metrics:
+        if background and not plot and plot_metric in METRIC_MAP_FILES:
+            submit_render(output_path + METRIC_MAP_FILES[plot_metric], plot_metric_map, metric_edges, plot_metric, figsize, plot, output_path)
+        else:
+            plot_metric_map(edges, plot_metric, figsize, plot, output_path)
+
+
+def plot_metric_map(edges, plot_metric, figsize, plot, output_path):
+    # One map of plot_metrics, shown or saved as output_path + METRIC_MAP_FILES[plot_metric]
     # Define the colormap
     cmap = plt.cm.RdYlGn.reversed()
 
     # Define the tiles server
     prov = ctx.providers.CartoDB.Positron
 
-    # Number of plots
-    num_plots = len(plot_metrics)
-
-    for _, plot_metric in enumerate(plot_metrics):
+    # The figure is released as soon as the map is shown or saved
+    with agg_subplots((figsize, figsize), interactive=plot) as (fig, ax):
         if plot_metric == "closeness":
             metric_data = edges["cc_norm"]
             metric_title = "Closeness Centrality"
-            fig, ax = plt.subplots(figsize=(figsize, figsize))
             edges.plot(
                 ax=ax, linewidth=3, edgecolor=edges["cc_norm"].apply(lambda x: cmap(x))
             )
-            ctx.add_basemap(ax, crs=edges.crs.to_string(), source=prov)
+            add_basemap(ax, crs=edges.crs.to_string(), source=prov)
             ax.set_title("Closeness Centrality Map")
 
             # Create a colorbar with the colormap
@@ -147,21 +317,20 @@ def plot_metrics(gdf, G, nodes, edges, plot_metrics, figsize, plot, output_path)
             cbar.set_label("Normalized Closeness Centrality")
 
             ax.axis("off")
-            plt.tight_layout()
+            fig.tight_layout()
             if plot:
                 plt.show()
             else:
-                plt.savefig(output_path + "cc_map.png")
+                fig.savefig(output_path + METRIC_MAP_FILES["closeness"])
 
         elif plot_metric == "betweenness":
             metric_data = edges["bc_norm"]
             metric_title = "Betweenness Centrality"
             # Plot for Betweenness Centrality
-            fig, ax = plt.subplots(figsize=(figsize, figsize))
             edges.plot(
                 ax=ax, linewidth=3, edgecolor=edges["bc_norm"].apply(lambda x: cmap(x))
             )
-            ctx.add_basemap(ax, crs=edges.crs.to_string(), source=prov)
+            add_basemap(ax, crs=edges.crs.to_string(), source=prov)
             ax.set_title("Betweenness Centrality Map")
 
             # Create a colorbar with the colormap
@@ -173,17 +342,16 @@ def plot_metrics(gdf, G, nodes, edges, plot_metrics, figsize, plot, output_path)
             cbar.set_label("Normalized Betweenness Centrality")
 
             ax.axis("off")
-            plt.tight_layout()
+            fig.tight_layout()
             if plot:
                 plt.show()
             else:
-                plt.savefig(output_path + "bc_map.png")
+                fig.savefig(output_path + METRIC_MAP_FILES["betweenness"])
 
         elif plot_metric == "bridge":
             metric_data = edges["is_bridge"]
             metric_title = "Bridge Identification"
             # Plot the bridge metric
-            fig, ax = plt.subplots(figsize=(figsize, figsize))
 
             # Plot the edges
             edges_color = edges["is_bridge"].apply(
@@ -192,7 +360,7 @@ def plot_metrics(gdf, G, nodes, edges, plot_metrics, figsize, plot, output_path)
             edges.plot(ax=ax, linewidth=3, edgecolor=edges_color)
 
             # Add a basemap
-            ctx.add_basemap(ax, crs=edges.crs.to_string(), source=prov)
+            add_basemap(ax, crs=edges.crs.to_string(), source=prov)
 
             # Set title
             ax.set_title("Bridge Identification Map")
@@ -216,22 +384,21 @@ def plot_metrics(gdf, G, nodes, edges, plot_metrics, figsize, plot, output_path)
 
             # Turn off axis
             ax.axis("off")
-            plt.tight_layout()
+            fig.tight_layout()
 
             if plot:
                 plt.show()
             else:
-                plt.savefig(output_path + "bridge_map.png")
+                fig.savefig(output_path + METRIC_MAP_FILES["bridge"])
 
         elif plot_metric == "composite":
             # Plot the composite metric
             # Define the colormap
             cmap = plt.cm.RdYlGn.reversed()
-            fig, ax = plt.subplots(figsize=(figsize, figsize))
             edges.plot(
                 ax=ax, linewidth=3, edgecolor=edges["cm"].apply(lambda x: cmap(x))
             )
-            ctx.add_basemap(ax, crs=edges.crs.to_string(), source=prov)
+            add_basemap(ax, crs=edges.crs.to_string(), source=prov)
             ax.set_title("Composite Metric Map")
 
             # Create a colorbar with the colormap
@@ -243,11 +410,11 @@ def plot_metrics(gdf, G, nodes, edges, plot_metrics, figsize, plot, output_path)
             cbar.set_label("Composite Metric")
 
             ax.axis("off")
-            plt.tight_layout()
+            fig.tight_layout()
             if plot:
                 plt.show()
             else:
-                plt.savefig(output_path + "cm_map.png")
+                fig.savefig(output_path + METRIC_MAP_FILES["composite"])
 
 
 def save_edge_gdf_shapefile(gdf, output_path):
@@ -260,30 +427,239 @@ def save_edge_gdf_shapefile(gdf, output_path):
     
 #### STEP2
 def read_shapefiles(pipe_shapefile_path, failures_shapefile_path):
-  pipe_gdf = gpd.read_file(pipe_shapefile_path).set_crs('EPSG:2100')
-  failures_gdf = gpd.read_file(failures_shapefile_path).set_crs('EPSG:2100')
+  # Only the combined metric and the label of the pipes are used by step 2, and only the location of the failures
+  pipe_gdf = read_shapefile(pipe_shapefile_path, ['LABEL', 'cm']).set_crs('EPSG:2100')
+  failures_gdf = read_shapefile(failures_shapefile_path, []).set_crs('EPSG:2100')
   return pipe_gdf, failures_gdf
 
 
-def create_fishnet(square_size, pipe_gdf):
-
-  total_bounds = pipe_gdf.total_bounds
+def fishnet_shape(square_size, total_bounds):
+  # Number of rows and columns of the fishnet, whose cells start at the lower left corner of the bounds and cover it
   minX, minY, maxX, maxY = total_bounds
-  x, y = (minX, minY)
-  geom_array = []
-
-  while y <= maxY:
-      while x <= maxX:
-          geom = geometry.Polygon([(x, y), (x, y + square_size), (x + square_size, y + square_size), (x + square_size, y), (x, y)])
-          geom_array.append(geom)
-          x += square_size
-      x = minX
-      y += square_size
-
-  fishnet = gpd.GeoDataFrame(geom_array, columns=['geometry']).set_crs('EPSG:2100')
+  n_cols = int(np.floor((maxX - minX) / square_size)) + 1
+  n_rows = int(np.floor((maxY - minY) / square_size)) + 1
+  return n_rows, n_cols
+
+
+def occupied_cells(square_size, total_bounds, occupied_by):
+  # Boolean (rows, columns) mask of the fishnet cells that intersect the bounding box of at least one geometry.
+  # A geometry on the border of two cells marks both, so the mask covers every cell an sjoin would match
+  minX, minY, _, _ = total_bounds
+  n_rows, n_cols = fishnet_shape(square_size, total_bounds)
+  bounds = np.vstack([gdf.geometry.bounds.to_numpy() for gdf in occupied_by])
+  bounds = bounds[~np.isnan(bounds).any(axis=1)]
+
+  eps = 1e-9  # Guards against the rounding of coordinates that lie on a cell border
+  col_lo = np.ceil((bounds[:, 0] - minX) / square_size - eps).astype(np.int64) - 1
+  col_hi = np.floor((bounds[:, 2] - minX) / square_size + eps).astype(np.int64)
+  row_lo = np.ceil((bounds[:, 1] - minY) / square_size - eps).astype(np.int64) - 1
+  row_hi = np.floor((bounds[:, 3] - minY) / square_size + eps).astype(np.int64)
+
+  inside = (col_hi >= 0) & (col_lo < n_cols) & (row_hi >= 0) & (row_lo < n_rows)
+  col_lo, col_hi = np.clip(col_lo[inside], 0, n_cols - 1), np.clip(col_hi[inside], 0, n_cols - 1)
+  row_lo, row_hi = np.clip(row_lo[inside], 0, n_rows - 1), np.clip(row_hi[inside], 0, n_rows - 1)
+
+  # Mark the cell range of every geometry on a 2D difference array, its cumulative sums count the geometries per cell
+  marks = np.zeros((n_rows + 1, n_cols + 1), dtype=np.int64)
+  np.add.at(marks, (row_lo, col_lo), 1)
+  np.add.at(marks, (row_lo, col_hi + 1), -1)
+  np.add.at(marks, (row_hi + 1, col_lo), -1)
+  np.add.at(marks, (row_hi + 1, col_hi + 1), 1)
+  return marks.cumsum(axis=0).cumsum(axis=1)[:n_rows, :n_cols] > 0
+
+
+def create_fishnet(square_size, pipe_gdf, occupied_by=None):
+  # Square grid over the bounds of the pipes, row by row from the lower left corner. The index of a cell is its
+  # position in the full grid, so with occupied_by (a list of GeoDataFrames) only the cells touching their
+  # geometries are created and they keep the same index as in the full grid
+  total_bounds = pipe_gdf.total_bounds
+  minX, minY, _, _ = total_bounds
+  n_rows, n_cols = fishnet_shape(square_size, total_bounds)
+
+  if occupied_by is None:
+      cells = np.arange(n_rows * n_cols)
+  else:
+      cells = np.flatnonzero(occupied_cells(square_size, total_bounds, occupied_by))
+
+  # The corners are computed from the grid line numbers, so neighbouring cells share their corners exactly
+  rows, cols = np.divmod(cells, n_cols)
+  x = minX + cols * square_size
+  y = minY + rows * square_size
+  x_right = minX + (cols + 1) * square_size
+  y_top = minY + (rows + 1) * square_size
+
+  fishnet = gpd.GeoDataFrame(geometry=shapely.box(x, y, x_right, y_top, ccw=False), index=cells).set_crs('EPSG:2100')
   return fishnet
 
 
+def fishnet_queen_weights(cells, n_cols):
+  # Queen contiguity weights of fishnet cells straight from their index (row * n_cols + column), the same as
+  # lps.weights.Queen.from_dataframe on the cell polygons: two cells are neighbours when they share an edge or a
+  # corner, i.e. when their rows and columns differ by at most one. The ids are the positions of the cells
+  cells = np.asarray(cells, dtype=np.int64)
+  order = np.argsort(cells)
+  sorted_cells = cells[order]
+  rows, cols = np.divmod(cells, n_cols)
+
+  focal, neighbour = [], []
+  for d_row in (-1, 0, 1):
+      for d_col in (-1, 0, 1):
+          if d_row == 0 and d_col == 0:
+              continue
+          r, c = rows + d_row, cols + d_col
+          target = r * n_cols + c
+          pos = np.minimum(np.searchsorted(sorted_cells, target), len(cells) - 1)
+          found = (r >= 0) & (c >= 0) & (c < n_cols) & (sorted_cells[pos] == target)
+          focal.append(np.flatnonzero(found))
+          neighbour.append(order[pos[found]])
+
+  focal, neighbour = np.concatenate(focal), np.concatenate(neighbour)
+  by_focal = np.lexsort((neighbour, focal))
+  focal, neighbour = focal[by_focal], neighbour[by_focal]
+  splits = np.searchsorted(focal, np.arange(1, len(cells)))
+  neighbors = {i: group.tolist() for i, group in enumerate(np.split(neighbour, splits))}
+  return lps.weights.W(neighbors)
+
+
+def point_cells(px, py, ids, square_size, total_bounds):
+  # (id, row, column) of every cell of the fishnet of create_fishnet that contains each point, a point on the border
+  # of cells belongs to all of them
+  minX, minY, _, _ = total_bounds
+  n_rows, n_cols = fishnet_shape(square_size, total_bounds)
+  col = np.floor((px - minX) / square_size).astype(np.int64)
+  row = np.floor((py - minY) / square_size).astype(np.int64)
+
+  # Points near a border may be rounded into the wrong cell or belong to several cells, they are tested
+  # against the exact corners that create_fishnet gives to the polygons of their neighbouring cells
+  frac_x = (px - minX) / square_size - col
+  frac_y = (py - minY) / square_size - row
+  near = (frac_x < 1e-6) | (frac_x > 1 - 1e-6) | (frac_y < 1e-6) | (frac_y > 1 - 1e-6)
+
+  inside = ~near & (row >= 0) & (row < n_rows) & (col >= 0) & (col < n_cols)
+  pairs = [(ids[inside], row[inside], col[inside])]
+  px, py, ids, row, col = px[near], py[near], ids[near], row[near], col[near]
+  for d_row in (-1, 0, 1):
+      for d_col in (-1, 0, 1):
+          r, c = row + d_row, col + d_col
+          left, bottom = minX + c * square_size, minY + r * square_size
+          right, top = minX + (c + 1) * square_size, minY + (r + 1) * square_size
+          inside = (r >= 0) & (r < n_rows) & (c >= 0) & (c < n_cols) & \
+                   (px >= left) & (px <= right) & (py >= bottom) & (py <= top)
+          pairs.append((ids[inside], r[inside], c[inside]))
+
+  return tuple(np.concatenate(column) for column in zip(*pairs))
+
+
+def grid_line_crossings(a0, b0, a1, b1, ids, origin, square_size):
+  # Points where the segments (a0, b0)-(a1, b1) cross the grid lines a = origin + k * square_size, as arrays of
+  # a, b and the id of the segment. Segments along a grid line are skipped, their ends and the crossings of the
+  # other axis cover them
+  lo, hi = np.minimum(a0, a1), np.maximum(a0, a1)
+  first = np.ceil((lo - origin) / square_size).astype(np.int64)
+  last = np.floor((hi - origin) / square_size).astype(np.int64)
+  counts = np.where(a0 != a1, np.maximum(last - first + 1, 0), 0)
+
+  # All the lines of every segment at once, segment i gets the lines first[i] ... last[i]
+  segment = np.repeat(np.arange(len(a0)), counts)
+  k = first[segment] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+  a = origin + k * square_size
+  keep = (a >= lo[segment]) & (a <= hi[segment])  # The divisions above can round one line too far
+  segment, a = segment[keep], a[keep]
+  b = b0[segment] + (a - a0[segment]) * (b1[segment] - b0[segment]) / (a1[segment] - a0[segment])
+  b = np.clip(b, np.minimum(b0, b1)[segment], np.maximum(b0, b1)[segment])
+  return a, b, ids[segment]
+
+
+def line_cells(gdf, square_size, total_bounds):
+  # (id, row, column) of every cell of the fishnet of create_fishnet that each (multi)line of gdf intersects. A grid
+  # traversal of every segment: a segment meets a cell either at one of its ends or where it crosses a grid line on
+  # the border of the cell, so the cells of these points are exactly the cells the line intersects
+  minX, minY, _, _ = total_bounds
+  parts, part_ids = shapely.get_parts(gdf.geometry.to_numpy(), return_index=True)
+  coords, vertex_parts = shapely.get_coordinates(parts, return_index=True)
+  vertex_ids = part_ids[vertex_parts]
+
+  segments = np.flatnonzero(vertex_parts[1:] == vertex_parts[:-1])
+  x0, y0 = coords[segments, 0], coords[segments, 1]
+  x1, y1 = coords[segments + 1, 0], coords[segments + 1, 1]
+  segment_ids = vertex_ids[segments]
+
+  xv, yv, id_v = grid_line_crossings(x0, y0, x1, y1, segment_ids, minX, square_size)
+  yh, xh, id_h = grid_line_crossings(y0, x0, y1, x1, segment_ids, minY, square_size)
+
+  px = np.concatenate([coords[:, 0], xv, xh])
+  py = np.concatenate([coords[:, 1], yv, yh])
+  ids = np.concatenate([vertex_ids, id_v, id_h])
+  ids, rows, cols = point_cells(px, py, ids, square_size, total_bounds)
+
+  # A line crosses most of its cells at more than one point
+  n_rows, n_cols = fishnet_shape(square_size, total_bounds)
+  ids, cells = np.divmod(np.unique(ids * (n_rows * n_cols) + rows * n_cols + cols), n_rows * n_cols)
+  rows, cols = np.divmod(cells, n_cols)
+  return ids, rows, cols
+
+
+def cell_incidence(square_size, pipe_gdf, gdf):
+  # Every (geometry, cell) pair of the fishnet of create_fishnet where the geometry intersects the cell, as arrays of
+  # the position of the geometry in gdf, the row and the column of the cell. Like an sjoin (predicate 'intersects')
+  # a geometry on the border of cells belongs to all of them. Points are binned by their coordinates and lines by a
+  # traversal of the grid, other geometries are joined with the cells that touch their bounding box
+  total_bounds = pipe_gdf.total_bounds
+  geom_types = set(gdf.geom_type.dropna().unique())
+
+  if geom_types <= {'Point'}:
+      ids = np.arange(len(gdf))
+      return point_cells(gdf.geometry.x.to_numpy(), gdf.geometry.y.to_numpy(), ids, square_size, total_bounds)
+
+  if geom_types <= {'LineString', 'MultiLineString'}:
+      return line_cells(gdf, square_size, total_bounds)
+
+  _, n_cols = fishnet_shape(square_size, total_bounds)
+  fishnet = create_fishnet(square_size, pipe_gdf, occupied_by=[gdf])
+  joined = gpd.sjoin(gdf.reset_index(drop=True), fishnet, predicate='intersects')
+  rows, cols = np.divmod(joined['index_right'].to_numpy(), n_cols)
+  return joined.index.to_numpy(), rows, cols
+
+
+def coarsen_incidence(incidence, factor, n_cols):
+  # Cell index in a fishnet whose cells are `factor` times larger, for every (geometry, cell) pair of the incidence.
+  # Both fishnets start at the same corner, so a larger cell is the union of factor x factor smaller cells and a
+  # geometry intersects it when it intersects one of them. A geometry is kept once per larger cell
+  ids, rows, cols = incidence
+  cells = (rows // factor) * n_cols + cols // factor
+  n_cells = (rows.max(initial=0) // factor + 1) * n_cols
+  return np.divmod(np.unique(ids * n_cells + cells), n_cells)
+
+
+def fishnet_failure_counts(square_size, pipe_gdf, failures_gdf):
+  # Number of failures per cell of the fishnet of create_fishnet, instead of an sjoin of the failures with the cells.
+  # Returns the same 'failures' series as the sjoin, indexed by the cell index and without the empty cells.
+  # The failures are binned on the fishnet of this size and not coarsened from a finer one: they may lie outside the
+  # pipes, in the last row or column of a fishnet that reaches beyond the cells of the finer fishnet
+  n_rows, n_cols = fishnet_shape(square_size, pipe_gdf.total_bounds)
+  _, rows, cols = cell_incidence(square_size, pipe_gdf, failures_gdf)
+  cells = rows * n_cols + cols
+
+  counts = np.bincount(cells, minlength=n_rows * n_cols)
+  occupied = np.flatnonzero(counts)
+  return pd.Series(counts[occupied], index=occupied, name="failures")
+
+
+def fishnet_average_metric(square_size, pipe_gdf, base_size, pipe_cells):
+  # Mean combined metric ('cm') of the pipes that intersect each cell of the fishnet of create_fishnet, indexed by the
+  # cell index, from the cell_incidence of the pipes at base_size (a divisor of square_size)
+  n_rows, n_cols = fishnet_shape(square_size, pipe_gdf.total_bounds)
+  ids, cells = coarsen_incidence(pipe_cells, square_size // base_size, n_cols)
+
+  cm = pipe_gdf['cm'].to_numpy(dtype=float)[ids]
+  valid = ~np.isnan(cm)
+  sums = np.bincount(cells[valid], weights=cm[valid], minlength=n_rows * n_cols)
+  counts = np.bincount(cells[valid], minlength=n_rows * n_cols)
+  occupied = np.flatnonzero(counts)
+  return pd.Series(sums[occupied] / counts[occupied], index=occupied)
+
+
 def spatial_autocorrelation_analysis(pipe_shapefile_path, 
                                      failures_shapefile_path, 
                                      lower_bound_cell, 
@@ -291,62 +667,280 @@ def spatial_autocorrelation_analysis(pipe_shapefile_path,
                                      weight_avg_combined_metric, 
                                      weight_failures, 
                                      output_path, 
-                                     edges):
-  results = []
+                                     edges,
+                                     workers=1,
+                                     seed=MORAN_SEED,
+                                     permutations=MORAN_PERMUTATIONS,
+                                     early_stop=False,
+                                     inference="permutation",
+                                     shortlist=3,
+                                     search="grid",
+                                     min_step=SQUARE_SIZE_MIN_STEP,
+                                     background=False,
+                                     lazy=False):
+  # Global Moran's I of the fishnets from lower_bound_cell to upper_bound_cell in steps of 100 m. The square sizes
+  # are independent of each other, with workers > 1 they are handed to a pool of processes. The permutations of
+  # every size are seeded from (seed, square size), so the results do not depend on the number of workers.
+  # With early_stop the permutations of a size stop once its p-value is settled against P_VALUE_THRESHOLDS.
+  # With inference 'analytic' the sizes are first compared with the analytical p-value of Moran's I (randomization
+  # assumption) and only the best `shortlist` sizes are confirmed with permutations, until they are all confirmed.
+  # With search 'adaptive' the 100 m grid of sizes is refined around the best size, halving the step down to min_step.
+  # The fishnet and weights of every size are kept in output_path, step 2b reuses them for the size it is given.
+  # With background the maps and the diagram are left to the render pool, which draws the maps from the kept fishnets,
+  # and the function returns as soon as the statistics are known. With lazy no map is drawn, request_swept_choropleth
+  # draws the map of a size from its kept fishnet the first time it is viewed
+  if inference not in MORAN_INFERENCES:
+      raise ValueError(f"Invalid inference: {inference}")
+  if search not in SQUARE_SIZE_SEARCHES:
+      raise ValueError(f"Invalid search: {search}")
+
+  # The peak memory of the sweep, with the processes of its workers, is reported with the results
+  with PeakMemory() as memory:
+      pipe_gdf, failures_gdf = read_shapefiles(pipe_shapefile_path, failures_shapefile_path)
+
+      # The pipes of every cell are found once on a base fishnet whose cell size divides all the sizes, the cells of
+      # the larger sizes are unions of its cells. The pipes lie within the base fishnet, the failures are binned per size
+      square_sizes = list(range(lower_bound_cell, upper_bound_cell+100, 100))
+      refine_steps = []
+      if search == "adaptive":
+          step = 100
+          while step % 2 == 0 and step // 2 >= min_step:
+              step //= 2
+              refine_steps.append(step)
+      base_size = math.gcd(*square_sizes, *refine_steps)
+      if base_size >= min(square_sizes) // BASE_SIZE_MIN_FRACTION:
+          pipe_cells = cell_incidence(base_size, pipe_gdf, pipe_gdf)
+      else:
+          # Sizes such as 101, 201, ... m have no common divisor worth a grid over the whole network (1 m here),
+          # every size then finds the pipes of its own cells
+          base_size, pipe_cells = None, None
+
+      arguments = (pipe_gdf, failures_gdf, base_size, pipe_cells, weight_avg_combined_metric, weight_failures, output_path, edges, seed,
+                   permutations, early_stop)
+      cache_key = sweep_cache_key(pipe_shapefile_path, failures_shapefile_path, weight_avg_combined_metric, weight_failures)
+
+      # Every choropleth of the sweep has the same frame, the basemap and the pipes are rendered once for it and only the
+      # cells are drawn per size
+      draw_maps = not (background or lazy)
+      backdrop = None if lazy else render_backdrop(sweep_frame(pipe_gdf, edges, upper_bound_cell), edges.crs.to_string(), edges)
+      evaluated = evaluate_square_sizes(square_sizes, arguments + (inference, draw_maps, cache_key, backdrop), workers)
+
+      results = [result for result, _ in evaluated]
+      map_paths = {result[0]: map_path for result, map_path in evaluated}
+
+      # Bracket the best size with the sizes one step away from it, halving the step every round, as long as the best
+      # size is significant at some threshold. The refined sizes are evaluated like the grid and reported with it
+      for step in refine_steps:
+          best = rank_square_sizes(results)[0]
+          if not any(result[0] == best and result[2] < P_VALUE_THRESHOLDS[-1] for result in results):
+              break
+          new_sizes = [size for size in (best - step, best + step) if lower_bound_cell <= size <= upper_bound_cell and size not in map_paths]
+          for result, map_path in evaluate_square_sizes(new_sizes, arguments + (inference, draw_maps, cache_key, backdrop), workers):
+              results.append(result)
+              map_paths[result[0]] = map_path
+      results.sort(key=lambda result: result[0])
+      square_sizes = [result[0] for result in results]
+
+      # Confirm the analytical choice with permutations, the maps of the sizes are already drawn
+      analytic_sizes = set(square_sizes) if inference == "analytic" else set()
+      while analytic_sizes:
+          pending = [size for size in rank_square_sizes(results)[:shortlist] if size in analytic_sizes]
+          if not pending:
+              break
+          confirmed = {result[0]: result for result, _ in evaluate_square_sizes(pending, arguments + ("permutation", False), workers)}
+          results = [confirmed.get(result[0], result) for result in results]
+          analytic_sizes -= set(pending)
+
+  if lazy:
+      # The maps of an earlier sweep in output_path are stale, the map of a size is drawn again when it is requested
+      for square_size in square_sizes:
+          map_paths[square_size] = choropleth_map_path(output_path, square_size)
+          if os.path.exists(map_paths[square_size]):
+              os.remove(map_paths[square_size])
+  elif background:
+      map_edges = edges[['geometry']]
+      for square_size in square_sizes:
+          map_paths[square_size] = choropleth_map_path(output_path, square_size)
+          submit_render(map_paths[square_size], plot_swept_choropleth, output_path, square_size, cache_key, map_edges, backdrop)
+
+  # Print results
+  best_square_size = find_best_square_size(results)
+  print(memory.report())
+  print_results(results, best_square_size, output_path, analytic_sizes, background, memory.report())
 
-  pipe_gdf, failures_gdf = read_shapefiles(pipe_shapefile_path, failures_shapefile_path)
+  return results, best_square_size, map_paths
 
-  for square_size in range(lower_bound_cell, upper_bound_cell+100, 100):
-      fishnet = create_fishnet(square_size, pipe_gdf)
 
-      # Perform spatial join to count failures per feature of the fishnet
-      fishnet_failures = fishnet.join(
-          gpd.sjoin(failures_gdf, fishnet).groupby("index_right").size().rename("failures"),
-          how="left",
-      )
+def sweep_frame(pipe_gdf, edges, largest_size):
+  # (xmin, xmax, ymin, ymax) frame of the choropleths of a sweep: the pipes and every cell of a fishnet up to
+  # largest_size (the cells start at the lower left corner of the pipes and end at most one cell beyond their upper
+  # right corner), with the 5% margins matplotlib adds
+  minX, minY, maxX, maxY = pipe_gdf.total_bounds
+  e_minX, e_minY, e_maxX, e_maxY = edges.total_bounds
+  xmin, ymin = min(minX, e_minX), min(minY, e_minY)
+  xmax, ymax = max(maxX + largest_size, e_maxX), max(maxY + largest_size, e_maxY)
+  pad_x, pad_y = 0.05 * (xmax - xmin), 0.05 * (ymax - ymin)
+  return xmin - pad_x, xmax + pad_x, ymin - pad_y, ymax + pad_y
 
-      fishnet_failures = fishnet_failures.dropna()
 
-      # Perform spatial join with pipe_gdf to calculate the average Combined Metric per fishnet square
-      pipe_metrics = gpd.sjoin(pipe_gdf, fishnet_failures, how='inner', predicate='intersects')
-      avg_metrics_per_square = pipe_metrics.groupby("index_right")['cm'].mean()
+def evaluate_square_sizes(square_sizes, arguments, workers):
+  # square_size_moran of every size, in a pool of processes when workers > 1. The arguments shared by the sizes
+  # (the pipes, the incidences, the backdrop) are sent once to every worker and a task only carries its size
+  if workers <= 1 or len(square_sizes) == 1:
+      return [square_size_moran(square_size, *arguments) for square_size in square_sizes]
 
-      # Add the average Combined Metric to the fishnet_failures GeoDataFrame
-      fishnet_failures['avg_combined_metric'] = fishnet_failures.index.map(avg_metrics_per_square)
+  with ProcessPoolExecutor(max_workers=min(workers, len(square_sizes)), initializer=init_sweep_worker, initargs=(arguments,)) as executor:
+      return list(executor.map(sweep_worker_moran, square_sizes))
 
-      # Standardize the 'failures' column from 0 to 1
-      min_failures = fishnet_failures['failures'].min()
-      max_failures = fishnet_failures['failures'].max()
-      fishnet_failures['failures_standardized'] = (fishnet_failures['failures'] - min_failures) / (max_failures - min_failures)
 
-      # Add the weighted average column
-      fishnet_failures['weighted_avg'] = (
-          fishnet_failures['avg_combined_metric'] * weight_avg_combined_metric +
-          fishnet_failures['failures_standardized'] * weight_failures
-      ) / (weight_avg_combined_metric + weight_failures)
+# square_size_moran arguments of the sweep that a worker process evaluates, set by init_sweep_worker
+_sweep_arguments = None
 
-      # Store fishnet_failures as an instance variable
-      # fishnet_failures = fishnet_failures
 
-      # Create static choropleth maps (Equal intervals, Quantiles, Natural Breaks)
-      # Ensure that the create_choropleth_maps method can handle the new column
-      create_choropleth_maps(fishnet_failures, square_size, output_path, edges)
+def init_sweep_worker(arguments):
+  global _sweep_arguments
+  plt.switch_backend('Agg')
+  _sweep_arguments = arguments
 
-      # Calculate global Moran's I and store results
-      y = fishnet_failures['weighted_avg']
-      w = lps.weights.Queen.from_dataframe(fishnet_failures)
-      w.transform = 'r'
-      moran = Moran(y, w)
-      results.append((square_size, moran.I, moran.p_sim, moran.z_sim))
 
-  # Print results
-  best_square_size = find_best_square_size(results)
-  print_results(results, best_square_size, output_path)
+def sweep_worker_moran(square_size):
+  return square_size_moran(square_size, *_sweep_arguments)
+
+
+def rank_square_sizes(results):
+  # Square sizes in the order of preference of find_best_square_size: first by the smallest p-value threshold they
+  # pass, then by decreasing Moran's I
+  def preference(result):
+      size, moran_i, p_value, z_score = result
+      passed = next((i for i, threshold in enumerate(P_VALUE_THRESHOLDS) if p_value < threshold), len(P_VALUE_THRESHOLDS))
+      return (passed, -moran_i if not np.isnan(moran_i) else np.inf)
+
+  return [result[0] for result in sorted(results, key=preference)]
+
+
+def square_size_moran(square_size, pipe_gdf, failures_gdf, base_size, pipe_cells, weight_avg_combined_metric, weight_failures, output_path, edges,
+                      seed=None, permutations=MORAN_PERMUTATIONS, early_stop=False, inference="permutation", draw_map=True, cache_key=None,
+                      backdrop=None):
+  # One square size of spatial_autocorrelation_analysis: the fishnet with the failures and the average combined metric
+  # per cell, its choropleth map and the global Moran's I. Returns (square size, I, p-value, z-score) and the map path,
+  # the p-value and z-score come from the permutations or from the analytical inference. With cache_key the fishnet,
+  # the weights and the pipes of its cells are saved for step 2b. Without a base fishnet (base_size None) the
+  # incidence of the pipes is found at this size
+  if base_size is None:
+      base_size = square_size
+      pipe_cells = cell_incidence(square_size, pipe_gdf, pipe_gdf)
+
+  # Cells without failures are dropped below, so only the cells that contain failures are created
+  fishnet = create_fishnet(square_size, pipe_gdf, occupied_by=[failures_gdf])
+
+  # Count the failures per cell of the fishnet
+  fishnet_failures = fishnet.join(fishnet_failure_counts(square_size, pipe_gdf, failures_gdf), how="left")
+
+  fishnet_failures = fishnet_failures.dropna()
+
+  # Average Combined Metric of the pipes that intersect each fishnet square
+  avg_metrics_per_square = fishnet_average_metric(square_size, pipe_gdf, base_size, pipe_cells)
+
+  # Add the average Combined Metric to the fishnet_failures GeoDataFrame
+  fishnet_failures['avg_combined_metric'] = fishnet_failures.index.map(avg_metrics_per_square)
+
+  # Standardize the 'failures' column from 0 to 1
+  min_failures = fishnet_failures['failures'].min()
+  max_failures = fishnet_failures['failures'].max()
+  fishnet_failures['failures_standardized'] = (fishnet_failures['failures'] - min_failures) / (max_failures - min_failures)
+
+  # Add the weighted average column
+  fishnet_failures['weighted_avg'] = (
+      fishnet_failures['avg_combined_metric'] * weight_avg_combined_metric +
+      fishnet_failures['failures_standardized'] * weight_failures
+  ) / (weight_avg_combined_metric + weight_failures)
+
+  # Create static choropleth maps (Equal intervals, Quantiles, Natural Breaks)
+  # Ensure that the create_choropleth_maps method can handle the new column
+  map_path = create_choropleth_maps(fishnet_failures, square_size, output_path, edges, backdrop) if draw_map else None
+
+  # Calculate global Moran's I
+  y = fishnet_failures['weighted_avg']
+  _, n_cols = fishnet_shape(square_size, pipe_gdf.total_bounds)
+  w = fishnet_queen_weights(fishnet_failures.index, n_cols)
+  w.transform = 'r'
+
+  if cache_key is not None:
+      ids, cells = coarsen_incidence(pipe_cells, square_size // base_size, n_cols)
+      in_fishnet = np.isin(cells, fishnet_failures.index)
+      cell_pipes = pd.DataFrame({'fishnet_index': cells[in_fishnet], 'LABEL': pipe_gdf['LABEL'].to_numpy()[ids[in_fishnet]]})
+      save_sweep_size(output_path, square_size, cache_key, SweepSize(fishnet_failures, w, n_cols, cell_pipes))
+
+  if inference == "analytic":
+      moran = moran_analytic(y, w)
+      return (square_size, moran.I, moran.p, moran.z), map_path
+
+  moran = moran_permutations(y, w, permutations, moran_seed(seed, square_size), early_stop)
+  return (square_size, moran.I, moran.p_sim, moran.z_sim), map_path
+
+
+def moran_seed(seed, square_size):
+  # Seed of the Moran's I permutations of one square size, the same in the sweep and in step 2b
+  return None if seed is None else [seed, square_size]
+
+
+def choropleth_map_path(output_path, square_size):
+  return output_path + '/'+ str(square_size) + '_' +'coropleth_map.png'
+
+
+def plot_swept_choropleth(output_path, square_size, cache_key, edges, backdrop=None):
+  # Choropleth map of a size of spatial_autocorrelation_analysis from the fishnet it kept in output_path
+  sweep_size = load_sweep_size(output_path, square_size, cache_key)
+  if sweep_size is None:
+      raise FileNotFoundError(f"The fishnet of {square_size} m is not kept in {output_path}, run the cell size sweep again")
+  return create_choropleth_maps(sweep_size.fishnet_failures, square_size, output_path, edges, backdrop)
+
+
+# Backdrop of the last sweep whose maps were requested, by (cache key, largest size). A render worker builds it for
+# the first map it draws and reuses it for the next sizes
+_sweep_backdrops = {}
+
+
+def sweep_backdrop(pipe_shapefile_path, failures_shapefile_path, edges, upper_bound_cell, cache_key=None):
+  # Backdrop of the choropleths of a sweep, for the maps drawn after it by request_swept_choropleth
+  if cache_key is not None and (cache_key, upper_bound_cell) in _sweep_backdrops:
+      return _sweep_backdrops[(cache_key, upper_bound_cell)]
+
+  pipe_gdf, _ = read_shapefiles(pipe_shapefile_path, failures_shapefile_path)
+  backdrop = render_backdrop(sweep_frame(pipe_gdf, edges, upper_bound_cell), edges.crs.to_string(), edges)
+  if cache_key is not None:
+      _sweep_backdrops.clear()
+      _sweep_backdrops[(cache_key, upper_bound_cell)] = backdrop
+  return backdrop
+
+
+def plot_requested_choropleth(pipe_shapefile_path, failures_shapefile_path, weight_avg_combined_metric, weight_failures, upper_bound_cell,
+                              output_path, square_size, edges):
+  # Choropleth map of a size of a lazy sweep with the backdrop of the sweep. The cache key hashes the shapefiles and the
+  # backdrop fetches the basemap, so both are left to this function and not to the caller of request_swept_choropleth
+  cache_key = sweep_cache_key(pipe_shapefile_path, failures_shapefile_path, weight_avg_combined_metric, weight_failures)
+  backdrop = sweep_backdrop(pipe_shapefile_path, failures_shapefile_path, edges, upper_bound_cell, cache_key)
+  return plot_swept_choropleth(output_path, square_size, cache_key, edges, backdrop)
 
-  return results, best_square_size
 
+def request_swept_choropleth(pipe_shapefile_path, failures_shapefile_path, weight_avg_combined_metric, weight_failures, upper_bound_cell,
+                             output_path, square_size, edges, background=False):
+  # Path of the choropleth map of a size of a lazy sweep, whose arguments are those of spatial_autocorrelation_analysis.
+  # The first request draws it from the fishnet the sweep kept in output_path (in the render pool with background,
+  # so the caller never waits for the shapefiles or the basemap), later requests find the PNG on disk
+  map_path = choropleth_map_path(output_path, square_size)
+  if os.path.exists(map_path) or is_rendering(map_path):
+      return map_path
 
-def create_choropleth_maps(fishnet_failures, square_size, output_path, edges):
+  arguments = (pipe_shapefile_path, failures_shapefile_path, weight_avg_combined_metric, weight_failures, upper_bound_cell, output_path, square_size)
+  if background:
+      submit_render(map_path, plot_requested_choropleth, *arguments, edges[['geometry']])
+  else:
+      plot_requested_choropleth(*arguments, edges)
+  return map_path
+
+
+def create_choropleth_maps(fishnet_failures, square_size, output_path, edges, backdrop=None):
   # fig, ax = plt.subplots(figsize=(12, 10))
   # fishnet_failures.plot(column='weighted_avg', scheme='equal_interval', k=10, cmap='RdYlGn_r', legend=True, ax=ax,
   #                   legend_kwds={'loc':'center left', 'bbox_to_anchor':(1,0.5), 'fmt':"{:.2f}", 'interval':True})
@@ -357,25 +951,30 @@ def create_choropleth_maps(fishnet_failures, square_size, output_path, edges):
   # plt.savefig(output_path + '_' + str(square_size) + '_' +'equal_intervals_coropleth_map.png')
 
   # Create a static choropleth map of the failure number per grid cell of the fishnet (Quantiles)
-  fig, ax = plt.subplots(figsize=(12, 10))
-  
-  edges.plot(
-      ax=ax, linewidth=1, color='0.2')
-  
-  prov = ctx.providers.CartoDB.Positron
-  
-   
+  # With a backdrop of render_backdrop the basemap (and the pipes of a large network) are its prerendered layers
+  map_path = choropleth_map_path(output_path, square_size)
+  with agg_subplots((12, 10)) as (fig, ax):
   
-  fishnet_failures.plot(column='weighted_avg', scheme='quantiles', k=10, cmap='RdYlGn_r', legend=True, ax=ax, alpha = 0.7,
-                    legend_kwds={'loc':'center left', 'bbox_to_anchor':(1,0.5), 'fmt':"{:.2f}", 'interval':True})
-  fishnet_failures.boundary.plot(ax=ax, color = 'black', alpha=0.7)
-  
-  ctx.add_basemap(ax, crs=edges.crs.to_string(), source=prov)
-  
-  plt.title(f'Average criticality metric per fishnet cell (size = {square_size} m x {square_size} m), Quantiles', fontsize = 18)
-  plt.axis('off')
-  plt.tight_layout()
-  plt.savefig(output_path + '/'+ str(square_size) + '_' +'coropleth_map.png')
+      if backdrop is None or backdrop.network is None:
+          edges.plot(
+              ax=ax, linewidth=1, color='0.2')
+      
+      prov = ctx.providers.CartoDB.Positron
+      
+      fishnet_failures.plot(column='weighted_avg', scheme='quantiles', k=10, cmap='RdYlGn_r', legend=True, ax=ax, alpha = 0.7,
+                        legend_kwds={'loc':'center left', 'bbox_to_anchor':(1,0.5), 'fmt':"{:.2f}", 'interval':True})
+      fishnet_failures.boundary.plot(ax=ax, color = 'black', alpha=0.7)
+      
+      if backdrop is None:
+          add_basemap(ax, crs=edges.crs.to_string(), source=prov)
+      else:
+          draw_backdrop(ax, backdrop)
+      
+      ax.set_title(f'Average criticality metric per fishnet cell (size = {square_size} m x {square_size} m), Quantiles', fontsize = 18)
+      ax.axis('off')
+      fig.tight_layout()
+      fig.savefig(map_path)
+  return map_path
 
   # # Create a static choropleth map of the failure number per grid cell of the fishnet (Natural Breaks)
   # fig, ax = plt.subplots(figsize=(12, 10))
@@ -388,68 +987,79 @@ def create_choropleth_maps(fishnet_failures, square_size, output_path, edges):
   # plt.savefig(output_path + '_' + str(square_size) + '_' +'natural_breaks_coropleth_map.png')
 
 
-def print_results(results, best_square_size, output_path):
+def print_results(results, best_square_size, output_path, analytic_sizes=(), background=False, peak_memory=None):
       # Print results here as in your original code
       # Writing the results to a text file
+      # The p-values and z-scores of analytic_sizes come from the analytical inference instead of permutations,
+      # peak_memory is the PeakMemory report of the sweep
 
       output_file_path = output_path + '/square_size_comparison_results.txt'
 
       with open(output_file_path, 'w') as file:
           for size, moran_i, p_value, z_score in results:
+              inference = " (analytical)" if size in analytic_sizes else ""
               file.write(f"Square Size: {size} m\n")
               file.write(f"Moran's I value: {round(moran_i,4)}\n")
-              file.write(f"Moran's I p-value: {round(p_value,4)}\n")
-              file.write(f"Moran's I z-score: {round(z_score,4)}\n")
+              file.write(f"Moran's I p-value: {round(p_value,4)}{inference}\n")
+              file.write(f"Moran's I z-score: {round(z_score,4)}{inference}\n")
               file.write("\n")
           file.write(f"The optimal square size is: {best_square_size} m\n")
+          if peak_memory is not None:
+              file.write(f"{peak_memory}\n")
+
+      # The diagram is rendered by the render pool with background
+      if background:
+          submit_render(output_path + '/square_size_comparison_diagram.png', plot_comparison_diagram, results, output_path)
+      else:
+          plot_comparison_diagram(results, output_path)
+
+
+def plot_comparison_diagram(results, output_path):
       # Extract data for plotting
       square_sizes, moran_values, p_values, z_scores = zip(*results)
 
       # Create a plot with multiple y-axes
-      fig, ax1 = plt.subplots(figsize=(10, 6))
+      with agg_subplots((10, 6)) as (fig, ax1):
 
-      # Plot Moran's I on the left y-axis
-      ax1.plot(square_sizes, moran_values, 'b-', label="Moran's I", marker='o')
-      ax1.set_xlabel("Square Size (m)", fontsize=12)
-      ax1.set_ylabel("Moran's I", color='b', fontsize=12)
-      ax1.tick_params(axis='y', labelcolor='b')
+          # Plot Moran's I on the left y-axis
+          ax1.plot(square_sizes, moran_values, 'b-', label="Moran's I", marker='o')
+          ax1.set_xlabel("Square Size (m)", fontsize=12)
+          ax1.set_ylabel("Moran's I", color='b', fontsize=12)
+          ax1.tick_params(axis='y', labelcolor='b')
 
-      # Create right y-axes for p-value and z-score
-      ax2 = ax1.twinx()
-      ax2.plot(square_sizes, p_values, 'r-', label="p-value", marker='s')
-      ax2.set_ylabel("p-value", color='r', fontsize=12)
-      ax2.tick_params(axis='y', labelcolor='r')
+          # Create right y-axes for p-value and z-score
+          ax2 = ax1.twinx()
+          ax2.plot(square_sizes, p_values, 'r-', label="p-value", marker='s')
+          ax2.set_ylabel("p-value", color='r', fontsize=12)
+          ax2.tick_params(axis='y', labelcolor='r')
 
-      ax3 = ax1.twinx()
-      ax3.spines['right'].set_position(('outward', 60))
-      ax3.plot(square_sizes, z_scores, 'g-', label="z-score", marker='^')
-      ax3.set_ylabel("z-score", color='g', fontsize=12)
-      ax3.tick_params(axis='y', labelcolor='g')
+          ax3 = ax1.twinx()
+          ax3.spines['right'].set_position(('outward', 60))
+          ax3.plot(square_sizes, z_scores, 'g-', label="z-score", marker='^')
+          ax3.set_ylabel("z-score", color='g', fontsize=12)
+          ax3.tick_params(axis='y', labelcolor='g')
 
-      # Add grid lines with different colors
-      ax1.grid(True, alpha=0.7, color='b')  # Moran's I grid in blue
-      ax2.grid(True, linestyle='--', alpha=0.7, color='r')  # p-value grid in red
-      ax3.grid(True, linestyle='--', alpha=0.7, color='g')  # z-score grid in green
+          # Add grid lines with different colors
+          ax1.grid(True, alpha=0.7, color='b')  # Moran's I grid in blue
+          ax2.grid(True, linestyle='--', alpha=0.7, color='r')  # p-value grid in red
+          ax3.grid(True, linestyle='--', alpha=0.7, color='g')  # z-score grid in green
 
-      # Add labels for each y-axis
-      ax1.set_title("Moran's I, p-value, and z-score vs. Square Size", fontsize=16)
-      ax1.set_xlabel("Square Size (m)", fontsize=12)
+          # Add labels for each y-axis
+          ax1.set_title("Moran's I, p-value, and z-score vs. Square Size", fontsize=16)
+          ax1.set_xlabel("Square Size (m)", fontsize=12)
 
-      # Show the legend
-      lines, labels = ax1.get_legend_handles_labels()
-      lines2, labels2 = ax2.get_legend_handles_labels()
-      lines3, labels3 = ax3.get_legend_handles_labels()
-      ax1.legend(lines + lines2 + lines3, labels + labels2 + labels3, loc='upper left')
+          # Show the legend
+          lines, labels = ax1.get_legend_handles_labels()
+          lines2, labels2 = ax2.get_legend_handles_labels()
+          lines3, labels3 = ax3.get_legend_handles_labels()
+          ax1.legend(lines + lines2 + lines3, labels + labels2 + labels3, loc='upper left')
 
-      plt.tight_layout()
-      plt.savefig(output_path + '/square_size_comparison_diagram.png')
+          fig.tight_layout()
+          fig.savefig(output_path + '/square_size_comparison_diagram.png')
 
 
 def find_best_square_size(results):
-    # Define p-value thresholds
-    p_value_thresholds = [0.05, 0.10, 0.15, 0.20, 0.25, 0.30, 0.35, 0.40, 0.45, 0.50]  # Add more thresholds if needed
-
-    for threshold in p_value_thresholds:
+    for threshold in P_VALUE_THRESHOLDS:
         best_square_size = None
         max_moran_i = None
 
@@ -468,43 +1078,38 @@ def find_best_square_size(results):
     return None
 
 
-def optimal_fishnet(pipe_shapefile_path, failures_shapefile_path, weight_avg_combined_metric, weight_failures, select_square_size, output_path):
+def optimal_fishnet(pipe_shapefile_path, failures_shapefile_path, weight_avg_combined_metric, weight_failures, select_square_size, output_path,
+                    permutations=MORAN_PERMUTATIONS, seed=MORAN_SEED):
+    # Returns the fishnet cells with failures, their Queen weights and the (fishnet_index, LABEL) pairs of the pipes
+    # in those cells. A size swept by spatial_autocorrelation_analysis with the same inputs is loaded from output_path,
+    # its global Moran's I is the one of the sweep (same permutation seed)
+    cached = load_sweep_size(output_path, select_square_size, sweep_cache_key(pipe_shapefile_path, failures_shapefile_path, weight_avg_combined_metric, weight_failures))
+    if cached is not None:
+        fishnet_failures = cached.fishnet_failures.dropna()
+        w = cached.w
+        if len(fishnet_failures) < len(cached.fishnet_failures):
+            # Cells without pipes have no combined metric, the weights are rebuilt without them
+            w = fishnet_queen_weights(fishnet_failures.index, cached.n_cols)
+            w.transform = 'r'
+        fishnet_failures['weighted_fail'] = lps.weights.lag_spatial(w, fishnet_failures['weighted_avg'])
+        pipe_cells = cached.pipe_cells[cached.pipe_cells['fishnet_index'].isin(fishnet_failures.index)]
+        print(f"Fishnet of {select_square_size} m loaded from the square size sweep")
+        return fishnet_failures, w, pipe_cells
 
     pipe_gdf, failures_gdf = read_shapefiles(pipe_shapefile_path, failures_shapefile_path)
 
-    # Perform the analysis and store results for the optimal square size
-    total_bounds = pipe_gdf.total_bounds
-    minX, minY, maxX, maxY = total_bounds
-    x, y = (minX, minY)
-    geom_array = []
-    # Create a fishnet
-    x, y = (minX, minY)
-    geom_array = []
-
-    # Polygon Size
-    square_size = select_square_size
-    while y <= maxY:
-        while x <= maxX:
-            geom = geometry.Polygon([(x,y), (x, y+square_size), (x+square_size, y+square_size), (x+square_size, y), (x, y)])
-            geom_array.append(geom)
-            x += square_size
-        x = minX
-        y += square_size
-
-    fishnet = gpd.GeoDataFrame(geom_array, columns=['geometry']).set_crs('EPSG:2100')
+    # Create a fishnet with the cells that contain failures, the others are dropped below
+    fishnet = create_fishnet(select_square_size, pipe_gdf, occupied_by=[failures_gdf])
     # fishnet.to_file(output_path + str(select_square_size) + '_fishnet_grid.shp') ### dont need to show
 
-    # Perform spatial join to count failures per feature of the fishnet
-    fishnet_failures = fishnet.join(
-        gpd.sjoin(failures_gdf, fishnet, how='inner', predicate='intersects').groupby("index_right").size().rename("failures"),
-        how="left",
-    )
+    # Count the failures per cell of the fishnet
+    fishnet_failures = fishnet.join(fishnet_failure_counts(select_square_size, pipe_gdf, failures_gdf), how="left")
 
     fishnet_failures = fishnet_failures.dropna()
 
-    # Perform spatial join with pipe_gdf to calculate the average Combined Metric per fishnet square
-    pipe_metrics = gpd.sjoin(pipe_gdf, fishnet_failures, how='inner', predicate='intersects')
-    avg_metrics_per_square = pipe_metrics.groupby("index_right")['cm'].mean()
+    # Average Combined Metric of the pipes that intersect each fishnet square
+    pipe_incidence = cell_incidence(select_square_size, pipe_gdf, pipe_gdf)
+    avg_metrics_per_square = fishnet_average_metric(select_square_size, pipe_gdf, select_square_size, pipe_incidence)
 
     # Add the average Combined Metric to the fishnet_failures GeoDataFrame
     fishnet_failures['avg_combined_metric'] = fishnet_failures.index.map(avg_metrics_per_square)
@@ -529,7 +1134,8 @@ def optimal_fishnet(pipe_shapefile_path, failures_shapefile_path, weight_avg_com
     # Spatial similarity, measured by spatial weights, shows the relative strength of a relationship between pairs of locations
 
     # Here we compute spatial weights using the Queen contiguity (8 directions)
-    w = lps.weights.Queen.from_dataframe(fishnet_failures)
+    _, n_cols = fishnet_shape(select_square_size, pipe_gdf.total_bounds)
+    w = fishnet_queen_weights(fishnet_failures.index, n_cols)
     w.transform = 'r'
 
     # Attribute similarity, measured by spatial lags, is a summary of the similarity (or dissimilarity) of observations for a variable at different locations
@@ -556,20 +1162,26 @@ def optimal_fishnet(pipe_shapefile_path, failures_shapefile_path, weight_avg_com
     # spatially clustered together in such a way that it is unlikely to have occurred by chance alone.
 
     y = fishnet_failures['weighted_avg']
-    moran = Moran(y, w)
+    moran = moran_permutations(y, w, permutations, moran_seed(seed, select_square_size))
     print(f"Moran's I value: {moran.I}\np-value: {moran.p_sim}\nZ-score: {moran.z_sim}")
 
-    return fishnet_failures, pipe_gdf
+    # Find the pipes of every fishnet grid cell with the grid traversal of the pipes
+    pipe_ids, cells = coarsen_incidence(pipe_incidence, 1, n_cols)
+    pipe_cells = pd.DataFrame({'fishnet_index': cells, 'LABEL': pipe_gdf['LABEL'].to_numpy()[pipe_ids]})
+    pipe_cells = pipe_cells[pipe_cells['fishnet_index'].isin(fishnet_failures.index)]
+
+    return fishnet_failures, w, pipe_cells
 
 
-def local_spatial_autocorrelation(pipe_shapefile_path, edges, failures_shapefile_path, weight_avg_combined_metric, weight_failures, select_square_size, output_path):
+def local_spatial_autocorrelation(pipe_shapefile_path, edges, failures_shapefile_path, weight_avg_combined_metric, weight_failures, select_square_size, output_path,
+                                  permutations=MORAN_PERMUTATIONS, seed=MORAN_SEED, workers=1, background=False):
+    # With background the LISA cluster map is rendered by the render pool and the function returns without waiting for it
 
-    fishnet_failures, pipe_gdf = optimal_fishnet(pipe_shapefile_path=pipe_shapefile_path, failures_shapefile_path=failures_shapefile_path, weight_avg_combined_metric=weight_avg_combined_metric, weight_failures=weight_failures, select_square_size=select_square_size, output_path=output_path)
+    fishnet_failures, w, pipe_cells = optimal_fishnet(pipe_shapefile_path=pipe_shapefile_path, failures_shapefile_path=failures_shapefile_path, weight_avg_combined_metric=weight_avg_combined_metric, weight_failures=weight_failures, select_square_size=select_square_size, output_path=output_path,
+                                                 permutations=permutations, seed=seed)
     # Perform the local spatial autocorrelation analysis
     y = fishnet_failures['weighted_avg']
-    w = lps.weights.Queen.from_dataframe(fishnet_failures)
-    w.transform = 'r'
-    moran_local = Moran_Local(y, w)
+    moran_local = Moran_Local(y, w, permutations=permutations, n_jobs=workers, seed=seed)
     # Local spatial autocorrelation with Local Indicators of Spatial Association (LISA) statistics
     # While the global spatial autocorrelation can prove the existence of clusters,
     # or a positive spatial autocorrelation between the listing price and their neighborhoods,
@@ -620,19 +1232,11 @@ def local_spatial_autocorrelation(pipe_shapefile_path, edges, failures_shapefile
     # Sort the cells according to the cluster label and weighted metric
     sorted_fishnet_df = fishnet_failures.sort_values(by=['Cluster_Label', 'weighted_avg'], ascending=[True, False])
 
-    # Spatially join the fishnet grid cells and pipes
-    
-    # Now perform the spatial join using this new 'fishnet_index' column
-    spatial_join = gpd.sjoin(fishnet_failures, pipe_gdf, predicate='intersects')
-
-    # Group the results by 'fishnet_index'
-    grouped = spatial_join.groupby('fishnet_index')
-
     # Create a dictionary to store the results
     results_pipe_clusters = {}
 
     # Iterate through each group (fishnet cell) and collect the associated pipe labels
-    for fishnet_index, group_data in grouped:
+    for fishnet_index, group_data in pipe_cells.groupby('fishnet_index'):
         pipe_labels = group_data['LABEL'].tolist()
         results_pipe_clusters[fishnet_index] = pipe_labels
 
@@ -657,56 +1261,65 @@ def local_spatial_autocorrelation(pipe_shapefile_path, edges, failures_shapefile
     
     fishnet_failures['Priority'] = sorted_fishnet_df['Priority']
     #### Create a LISA cluster map
+    lisa_map_path = output_path + '/' + str(select_square_size) + '_' +'final_lisa_cluster_map.png'
+    if background:
+        submit_render(lisa_map_path, plot_lisa_map, moran_local, fishnet_failures, edges[['geometry']], select_square_size, lisa_map_path)
+    else:
+        plot_lisa_map(moran_local, fishnet_failures, edges, select_square_size, lisa_map_path)
+
+    return sorted_fishnet_df, results_pipe_clusters, fishnet_index
+
+
+def plot_lisa_map(moran_local, fishnet_failures, edges, select_square_size, lisa_map_path):
+    # LISA cluster map of local_spatial_autocorrelation, with the priority of every cell
     # Define the tiles server
     prov = ctx.providers.CartoDB.Positron
 
-    fig, ax = plt.subplots(figsize=(12,10))
+    with agg_subplots((12, 10)) as (fig, ax):
     
-    edges.plot(ax=ax, linewidth=1, color='0.2')
+        edges.plot(ax=ax, linewidth=1, color='0.2')
     
-    lisa_cluster(moran_local, fishnet_failures, p=1,  ax=ax, legend=True, legend_kwds={'loc':'center left', 'bbox_to_anchor':(1,0.5), 'fmt':"{:.0f}"}, alpha = 0.55)
+        lisa_cluster(moran_local, fishnet_failures, p=1,  ax=ax, legend=True, legend_kwds={'loc':'center left', 'bbox_to_anchor':(1,0.5), 'fmt':"{:.0f}"}, alpha = 0.55)
     
-    fishnet_failures.boundary.plot(ax=ax, color='black', alpha=0.5)
+        fishnet_failures.boundary.plot(ax=ax, color='black', alpha=0.5)
     
-    # Annotate each grid cell with its ID
-    if select_square_size == 100:
-        for idx, row in fishnet_failures.iterrows():
-            # Get the ID value
-            id_value = row['Priority']
-            # Get the centroid of the grid cell
-            centroid = row.geometry.centroid
-            # Annotate the ID at the centroid  
-            ax.annotate(text=str(id_value), xy=(centroid.x, centroid.y), ha='center', va='center', fontsize=8, color='black', weight="bold")
+        # Annotate each grid cell with its ID
+        if select_square_size == 100:
+            for idx, row in fishnet_failures.iterrows():
+                # Get the ID value
+                id_value = row['Priority']
+                # Get the centroid of the grid cell
+                centroid = row.geometry.centroid
+                # Annotate the ID at the centroid  
+                ax.annotate(text=str(id_value), xy=(centroid.x, centroid.y), ha='center', va='center', fontsize=8, color='black', weight="bold")
                         
-    elif select_square_size == 200:
-        for idx, row in fishnet_failures.iterrows():
-            # Get the ID value
-            id_value = row['Priority']
-            # Get the centroid of the grid cell
-            centroid = row.geometry.centroid
-            # Annotate the ID at the centroid  
-            # ax.annotate(text=str(id_value), xy=(centroid.x, centroid.y), ha='center', va='center', fontsize=12, color='black', weight="bold",
-            #             bbox=dict(boxstyle='round,pad=0.5', fc='gray', alpha=0.4))
-            ax.annotate(text=str(id_value), xy=(centroid.x, centroid.y), ha='center', va='center', fontsize=12, color='black', weight="bold")
+        elif select_square_size == 200:
+            for idx, row in fishnet_failures.iterrows():
+                # Get the ID value
+                id_value = row['Priority']
+                # Get the centroid of the grid cell
+                centroid = row.geometry.centroid
+                # Annotate the ID at the centroid  
+                # ax.annotate(text=str(id_value), xy=(centroid.x, centroid.y), ha='center', va='center', fontsize=12, color='black', weight="bold",
+                #             bbox=dict(boxstyle='round,pad=0.5', fc='gray', alpha=0.4))
+                ax.annotate(text=str(id_value), xy=(centroid.x, centroid.y), ha='center', va='center', fontsize=12, color='black', weight="bold")
         
-    else:
-        for idx, row in fishnet_failures.iterrows():
-            # Get the ID value
-            id_value = row['Priority']
-            # Get the centroid of the grid cell
-            centroid = row.geometry.centroid
-            # Annotate the ID at the centroid  
-            ax.annotate(text=str(id_value), xy=(centroid.x, centroid.y), ha='center', va='center', fontsize=12, color='black', weight="bold",
-                        bbox=dict(boxstyle='round,pad=0.5', fc='gray', alpha=0.4))
-            # ax.annotate(text=str(id_value), xy=(centroid.x, centroid.y), ha='center', va='center', fontsize=12, color='black', weight="bold")
+        else:
+            for idx, row in fishnet_failures.iterrows():
+                # Get the ID value
+                id_value = row['Priority']
+                # Get the centroid of the grid cell
+                centroid = row.geometry.centroid
+                # Annotate the ID at the centroid  
+                ax.annotate(text=str(id_value), xy=(centroid.x, centroid.y), ha='center', va='center', fontsize=12, color='black', weight="bold",
+                            bbox=dict(boxstyle='round,pad=0.5', fc='gray', alpha=0.4))
+                # ax.annotate(text=str(id_value), xy=(centroid.x, centroid.y), ha='center', va='center', fontsize=12, color='black', weight="bold")
     
-    ctx.add_basemap(ax, crs=edges.crs.to_string(), source=prov)
+        add_basemap(ax, crs=edges.crs.to_string(), source=prov)
     
-    plt.title('LISA Cluster Map for average criticality metric per fishnet cell', fontsize = 18)
-    plt.tight_layout()
-    plt.savefig(output_path + '/' + str(select_square_size) + '_' +'final_lisa_cluster_map.png')
-
-    return sorted_fishnet_df, results_pipe_clusters, fishnet_index
+        ax.set_title('LISA Cluster Map for average criticality metric per fishnet cell', fontsize = 18)
+        fig.tight_layout()
+        fig.savefig(lisa_map_path)
 
 
 ### STEP 3
@@ -745,12 +1358,9 @@ def optimize_pipe_clusters(results_pipe_clusters, df_metrics, sorted_fishnet_df)
     return results_pipe_clusters
 
 
-def process_pipes_cell_data(path_pipes, path_fishnet, fishnet_index, row_number_to_keep, results_pipe_clusters, pipe_materials):
+def process_pipes_cell_data(path_pipes, fishnet_index, row_number_to_keep, results_pipe_clusters, pipe_materials):
     # Read pipes data and set coordinate reference system
-    pipes_gdf = gpd.read_file(path_pipes).set_crs('EPSG:2100')
-
-    # Read fishnet data and set coordinate reference system
-    fishnet_gdf = gpd.read_file(path_fishnet).set_crs('EPSG:2100')
+    pipes_gdf = read_shapefile(path_pipes, NETWORK_COLUMNS).set_crs('EPSG:2100')
 
     # Extract the specific row based on the row number
     cell_index = fishnet_index.iloc[row_number_to_keep - 1]
@@ -1033,7 +1643,7 @@ def create_subgraph_from_threshold(gdf_cell_path, choose_option, filter_list, fi
     :return: A subgraph consisting of edges where 'opt_time' <= threshold.
     """
     # Convert shp to GeodataFrame
-    pipes_gdf_cell_merged = gpd.read_file(gdf_cell_path).set_crs('EPSG:2100')
+    pipes_gdf_cell_merged = read_shapefile(gdf_cell_path).set_crs('EPSG:2100')
     
     ## Convert the GeoDataFrame into a graph
     ## Load the shapefile as geodataframe
@@ -1055,21 +1665,18 @@ def create_subgraph_from_threshold(gdf_cell_path, choose_option, filter_list, fi
     
     red_edges_df = red_edges_df.drop(['mm_len','node_start','node_end'],axis=1)
     
-    # Plot setup
-    fig, ax = plt.subplots(figsize=figsize)
-
-    # Plotting edges with opt_time < threshold in red
-    red_edges_df.plot(ax=ax, linewidth=line_width, color='red')
+    # Plot setup, the figure is released when the block exits
+    with agg_subplots(figsize) as (fig, ax):
 
-    # Adding basemap
-    ctx.add_basemap(ax, crs=edges.crs.to_string(), source=ctx.providers.CartoDB.Positron)
+        # Plotting edges with opt_time < threshold in red
+        red_edges_df.plot(ax=ax, linewidth=line_width, color='red')
 
-    # Title and axis off
-    ax.set_title("Replacement for selected pipes")
-    ax.axis('off')
+        # Adding basemap
+        add_basemap(ax, crs=edges.crs.to_string(), source=ctx.providers.CartoDB.Positron)
 
-    # Show plot
-    plt.plot()
+        # Title and axis off
+        ax.set_title("Replacement for selected pipes")
+        ax.axis('off')
 
     return subgraph, red_edges_df
 
@@ -1176,13 +1783,25 @@ def main():
     weight_betweenness = 1/3
     weight_bridge = 1/3
 
+    # Choose the centrality engine, 'networkx' or 'csr' (same results, faster on large networks)
+    engine = 'csr'
+
+    # Number of processes used for the centralities
+    workers = os.cpu_count()
+
+    # Measure the shortest paths in number of pipes ('hops') or in metres ('length')
+    distance = 'hops'
+
+    # Number of pivot sources for a quick sampled betweenness, None for the exact values
+    betweenness_k = None
+
     # Path to save the 'df_metrics' DataFrame, making it visible to the user.
     output_path = r'C:\\Users\\Nikos\\Dropbox\\EYDAP_Asset Management\\Calcs\\WP2\\study_results_v1\\'
     os.makedirs(output_path, exist_ok=True)
     os.chdir(output_path)
 
     # Process shapefile and save df_metrics
-    gdf, G, nodes, edges, df_metrics = process_shapefile(shp_path, weight_closeness, weight_betweenness, weight_bridge, output_path)
+    gdf, G, nodes, edges, df_metrics = process_shapefile(shp_path, weight_closeness, weight_betweenness, weight_bridge, output_path, engine=engine, workers=workers, betweenness_k=betweenness_k, distance=distance)
 	
     # Example usage:
     # Specify the metrics to plot
@@ -1216,7 +1835,10 @@ def main():
     output_path_fishnet = 'Fishnet_Grids'    #_{timestamp}'
     os.makedirs(output_path_fishnet, exist_ok=True)
 
-    results, best_square_size = spatial_autocorrelation_analysis(pipe_shapefile_path, failures_shapefile_path, lower_bound_cell, upper_bound_cell, weight_avg_combined_metric, weight_failures, output_path_fishnet, edges)
+    # The square sizes are evaluated by this number of processes, the results are the same for any number
+    sweep_workers = os.cpu_count()
+
+    results, best_square_size, map_paths = spatial_autocorrelation_analysis(pipe_shapefile_path, failures_shapefile_path, lower_bound_cell, upper_bound_cell, weight_avg_combined_metric, weight_failures, output_path_fishnet, edges, workers=sweep_workers)
 
     ####### STEP 2B
     select_square_size = best_square_size ## εδώ ο χρήστης επιλέγει αν θέλει να κρατήσει το best_square_size ή να βάλει ένα δικό του.
@@ -1230,9 +1852,6 @@ def main():
     # Read the pipe shapefile which was created in part 1 and exported in the main folder 
     path_pipes = r"C:\Users\Nikos\Dropbox\EYDAP_Asset Management\Calcs\WP2\study_results_v1\Pipes_WG_export_with_metrics.shp"
 
-    # Read the sorted fishnet shapefile
-    path_fishnet = output_path_fishnet +'/' +str(select_square_size) + '_fishnets_sorted.shp'
-
     # Create a folder containig the optimization results
     output_path_all_cells = 'Cell_optimization_results'
     os.makedirs(output_path_all_cells, exist_ok=True)
@@ -1268,7 +1887,7 @@ def main():
     a_rel = 3 # years # check oti einai mikrotero apo to p_span
 
     # Run functions
-    pipes_gdf_cell = process_pipes_cell_data(path_pipes, path_fishnet, fishnet_index, row_number_to_keep, results_pipe_clusters, pipe_materials)
+    pipes_gdf_cell = process_pipes_cell_data(path_pipes, fishnet_index, row_number_to_keep, results_pipe_clusters, pipe_materials)
 
     pipe_table_trep, LLCCn, ann_budg, xl, xu = calculate_investment_timeseries(pipes_gdf_cell, p_span, 50, a_rel)
 
@@ -0,0 +1,32 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely.geometry import LineString, Point
+
+
+@pytest.fixture
+def network(tmp_path):
+    '''
+    Synthetic step 2 inputs written as shapefiles: a grid of pipes with a combined metric and failures that also lie
+    outside the pipes, beyond the last row and column of the finer fishnets of a sweep. Returns their paths.
+    '''
+    rng = np.random.default_rng(0)
+    ox, oy = 480000.0, 4200000.0
+
+    lines = []
+    for i in range(12):
+        for j in range(12):
+            x, y = ox + i * 83.0, oy + j * 79.0
+            lines.append(LineString([(x, y), (x + 83.0 + rng.uniform(-9, 9), y + rng.uniform(-9, 9))]))
+            lines.append(LineString([(x, y), (x + rng.uniform(-9, 9), y + 79.0)]))
+    pipes = gpd.GeoDataFrame({'LABEL': np.arange(len(lines)), 'cm': rng.uniform(0, 1, len(lines))}, geometry=lines, crs='EPSG:2100')
+
+    minX, minY, maxX, maxY = pipes.total_bounds
+    points = [Point(rng.uniform(minX - 30, maxX + 250), rng.uniform(minY - 30, maxY + 250)) for _ in range(600)]
+    points += [Point(minX + 200, minY + 300), Point(minX, minY)]  # On the grid lines of the fishnets
+    failures = gpd.GeoDataFrame({'KOD_VLAVIS': np.arange(len(points))}, geometry=points, crs='EPSG:2100')
+
+    pipe_path, failures_path = str(tmp_path / "pipes.shp"), str(tmp_path / "failures.shp")
+    pipes.to_file(pipe_path)
+    failures.to_file(failures_path)
+    return pipe_path, failures_path
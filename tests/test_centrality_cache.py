@@ -0,0 +1,13 @@
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import LineString
+from src.centrality_cache import network_hash
+
+
+def test_network_hash_covers_the_pipe_lengths():
+    edges = gpd.GeoDataFrame({'node_start': [0, 1], 'node_end': [1, 2]},
+                             geometry=[LineString([(0, 0), (1, 0)]), LineString([(1, 0), (2, 0)])], crs='EPSG:2100')
+
+    assert network_hash(edges) == network_hash(edges)
+    assert network_hash(edges, np.array([1.0, 1.0])) != network_hash(edges)
+    assert network_hash(edges, np.array([1.0, 1.0])) != network_hash(edges, np.array([1.0, 2.5]))
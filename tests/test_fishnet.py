@@ -0,0 +1,55 @@
+import math
+import geopandas as gpd
+import numpy as np
+import pytest
+from src.sweep_cache import load_sweep_size, sweep_cache_key
+from src.tools import cell_incidence, create_fishnet, fishnet_average_metric, fishnet_failure_counts, read_shapefiles, \
+    spatial_autocorrelation_analysis
+
+
+SWEEP_SIZES = [100, 200, 300, 400, 500, 600]
+
+
+def sjoin_failure_counts(square_size, pipe_gdf, failures_gdf):
+    fishnet = create_fishnet(square_size, pipe_gdf)
+    return gpd.sjoin(failures_gdf, fishnet, predicate='intersects').groupby('index_right').size()
+
+
+@pytest.mark.parametrize("square_size", SWEEP_SIZES)
+def test_failure_counts_match_sjoin(network, square_size):
+    pipe_gdf, failures_gdf = read_shapefiles(*network)
+    expected = sjoin_failure_counts(square_size, pipe_gdf, failures_gdf)
+    counts = fishnet_failure_counts(square_size, pipe_gdf, failures_gdf)
+
+    assert counts.index.tolist() == expected.index.tolist()
+    assert counts.tolist() == expected.tolist()
+
+
+def test_swept_failure_counts_match_sjoin(network, tmp_path):
+    # Every size of a sweep counts the failures of its own cells, also those beyond the cells of the base fishnet
+    pipe_shp, failures_shp = network
+    pipe_gdf, failures_gdf = read_shapefiles(pipe_shp, failures_shp)
+    spatial_autocorrelation_analysis(pipe_shp, failures_shp, SWEEP_SIZES[0], SWEEP_SIZES[-1], 1, 1, str(tmp_path), pipe_gdf,
+                                     permutations=9, lazy=True)
+
+    key = sweep_cache_key(pipe_shp, failures_shp, 1, 1)
+    for square_size in SWEEP_SIZES:
+        expected = sjoin_failure_counts(square_size, pipe_gdf, failures_gdf)
+        fishnet_failures = load_sweep_size(str(tmp_path), square_size, key).fishnet_failures
+
+        assert fishnet_failures.index.tolist() == expected.index.tolist(), square_size
+        assert fishnet_failures['failures'].tolist() == expected.tolist(), square_size
+
+
+@pytest.mark.parametrize("square_size", SWEEP_SIZES)
+def test_average_metric_from_base_fishnet_matches_sjoin(network, square_size):
+    # The sweep coarsens the pipes of a base fishnet whose size divides every swept size
+    pipe_gdf, _ = read_shapefiles(*network)
+    base_size = math.gcd(*SWEEP_SIZES)
+    fishnet = create_fishnet(square_size, pipe_gdf)
+
+    expected = gpd.sjoin(pipe_gdf, fishnet, predicate='intersects').groupby('index_right')['cm'].mean()
+    average = fishnet_average_metric(square_size, pipe_gdf, base_size, cell_incidence(base_size, pipe_gdf, pipe_gdf))
+
+    assert average.index.tolist() == expected.index.tolist()
+    assert np.allclose(average.to_numpy(), expected.to_numpy())
@@ -0,0 +1,13 @@
+import matplotlib.colors as mcolors
+import matplotlib.pyplot as plt
+import numpy as np
+from src.map_utils import metric_color_indices, metric_color_lut
+
+
+def test_preview_colors_match_the_composite_map():
+    # plot_metric_map colors the pipes with cmap(cm) of the raw composite metric
+    values = np.r_[np.random.default_rng(0).uniform(-0.2, 1.2, 1000), 0, 0.5, 1]
+    cmap = plt.cm.RdYlGn.reversed()
+    lut = metric_color_lut()
+
+    assert [lut[i] for i in metric_color_indices(values)] == [mcolors.to_hex(cmap(value)) for value in values]
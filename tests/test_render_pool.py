@@ -0,0 +1,26 @@
+import time
+from src.render_pool import shutdown_render_pool, submit_render, wait_for_renders
+
+
+def write_log(path, tag, delay):
+    time.sleep(delay)
+    with open(path, 'a') as file:
+        file.write(f"start {tag}\n")
+    time.sleep(0.3)
+    with open(path, 'a') as file:
+        file.write(f"end {tag}\n")
+
+
+def test_newer_render_waits_for_the_running_one(tmp_path):
+    path = str(tmp_path / "map.png")
+    try:
+        submit_render(path, write_log, path, "old", 0.3)
+        time.sleep(0.2)  # The old job is being rendered and cannot be cancelled
+        submit_render(path, write_log, path, "replaced", 0)
+        future = submit_render(path, write_log, path, "new", 0)
+        wait_for_renders()
+    finally:
+        shutdown_render_pool()
+
+    assert future.result() == path
+    assert open(path).read().split() == ["start", "old", "end", "old", "start", "new", "end", "new"]
@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+from esda.moran import Moran_Local
+from src.tools import optimal_fishnet, read_shapefiles, spatial_autocorrelation_analysis
+
+
+def test_cached_fishnet_matches_fresh_run(network, tmp_path):
+    # Step 2b gets the same cells, weights and pipes from the sweep cache as from a fresh run
+    pipe_shp, failures_shp = network
+    pipe_gdf, _ = read_shapefiles(pipe_shp, failures_shp)
+    swept, fresh = tmp_path / "swept", tmp_path / "fresh"
+    swept.mkdir()
+    fresh.mkdir()
+    spatial_autocorrelation_analysis(pipe_shp, failures_shp, 100, 400, 1, 1, str(swept), pipe_gdf, permutations=9, lazy=True)
+
+    cached_fishnet, cached_w, cached_pipes = optimal_fishnet(pipe_shp, failures_shp, 1, 1, 300, str(swept))
+    fresh_fishnet, fresh_w, fresh_pipes = optimal_fishnet(pipe_shp, failures_shp, 1, 1, 300, str(fresh))
+
+    assert cached_fishnet.index.tolist() == fresh_fishnet.index.tolist()
+    for column in ('failures', 'avg_combined_metric', 'weighted_avg', 'weighted_fail'):
+        assert np.allclose(cached_fishnet[column], fresh_fishnet[column]), column
+    assert cached_w.neighbors == fresh_w.neighbors
+
+    key = ['fishnet_index', 'LABEL']
+    cached_pipes = cached_pipes[key].sort_values(key).reset_index(drop=True)
+    fresh_pipes = fresh_pipes[key].sort_values(key).reset_index(drop=True)
+    pd.testing.assert_frame_equal(cached_pipes, fresh_pipes, check_dtype=False)
+
+    # And so the same LISA clusters
+    cached_q = Moran_Local(cached_fishnet['weighted_avg'], cached_w, permutations=99, seed=0).q
+    fresh_q = Moran_Local(fresh_fishnet['weighted_avg'], fresh_w, permutations=99, seed=0).q
+    assert cached_q.tolist() == fresh_q.tolist()